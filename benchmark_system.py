@@ -0,0 +1,407 @@
+import io
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+import threading
+import tracemalloc
+import shutil
+import statistics
+
+# Benchmarks run against a throwaway database, never the real data/investors.db
+BENCH_DIR = tempfile.mkdtemp(prefix="investor_mail_bench_")
+os.environ["INVESTOR_MAIL_DB"] = os.path.join(BENCH_DIR, "bench.db")
+
+# Add project dir to path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "investor-mail-system"))
+
+
+def measure(func, repeat):
+    """Run func `repeat` times and return per-call latencies in microseconds"""
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        latencies.append((time.perf_counter() - start) * 1_000_000)
+    return latencies
+
+
+def report(label, latencies):
+    """Print p50/p99 of a latency list"""
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"  {label:<40} p50={p50:8.1f}µs  p99={p99:8.1f}µs")
+    return p50
+
+
+print("⏱️ PERFORMANS ÖLÇÜMÜ BAŞLIYOR...\n")
+print(f"Geçici veritabanı: {os.environ['INVESTOR_MAIL_DB']}\n")
+
+import database
+
+# 1. Veritabanı bağlantı gecikmesi
+print("1️⃣ Veritabanı Çağrı Gecikmesi (bağlantı başına çağrı vs. havuz)...")
+REPEAT = 2000
+investor_id = database.add_investor("Bench User", "bench@example.com", "Bench Co")
+
+
+def connect_per_call():
+    # The pre-pool pattern: open, query, close on every call
+    conn = sqlite3.connect(database.DATABASE_PATH)
+    conn.row_factory = sqlite3.Row
+    row = conn.execute('SELECT * FROM investors WHERE id = ?', (investor_id,)).fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+before = report("connect-per-call get_investor_by_id", measure(connect_per_call, REPEAT))
+after = report("pooled get_investor_by_id", measure(lambda: database.get_investor_by_id(investor_id), REPEAT))
+report("pooled is_unsubscribed", measure(lambda: database.is_unsubscribed("bench@example.com"), REPEAT))
+report("pooled log_sent_mail", measure(lambda: database.log_sent_mail(investor_id, None, "Bench"), REPEAT // 4))
+print(f"  ⚡ Hızlanma: {before / after:.1f}x")
+
+# 2. Yazma yükü altında okuma gecikmesi
+print(f"\n2️⃣ Kampanya Yazma Yükü Altında UI Okuma Gecikmesi (profil: {database.DB_STORAGE_PROFILE})...")
+stop_writer = threading.Event()
+
+
+def campaign_writer():
+    # Simulates the scheduler logging a send burst in small transactions
+    while not stop_writer.is_set():
+        time.sleep(0.01)
+        with database.db_connection() as conn:
+            for _ in range(50):
+                conn.execute(
+                    "INSERT INTO sent_mails (investor_id, template_id, subject, status) VALUES (?, NULL, 'Bench', 'sent')",
+                    (investor_id,)
+                )
+
+
+writer = threading.Thread(target=campaign_writer, daemon=True)
+writer.start()
+report("get_investor_by_id during write burst", measure(lambda: database.get_investor_by_id(investor_id), REPEAT // 4))
+report("get_stats during write burst", measure(database.get_stats, 50))
+stop_writer.set()
+writer.join()
+
+# 3. Toplu içe aktarma
+IMPORT_ROWS = 200_000
+print(f"\n3️⃣ {IMPORT_ROWS:,} Satırlık CSV İçe Aktarma...")
+import pandas as pd
+from importer import read_investor_file, import_dataframe, stream_import
+
+
+class NamedFile(io.BytesIO):
+    # Mimics Streamlit's UploadedFile (a BytesIO with a name)
+    name = "bench.csv"
+
+
+csv_bytes = pd.DataFrame({
+    'İsim': [f"Yatırımcı {i}" for i in range(IMPORT_ROWS)],
+    'Email': [f"investor{i}@example.com" for i in range(IMPORT_ROWS)],
+    'Şirket': [f"Fund {i % 500}" for i in range(IMPORT_ROWS)],
+    'Kategori': [('MELEK', 'VC', 'GAMING')[i % 3] for i in range(IMPORT_ROWS)],
+    'Telefon': [f"0555{i:07d}" for i in range(IMPORT_ROWS)],
+}).to_csv(index=False).encode('utf-8')
+
+start = time.perf_counter()
+result = import_dataframe(read_investor_file(NamedFile(csv_bytes)), 'standard', 'skip')
+print(f"  İlk yükleme:        {time.perf_counter() - start:6.2f}s  {result}")
+start = time.perf_counter()
+result = import_dataframe(read_investor_file(NamedFile(csv_bytes)), 'standard', 'update')
+print(f"  Tekrar (güncelle):  {time.perf_counter() - start:6.2f}s  {result}")
+
+# 4. Parça parça (streaming) içe aktarma belleği
+print("\n4️⃣ Tüm Dosya vs. Parça Parça İçe Aktarma Bellek Tepe Noktası...")
+tracemalloc.start()
+import_dataframe(read_investor_file(NamedFile(csv_bytes)), 'standard', 'skip')
+whole_peak = tracemalloc.get_traced_memory()[1]
+tracemalloc.reset_peak()
+start = time.perf_counter()
+job = stream_import(NamedFile(csv_bytes), "bench.csv", 'standard', 'skip')
+stream_peak = tracemalloc.get_traced_memory()[1]
+tracemalloc.stop()
+print(f"  Tüm dosya:      tepe {whole_peak / 1024 / 1024:7.1f} MB")
+print(f"  Parça parça:    tepe {stream_peak / 1024 / 1024:7.1f} MB  ({time.perf_counter() - start:.2f}s, {job['rows_committed']:,} satır)")
+
+# 5. Şablon render hızı
+print("\n5️⃣ Varsayılan Şablonlarda Render Hızı (renders/sn)...")
+from jinja2 import Template
+import template_engine
+
+RENDERS = 2000
+context = {'name': 'Ayşe Yılmaz', 'company': 'Örnek Ventures', 'email': 'ayse@example.com', 'category': 'VC'}
+for tmpl in template_engine.get_default_templates():
+    start = time.perf_counter()
+    for _ in range(RENDERS // 10):
+        Template(tmpl['body']).render(ad=context['name'], sirket=context['company'])
+    uncached = (RENDERS // 10) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(RENDERS):
+        template_engine.render_template(tmpl['body'], context)
+    cached = RENDERS / (time.perf_counter() - start)
+    print(f"  {tmpl['name']:<24} derlemeli {uncached:8.0f}/sn  önbellekli {cached:8.0f}/sn  ({cached / uncached:.0f}x)")
+print(f"  Önbellek: {template_engine.get_template_cache_stats()}")
+
+print("\n6️⃣ Basit Şablonlarda Hızlı Yol vs Jinja2 (renders/sn)...")
+jinja_cache = template_engine.TemplateCache(bytecode_dir=None, fast_path=False)
+fast_cache = template_engine.TemplateCache(bytecode_dir=None)
+full_context = template_engine.build_context(context)
+for tmpl in template_engine.get_default_templates():
+    rates = []
+    for cache in (jinja_cache, fast_cache):
+        compiled = cache.get(tmpl['body'])
+        start = time.perf_counter()
+        for _ in range(RENDERS * 5):
+            compiled.render(full_context)
+        rates.append(RENDERS * 5 / (time.perf_counter() - start))
+    print(f"  {tmpl['name']:<24} jinja2 {rates[0]:9.0f}/sn  hızlı yol {rates[1]:9.0f}/sn  ({rates[1] / rates[0]:.1f}x)")
+
+print("\n7️⃣ Büyük HTML Gövdede Piksel + MIME (mesaj/sn)...")
+from email.mime.text import MIMEText
+from mail_sender import html_part
+big_source = "<html><body>" + "<p>Sayın {{ad}}, {{sirket}} için detaylı sunum paragrafı.</p>" * 4000 + "</body></html>"
+big_template = fast_cache.get(big_source)
+MESSAGES = 200
+start = time.perf_counter()
+for _ in range(MESSAGES):
+    rendered = big_template.render(full_context)
+    if "</body>" in rendered:
+        rendered = rendered.replace("</body>", f"{template_engine.TRACKING_PIXEL}</body>")
+    MIMEText(rendered, 'html', 'utf-8')
+old_rate = MESSAGES / (time.perf_counter() - start)
+start = time.perf_counter()
+for _ in range(MESSAGES):
+    html_part(template_engine.render_message(big_template, full_context, template_engine.TRACKING_PIXEL, as_bytes=True))
+new_rate = MESSAGES / (time.perf_counter() - start)
+print(f"  {len(big_source) // 1024} KB şablon: replace + str {old_rate:6.0f}/sn  footer slot + bytes {new_rate:6.0f}/sn  ({new_rate / old_rate:.1f}x)")
+
+print("\n8️⃣ 1000 Alıcılı Kampanya, Ekli Dosyalar (CPU sn / tepe bellek)...")
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from mime_message import message_chunks, prepare_attachments, close_attachments
+
+CAMPAIGN = 1000
+MEMORY_SAMPLE = 50  # tracemalloc slows the old path a lot, peak memory is per message anyway
+campaign_files = [("pitch_deck.pdf", os.urandom(768 * 1024), "application/pdf"),
+                  ("one_pager.pdf", os.urandom(128 * 1024), "application/pdf")]
+campaign_body = template_engine.render_template(template_engine.get_default_templates()[1]['body'], context)
+
+
+def per_recipient_encoding(count):
+    """Old path: every message re-encodes every attachment"""
+    for _ in range(count):
+        msg = MIMEMultipart('mixed')
+        msg['To'] = context['email']
+        msg['Subject'] = "Sunum"
+        msg.attach(MIMEText(campaign_body, 'html', 'utf-8'))
+        for filename, content, ctype in campaign_files:
+            part = MIMEBase(*ctype.split('/', 1))
+            part.set_payload(content)
+            encoders.encode_base64(part)
+            part.add_header('Content-Disposition', f'attachment; filename="{filename}"')
+            msg.attach(part)
+        msg.as_string().encode('ascii')
+
+
+def prepared_encoding(count):
+    """New path: attachments encoded once, messages reuse the parts"""
+    prepared = prepare_attachments(campaign_files)
+    for _ in range(count):
+        message_chunks(None, context['email'], "Sunum", campaign_body, prepared)
+    close_attachments(prepared)
+
+
+for label, campaign in (("her alıcıda base64", per_recipient_encoding), ("bir kez hazırlanmış", prepared_encoding)):
+    cpu_start = time.process_time()
+    campaign(CAMPAIGN)
+    cpu = time.process_time() - cpu_start
+    tracemalloc.start()
+    campaign(MEMORY_SAMPLE)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"  {label:<20} CPU {cpu:7.2f} sn   tepe bellek {peak / 1024 / 1024:7.1f} MB")
+
+print("\n9️⃣ SMTP Havuzu Verimi, Yerel SMTP Sink (mail/sn, 50 ms sunucu gecikmesi)...")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from smtp_sink import SMTPSink
+from mail_sender import MailSender, MailSenderPool
+from rate_limiter import RateLimiter
+
+POOL_MAILS = 200
+sink = SMTPSink(latency=0.05).start()
+pool_recipients = [{'email': f'yatirimci{i}@example.com', 'name': f'Yatırımcı {i}', 'company': 'Fon'}
+                   for i in range(POOL_MAILS)]
+body_source = template_engine.get_default_templates()[0]['body']
+no_limit = RateLimiter(0)
+
+sender = MailSender("me@example.com", "", server="127.0.0.1", port=sink.port, starttls=False, rate_limiter=no_limit)
+sender.connect()
+start = time.perf_counter()
+sender.send_bulk(pool_recipients, "{{sirket}}", body_source)
+serial_rate = POOL_MAILS / (time.perf_counter() - start)
+sender.disconnect()
+print(f"  Tek bağlantı (MailSender)  {serial_rate:7.1f}/sn")
+
+for size in (2, 4, 8, 16):
+    pool = MailSenderPool("me@example.com", "", size=size, server="127.0.0.1", port=sink.port,
+                          starttls=False, rate_limiter=no_limit)
+    pool.connect()
+    start = time.perf_counter()
+    pool.send_bulk(pool_recipients, "{{sirket}}", body_source)
+    rate = POOL_MAILS / (time.perf_counter() - start)
+    pool.disconnect()
+    print(f"  Havuz, {size:2} bağlantı         {rate:7.1f}/sn  ({rate / serial_rate:.1f}x)")
+
+from async_sender import AsyncSMTPTransport, run_campaign
+for size in (8, 16):
+    transport = AsyncSMTPTransport("me@example.com", "", size=size, server="127.0.0.1", port=sink.port, starttls=False)
+    start = time.perf_counter()
+    list(run_campaign(transport, pool_recipients, "{{sirket}}", body_source, rate_limiter=no_limit))
+    rate = POOL_MAILS / (time.perf_counter() - start)
+    print(f"  Async motor, {size:2} oturum    {rate:7.1f}/sn  ({rate / serial_rate:.1f}x)")
+sink.stop()
+
+print("\n🔟 Zamanlayıcı Gönderim Gecikmesi (planlanan zaman → gönderim)...")
+from datetime import datetime, timedelta
+from scheduler import EmailScheduler
+
+
+class BenchScheduler(EmailScheduler):
+    """Scheduler with a no-op Gmail client"""
+    _instance = None
+    _running = False
+
+    def _oauth_client(self):
+        return object()
+
+    def _send(self, oauth_client, messages):
+        for key, mail, *_ in messages:
+            yield {'key': key, 'recipient': mail, 'success': True, 'message': "✅", 'error_kind': None}
+
+
+SCHEDULED_MAILS = 200
+bench_scheduler = BenchScheduler()
+start = datetime.now()
+for i in range(SCHEDULED_MAILS):
+    database.schedule_mail(investor_id, None, "Konu", "<p>Gövde</p>", start + timedelta(seconds=0.5 + i * 0.01))
+deadline = time.time() + 30
+while bench_scheduler.lag_stats()['count'] < SCHEDULED_MAILS and time.time() < deadline:
+    time.sleep(0.05)
+bench_scheduler.stop()
+lag = bench_scheduler.lag_stats()
+print(f"  {'Uyandırma yığını (' + str(lag['count']) + ' mail)':<32} p50={lag['p50'] * 1000:8.1f}ms  p99={lag['p99'] * 1000:8.1f}ms")
+print(f"  {'60 sn yoklama (önceki)':<32} ortalama ~30 sn, en kötü 60 sn")
+
+print("\n1️⃣1️⃣ 10.000 Alıcıya Planlama: Hazır HTML vs Şablon + Bağlam (süre / saklanan veri)...")
+from scheduler import schedule_campaign
+from template_engine import get_default_templates, render_batch
+
+SCHEDULE_RECIPIENTS = 10_000
+with database.db_connection() as conn:
+    schedule_recipients = [dict(row) for row in conn.execute("SELECT * FROM investors LIMIT ?", (SCHEDULE_RECIPIENTS,))]
+pitch = get_default_templates()[0]
+tomorrow = datetime.now() + timedelta(days=1)
+
+
+def stored_bytes():
+    """Bytes of scheduled mail subjects, bodies, contexts and template snapshots"""
+    with database.db_connection() as conn:
+        mails = conn.execute(
+            "SELECT COALESCE(SUM(IFNULL(LENGTH(CAST(subject AS BLOB)), 0) + IFNULL(LENGTH(CAST(body AS BLOB)), 0)"
+            " + IFNULL(LENGTH(CAST(context AS BLOB)), 0)), 0) FROM scheduled_mails"
+        ).fetchone()[0]
+        snapshots = conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(CAST(subject_template AS BLOB)) + LENGTH(CAST(body_template AS BLOB))), 0)"
+            " FROM scheduled_campaigns"
+        ).fetchone()[0]
+    with database.db_connection() as conn:
+        conn.execute("DELETE FROM scheduled_mails")
+        conn.execute("DELETE FROM scheduled_campaigns")
+    return mails + snapshots
+
+
+start = time.perf_counter()
+with database.db_connection():
+    for inv, subject, body in render_batch(pitch['body'], pitch['subject'], schedule_recipients):
+        database.schedule_mail(inv['id'], None, subject, body, tomorrow)
+eager_time = time.perf_counter() - start
+eager_bytes = stored_bytes()
+
+start = time.perf_counter()
+schedule_campaign(schedule_recipients, pitch['subject'], pitch['body'], tomorrow)
+lazy_time = time.perf_counter() - start
+lazy_bytes = stored_bytes()
+print(f"  Hazır HTML (önceki):   {eager_time:6.2f}s  {eager_bytes / 1024 / 1024:7.2f} MB")
+print(f"  Şablon + bağlam:       {lazy_time:6.2f}s  {lazy_bytes / 1024 / 1024:7.2f} MB  "
+      f"({eager_bytes / max(lazy_bytes, 1):.0f}x daha az)")
+
+print("\n1️⃣2️⃣ Streamlit Yeniden Çalıştırma Okumaları (yatırımcılar, şablonlar, kategoriler, istatistikler)...")
+import data_cache
+
+
+def rerun_reads(module):
+    module.get_all_investors()
+    module.get_all_templates()
+    module.get_categories()
+    module.get_stats()
+
+
+total = database.get_stats()['total_investors']
+report(f"Her seferinde veritabanı ({total:,} kişi)", measure(lambda: rerun_reads(database), 5))
+rerun_reads(data_cache)
+report("Önbellek (tablo nesli)", measure(lambda: rerun_reads(data_cache), 1000))
+
+print("\n1️⃣3️⃣ 5.000 Seçili Yatırımcıyı Okuma (kişi başına sorgu vs. toplu)...")
+with database.db_connection() as conn:
+    selected_ids = [row['id'] for row in conn.execute("SELECT id FROM investors ORDER BY RANDOM() LIMIT 5000")]
+start = time.perf_counter()
+[database.get_investor_by_id(inv_id) for inv_id in selected_ids]
+per_id_time = time.perf_counter() - start
+start = time.perf_counter()
+list(database.get_investors_by_ids(selected_ids))
+bulk_time = time.perf_counter() - start
+print(f"  get_investor_by_id döngüsü:  {per_id_time * 1000:8.1f} ms")
+print(f"  get_investors_by_ids:        {bulk_time * 1000:8.1f} ms  ({per_id_time / bulk_time:.1f}x)")
+
+print("\n1️⃣4️⃣ CRM Listesi Sayfası (tüm liste + Python filtresi vs. SQL filtresi + keyset, 50 satır)...")
+deep = database.get_investor_page(limit=1, offset=total - 100)[0]
+deep_key = (deep['category'], deep['name'], deep['id'])
+
+
+def python_filtered_page():
+    investors = database.get_all_investors()
+    filtered = [i for i in investors if i['category'] == 'VC' and 'fund 1' in (i['company'] or '').lower()]
+    return filtered[:50]
+
+
+report("Tüm liste + Python filtresi", measure(python_filtered_page, 5))
+report("Keyset, ilk sayfa", measure(lambda: database.get_investors_keyset(limit=50), 200))
+report("Keyset, son sayfalar", measure(lambda: database.get_investors_keyset(limit=50, after=deep_key), 200))
+report("OFFSET, son sayfalar", measure(lambda: database.get_investor_page(limit=50, offset=total - 100), 20))
+report("SQL filtresi (kategori + arama)", measure(lambda: database.get_investors_keyset('VC', 'fund 1', limit=50), 200))
+report("Durum sayıları", measure(database.get_status_counts, 20))
+
+print(f"\n1️⃣5️⃣ Yatırımcı Arama ({total:,} kişi, isim + şirket + not + etiket, 20 sonuç)...")
+
+
+def substring_search(text):
+    needle = text.lower()
+    with database.db_connection() as conn:
+        return conn.execute(
+            "SELECT * FROM investors WHERE is_active = 1 AND instr(py_lower(name || ' ' || COALESCE(company, '') "
+            "|| ' ' || COALESCE(notes, '') || ' ' || COALESCE(tags, '')), ?) > 0 ORDER BY name LIMIT 20",
+            (needle,)).fetchall()
+
+
+report("instr(py_lower(...)) taraması", measure(lambda: substring_search("fund 1"), 5))
+report("FTS5 + bm25 (search_investors)", measure(lambda: database.search_investors("fund 1"), 200))
+report("FTS5, nadir kelime", measure(lambda: database.search_investors("investor 1234"), 200))
+
+database._manager.close_all()
+shutil.rmtree(BENCH_DIR, ignore_errors=True)
+print("\n🏁 ÖLÇÜM TAMAMLANDI!")
@@ -12,19 +12,28 @@ from datetime import datetime
 import io
 
 # Local imports
-from config import APP_TITLE, PAGE_ICON, DAILY_LIMIT
+from config import APP_TITLE, PAGE_ICON, DAILY_LIMIT, OUTBOX_LEASE_SECONDS
 from database import (
-    init_db, get_all_investors, add_investor, bulk_add_investors,
-    get_all_templates, add_template, get_template_by_id, update_template, delete_template,
-    get_sent_mails, get_stats, log_sent_mail, get_categories,
-    get_investor_by_id, update_investor, delete_investor,
-    add_interaction, get_investor_interactions
+    init_db, add_investor, bulk_add_investors,
+    add_template, update_template, delete_template,
+    get_investor_by_id, get_investors_by_ids, update_investor, delete_investor,
+    count_investors, get_investor_ids, get_investor_page, get_investors_keyset,
+    add_interaction, get_investor_interactions, get_unfinished_import_jobs,
+    get_unfinished_campaigns, get_campaign_progress, cancel_campaign
+)
+# Reads that every rerun repeats, served from memory until their tables change
+from data_cache import (
+    get_all_investors, get_categories, get_status_counts, get_all_templates, get_template_by_id, get_stats,
+    get_sent_mails
 )
 from mail_sender import MailSender, validate_email
-from template_engine import render_template, get_default_templates, preview_template, generate_ai_suggestion
+from async_sender import AsyncSMTPTransport, AsyncGmailBatchTransport
+from outbox import enqueue_campaign, run_outbox
+from rate_limiter import get_rate_limiter, get_throttle
+from template_engine import render_batch, get_default_templates, preview_template, generate_ai_suggestion
 from gmail_oauth import GmailOAuth, check_credentials_file
-from database import schedule_mail
-from scheduler import EmailScheduler
+from importer import stream_import
+from scheduler import EmailScheduler, schedule_campaign
 
 
 # Page config
@@ -407,7 +416,7 @@ def init_session_state():
     if 'auth_method' not in st.session_state:
         st.session_state.auth_method = None  # 'oauth' or 'smtp'
     if 'selected_investors' not in st.session_state:
-        st.session_state.selected_investors = []
+        st.session_state.selected_investors = set()  # Investor ids picked on the send page
     if 'current_page' not in st.session_state:
         st.session_state.current_page = "Dashboard"
     
@@ -599,10 +608,26 @@ def render_dashboard():
     with col2:
         st.metric("Gönderilen", stats['total_sent'], help="Toplam gönderilen mail")
     with col3:
-        st.metric("Bugün", f"{stats['sent_today']}/{DAILY_LIMIT}", help="Günlük gönderim limiti")
+        quota = get_rate_limiter().status()
+        st.metric("Son 24 Saat", f"{quota['sent_24h']}/{DAILY_LIMIT}", help="Günlük gönderim limiti (son 24 saat, tüm gönderimler)")
     with col4:
         st.metric("Başarısız", stats['total_failed'], help="Başarısız gönderimler")
     
+    # Effective send rate of this session (slows down on 421/450/429 replies)
+    throttle_metrics = get_throttle().metrics()
+    if throttle_metrics['sent'] or throttle_metrics['transient']:
+        st.markdown("#### 📈 Gönderim Hızı")
+        rate_df = pd.DataFrame(throttle_metrics['series']).set_index('time')
+        st.line_chart(rate_df[['sent_per_minute', 'errors']], use_container_width=True)
+        caption = (
+            f"Hız: %{throttle_metrics['factor'] * 100:.0f} · "
+            f"Son dakika: {throttle_metrics['sent_per_minute']:.0f} mail/dk · "
+            f"Geçici hata: {throttle_metrics['transient']}"
+        )
+        if throttle_metrics['backoff_seconds'] > 0:
+            caption += f" · ⏳ {throttle_metrics['backoff_seconds']:.0f} sn bekleniyor"
+        st.caption(caption)
+    
     st.markdown("<br>", unsafe_allow_html=True)
     
     # Recent activity
@@ -650,6 +675,38 @@ def render_dashboard():
 
 # ============ INVESTORS PAGE ============
 
+CRM_PAGE_SIZES = [25, 50, 100]
+CRM_STATUSES = ['NEW', 'CONTACTED', 'REPLIED', 'MEETING', 'REJECTED']
+
+
+def get_crm_page(filters, page_size):
+    """
+    Current page of the CRM list: (rows, has_prev, has_next)
+    
+    The position is a keyset cursor in st.session_state.crm_page (the (category, name, id)
+    of the row the page starts after or ends before); changing a filter goes back to page 1.
+    """
+    signature = (tuple(sorted(filters.items())), page_size)
+    state = st.session_state.get('crm_page')
+    if state is None or state['signature'] != signature:
+        state = st.session_state.crm_page = {'signature': signature, 'after': None, 'before': None, 'number': 1}
+    
+    # One extra row tells whether there is a page beyond this one
+    rows = get_investors_keyset(limit=page_size + 1, after=state['after'], before=state['before'], **filters)
+    if state['before'] is not None:
+        has_prev, has_next = len(rows) > page_size, True
+        rows = rows[-page_size:]
+    else:
+        has_prev, has_next = state['number'] > 1, len(rows) > page_size
+        rows = rows[:page_size]
+    
+    if not rows and state['number'] > 1:
+        # The page emptied (investors deleted meanwhile), start over
+        state.update(after=None, before=None, number=1)
+        return get_crm_page(filters, page_size)
+    return rows, has_prev, has_next
+
+
 def render_investors():
     """Render the investors management page with CRM features"""
     # Modern Header
@@ -667,20 +724,17 @@ def render_investors():
     tab1, tab2, tab3 = st.tabs(["📋 Liste & Detaylar", "📤 Dosya Yükle", "➕ Manuel Ekle"])
     
     with tab1:
-        investors = get_all_investors()
+        # Aggregates only; the list below loads one page at a time
+        status_counts = get_status_counts()
+        total = sum(status_counts.values())
         
-        if investors:
+        if total:
             # Stats row
-            total = len(investors)
-            new = len([i for i in investors if i.get('status', 'NEW') == 'NEW'])
-            contacted = len([i for i in investors if i.get('status') == 'CONTACTED'])
-            replied = len([i for i in investors if i.get('status') == 'REPLIED'])
-            
             c1, c2, c3, c4 = st.columns(4)
             c1.metric("Toplam", total)
-            c2.metric("🆕 Yeni", new)
-            c3.metric("📩 İletişimde", contacted)
-            c4.metric("💬 Cevaplayan", replied)
+            c2.metric("🆕 Yeni", status_counts.get('NEW', 0))
+            c3.metric("📩 İletişimde", status_counts.get('CONTACTED', 0))
+            c4.metric("💬 Cevaplayan", status_counts.get('REPLIED', 0))
             
             st.markdown("---")
             
@@ -690,27 +744,34 @@ def render_investors():
             with col_list:
                 st.markdown("### 🔍 Yatırımcı Listesi")
                 
-                # Filters
-                search = st.text_input("Ara", placeholder="İsim veya şirket...", label_visibility="collapsed")
-                filter_cat = st.selectbox("Kategori", ['Tümü'] + get_categories(), label_visibility="collapsed")
+                # Filters (run in SQL)
+                search = st.text_input("Ara", placeholder="İsim, şirket, not, etiket...", label_visibility="collapsed")
+                fc1, fc2 = st.columns(2)
+                filter_cat = fc1.selectbox("Kategori", ['Tümü'] + get_categories(), label_visibility="collapsed")
+                filter_status = fc2.selectbox("Durum", ['Tümü'] + CRM_STATUSES, label_visibility="collapsed")
+                fc3, fc4 = st.columns([2, 1])
+                filter_tag = fc3.text_input("Etiket", placeholder="Etiket...", label_visibility="collapsed")
+                page_size = fc4.selectbox("Sayfa boyutu", CRM_PAGE_SIZES, index=1, label_visibility="collapsed")
                 
-                # Filter logic
-                filtered = investors
-                if filter_cat != 'Tümü':
-                    filtered = [i for i in filtered if i['category'] == filter_cat]
-                if search:
-                    s = search.lower()
-                    filtered = [i for i in filtered if s in i['name'].lower() or s in (i['company'] or '').lower()]
-                
-                # List view
+                filters = {
+                    'category': None if filter_cat == 'Tümü' else filter_cat,
+                    'search': search or None,
+                    'status': None if filter_status == 'Tümü' else filter_status,
+                    'tag': filter_tag.strip() or None,
+                }
+                page, has_prev, has_next = get_crm_page(filters, page_size)
+                matching = count_investors(**filters)
                 
-                # Excel Export
-                if filtered:
-                    df = pd.DataFrame(filtered)
-                    csv = df.to_csv(index=False).encode('utf-8-sig')
+                # Excel Export (the whole filtered list, built on demand)
+                export_key = tuple(sorted(filters.items()))
+                if st.button("📊 Listeyi Excel/CSV İçin Hazırla", use_container_width=True, disabled=not matching):
+                    df = pd.DataFrame(get_investor_page(limit=-1, **filters))
+                    st.session_state.crm_export = (export_key, df.to_csv(index=False).encode('utf-8-sig'))
+                export = st.session_state.get('crm_export')
+                if export and export[0] == export_key:
                     st.download_button(
-                        "📊 Listeyi Excel/CSV Olarak İndir",
-                        csv,
+                        "📥 CSV İndir",
+                        export[1],
                         "yatirimcilar.csv",
                         "text/csv",
                         key='download-csv',
@@ -719,12 +780,12 @@ def render_investors():
                 
                 st.markdown("---")
                 
-                for inv in filtered:
-                    status_colors = {
-                        'NEW': '⬜', 'CONTACTED': '🟦', 'REPLIED': '🟩', 
-                        'MEETING': '🟪', 'REJECTED': '🟥'
-                    }
-                    status_icon = status_colors.get(inv.get('status', 'NEW'), '⬜')
+                status_colors = {
+                    'NEW': '⬜', 'CONTACTED': '🟦', 'REPLIED': '🟩', 
+                    'MEETING': '🟪', 'REJECTED': '🟥'
+                }
+                for inv in page:
+                    status_icon = status_colors.get(inv.get('status') or 'NEW', '⬜')
                     
                     with st.container():
                         c1, c2 = st.columns([4, 1])
@@ -732,8 +793,27 @@ def render_investors():
                         if c2.button("Detay", key=f"sel_{inv['id']}"):
                             st.session_state.selected_investor_id = inv['id']
                             st.rerun()
-                        st.markdown(f"<small>{status_icon} {inv.get('status', 'NEW')}</small>", unsafe_allow_html=True)
+                        st.markdown(f"<small>{status_icon} {inv.get('status') or 'NEW'}</small>", unsafe_allow_html=True)
                         st.divider()
+                
+                if not page:
+                    st.info("🔍 Filtreye uyan yatırımcı yok")
+                
+                # Pagination
+                state = st.session_state.crm_page
+                pages = max(1, -(-matching // page_size))
+                nc1, nc2, nc3 = st.columns([1, 2, 1])
+                if nc1.button("◀", disabled=not has_prev, key="crm_prev"):
+                    first = page[0]
+                    state.update(after=None, before=(first['category'], first['name'], first['id']),
+                                 number=state['number'] - 1)
+                    st.rerun()
+                nc2.caption(f"Sayfa {state['number']} / {pages} · {matching} sonuç")
+                if nc3.button("▶", disabled=not has_next, key="crm_next"):
+                    last = page[-1]
+                    state.update(after=(last['category'], last['name'], last['id']), before=None,
+                                 number=state['number'] + 1)
+                    st.rerun()
 
             with col_detail:
                 if st.session_state.selected_investor_id:
@@ -821,6 +901,20 @@ def render_investors():
         
         import_type = st.radio("Dosya Tipi", ["Standart (Excel/CSV)", "LinkedIn Export (CSV)"])
         
+        conflict_label = st.radio(
+            "Kayıtlı e-postalar",
+            ["Atla", "Güncelle"],
+            horizontal=True,
+            help="Zaten kayıtlı olan e-postalar atlanır veya boş olmayan alanlarla güncellenir"
+        )
+        on_conflict = 'update' if conflict_label == "Güncelle" else 'skip'
+        
+        for job in get_unfinished_import_jobs():
+            st.info(
+                f"⏸️ Yarım kalan içe aktarma: **{job['filename']}** ({job['rows_committed']:,} satır işlendi). "
+                "Aynı dosyayı tekrar yükleyerek kaldığı yerden devam edebilirsiniz."
+            )
+        
         if import_type == "Standart (Excel/CSV)":
             st.caption("Format: İsim, Email, Şirket, Kategori, Notlar")
             uploaded_file = st.file_uploader("Dosya Seç", type=['csv', 'xlsx'])
@@ -828,29 +922,11 @@ def render_investors():
             if uploaded_file:
                 if st.button("📥 Yükle"):
                     try:
-                        if uploaded_file.name.endswith('.csv'):
-                            df = pd.read_csv(uploaded_file)
-                        else:
-                            df = pd.read_excel(uploaded_file)
-                        
-                        count = 0
-                        for _, row in df.iterrows():
-                            # Basic mapping
-                            name = row.get('İsim') or row.get('Name')
-                            email = row.get('Email') or row.get('E-posta')
-                            
-                            if name and email:
-                                add_investor(
-                                    name=name,
-                                    email=email,
-                                    company=row.get('Şirket', row.get('Company', '')),
-                                    category=row.get('Kategori', row.get('Category', 'GENEL')),
-                                    notes=row.get('Notlar', row.get('Notes', '')),
-                                    phone=str(row.get('Telefon', row.get('Phone', ''))),
-                                    linkedin=row.get('LinkedIn', '')
-                                )
-                                count += 1
-                        st.success(f"✅ {count} kişi eklendi!")
+                        result = run_streaming_import(uploaded_file, 'standard', on_conflict)
+                        st.success(
+                            f"✅ {result['added']} kişi eklendi, {result['updated']} güncellendi, "
+                            f"{result['skipped']} atlandı ({result['invalid']} satırda isim/email eksik)"
+                        )
                         st.rerun()
                     except Exception as e:
                         st.error(f"Hata: {e}")
@@ -862,37 +938,10 @@ def render_investors():
             if uploaded_file:
                 if st.button("📥 LinkedIn Kişilerini Yükle"):
                     try:
-                        df = pd.read_csv(uploaded_file, skiprows=2) # LinkedIn csv often has header text
-                        # Check columns
-                        if 'Email Address' not in df.columns:
-                            # Try reloading without skiprows if failed
-                            uploaded_file.seek(0)
-                            df = pd.read_csv(uploaded_file)
+                        result = run_streaming_import(uploaded_file, 'linkedin', on_conflict)
+                        count = result['added'] + result['updated']
                         
-                        count = 0
-                        for _, row in df.iterrows():
-                            email = row.get('Email Address')
-                            if not email or pd.isna(email): continue
-                            
-                            first = row.get('First Name', '')
-                            last = row.get('Last Name', '')
-                            name = f"{first} {last}".strip()
-                            
-                            company = row.get('Company', '')
-                            position = row.get('Position', '')
-                            
-                            # Add with default category
-                            add_investor(
-                                name=name,
-                                email=email,
-                                company=company,
-                                category="GENEL",
-                                notes=f"LinkedIn Import. Position: {position}",
-                                linkedin=row.get('URL', '') # Some exports have URL
-                            )
-                            count += 1
-                            
-                        st.success(f"✅ {count} kişi eklendi!")
+                        st.success(f"✅ {result['added']} kişi eklendi, {result['updated']} güncellendi, {result['skipped']} atlandı")
                         if count == 0:
                             st.warning("Hiç email bulunamadı. LinkedIn exportlarında genelde email gizlidir. Sadece izin verenlerin maili gelir.")
                         else:
@@ -922,6 +971,23 @@ def render_investors():
                 st.rerun()
 
 
+def run_streaming_import(uploaded_file, import_type, on_conflict):
+    """Stream an uploaded file into the database with a progress bar"""
+    progress_bar = st.progress(0.0)
+    status_text = st.empty()
+    
+    def on_progress(rows_done, fraction):
+        if fraction is not None:
+            progress_bar.progress(fraction)
+        status_text.text(f"{rows_done:,} satır işlendi...")
+    
+    result = stream_import(uploaded_file, uploaded_file.name, import_type, on_conflict,
+                           progress_callback=on_progress)
+    progress_bar.empty()
+    status_text.empty()
+    return result
+
+
 # ============ TEMPLATES PAGE ============
 
 def render_templates():
@@ -1066,6 +1132,16 @@ def render_templates():
 
 # ============ HELPER FUNCTION FOR SENDING MAIL ============
 
+def make_send_transport():
+    """Async sending transport for the current auth method (OAuth or SMTP)"""
+    if st.session_state.auth_method == 'oauth' and st.session_state.gmail_oauth:
+        return AsyncGmailBatchTransport(st.session_state.gmail_oauth)
+    elif st.session_state.auth_method == 'smtp' and st.session_state.mail_sender:
+        sender = st.session_state.mail_sender
+        return AsyncSMTPTransport(sender.email, sender.app_password)
+    raise RuntimeError("Gmail'e bağlı değil!")
+
+
 def send_email_helper(to_email, subject, body_html, attachments=None):
     """Send email using either OAuth or SMTP based on auth method"""
     if st.session_state.auth_method == 'oauth' and st.session_state.gmail_oauth:
@@ -1078,6 +1154,81 @@ def send_email_helper(to_email, subject, body_html, attachments=None):
 
 # ============ SEND MAIL PAGE ============
 
+PICKER_PAGE_SIZES = [50, 100, 250, 500]
+
+
+def render_recipient_picker():
+    """
+    Recipient selection: filters, a paginated checkbox table and bulk select buttons
+    
+    The selection is a set of investor ids in st.session_state.selected_investors.
+    Only the current page is loaded and rendered; "select all matching" asks the
+    database for the matching ids instead of walking the list.
+    """
+    selected = st.session_state.selected_investors
+    if 'picker_version' not in st.session_state:
+        st.session_state.picker_version = 0
+    
+    col1, col2, col3 = st.columns([1, 3, 1])
+    with col1:
+        categories = ['Tümü'] + get_categories()
+        filter_category = st.selectbox("Kategori", categories, key="send_category")
+    with col2:
+        search = st.text_input("🔍 Ara", key="send_search", placeholder="İsim, şirket, not, etiket...")
+    with col3:
+        page_size = st.selectbox("Sayfa boyutu", PICKER_PAGE_SIZES, index=1, key="send_page_size")
+    
+    category = None if filter_category == 'Tümü' else filter_category
+    matching = count_investors(category, search)
+    pages = max(1, -(-matching // page_size))
+    
+    # Select buttons
+    col1, col2, col3, col4 = st.columns([2, 2, 1, 2])
+    with col1:
+        if st.button(f"☑️ Filtreye Uyan Tümünü Seç ({matching})"):
+            selected.update(get_investor_ids(category, search))
+            st.session_state.picker_version += 1
+            st.rerun()
+    with col2:
+        if st.button("➖ Filtreye Uyanları Kaldır"):
+            selected.difference_update(get_investor_ids(category, search))
+            st.session_state.picker_version += 1
+            st.rerun()
+    with col3:
+        if st.button("⬜ Tümünü Kaldır"):
+            selected.clear()
+            st.session_state.picker_version += 1
+            st.rerun()
+    with col4:
+        page = st.number_input(f"Sayfa (toplam {pages})", min_value=1, max_value=pages, value=1, key="send_page")
+    
+    rows = get_investor_page(category, search, page_size, (min(page, pages) - 1) * page_size)
+    if not rows:
+        st.info("🔍 Filtreye uyan yatırımcı yok")
+        return
+    
+    page_df = pd.DataFrame({
+        'Seç': [inv['id'] in selected for inv in rows],
+        'İsim': [inv['name'] for inv in rows],
+        'Şirket': [inv['company'] or '-' for inv in rows],
+        'Kategori': [inv['category'] for inv in rows],
+        'Email': [inv['email'] for inv in rows],
+    }, index=[inv['id'] for inv in rows])
+    
+    # The key changes with the page, filter and bulk actions, so stale edits are never replayed
+    editor_key = f"picker_{st.session_state.picker_version}_{filter_category}_{search}_{page_size}_{page}"
+    edited = st.data_editor(
+        page_df, key=editor_key, hide_index=True, use_container_width=True,
+        disabled=['İsim', 'Şirket', 'Kategori', 'Email'],
+        column_config={'Seç': st.column_config.CheckboxColumn("Seç", width="small")}
+    )
+    for investor_id, checked in edited['Seç'].items():
+        if checked:
+            selected.add(investor_id)
+        else:
+            selected.discard(investor_id)
+
+
 def render_send_mail():
     """Render the send mail page with scheduling"""
     # Modern Header
@@ -1092,10 +1243,27 @@ def render_send_mail():
         st.error("⚠️ Lütfen önce Gmail'e bağlanın (sol menüden)")
         return
     
-    investors = get_all_investors()
+    # Campaigns interrupted by a rerun, a closed tab or a restart
+    for campaign in get_unfinished_campaigns():
+        progress = campaign['progress']
+        remaining = progress['queued'] + progress['sending']
+        st.info(
+            f"⏸️ Yarım kalan kampanya: **{campaign['subject']}** ({campaign['created_at']}) - "
+            f"{progress['sent']}/{progress['total']} gönderildi, {remaining} mail kuyrukta"
+        )
+        col1, col2, _ = st.columns([1, 1, 4])
+        with col1:
+            resume = st.button("▶️ Devam Et", key=f"resume_campaign_{campaign['id']}")
+        with col2:
+            if st.button("🗑️ İptal Et", key=f"cancel_campaign_{campaign['id']}"):
+                cancel_campaign(campaign['id'])
+                st.rerun()
+        if resume:
+            drain_campaign(campaign['id'])
+    
     templates = get_all_templates()
     
-    if not investors:
+    if not count_investors():
         st.warning("Henüz yatırımcı eklenmedi. Önce Yatırımcılar sayfasından ekleyin.")
         return
     
@@ -1119,44 +1287,7 @@ def render_send_mail():
     # Investor selection
     st.markdown("### 2️⃣ Yatırımcı Seç")
     
-    # Filter controls... (Simplified for brevity, assuming standard filters are OK)
-    col1, col2 = st.columns([1, 3])
-    with col1:
-        categories = ['Tümü'] + get_categories()
-        filter_category = st.selectbox("Kategori", categories, key="send_category")
-    with col2:
-        search = st.text_input("🔍 Ara", key="send_search")
-    
-    # Filter logic
-    filtered = investors
-    if filter_category != 'Tümü':
-        filtered = [i for i in filtered if i['category'] == filter_category]
-    if search:
-        search_lower = search.lower()
-        filtered = [i for i in filtered if search_lower in i['name'].lower() or search_lower in (i['company'] or '').lower()]
-    
-    # Select buttons
-    col1, col2, col3 = st.columns([1, 1, 4])
-    with col1:
-        if st.button("☑️ Tümünü Seç"):
-            st.session_state.selected_investors = [i['id'] for i in filtered]
-            st.rerun()
-    with col2:
-        if st.button("⬜ Tümünü Kaldır"):
-            st.session_state.selected_investors = []
-            st.rerun()
-            
-    # Checkboxes grid
-    cols = st.columns(3)
-    for idx, inv in enumerate(filtered):
-        with cols[idx % 3]:
-            checked = inv['id'] in st.session_state.selected_investors
-            if st.checkbox(f"{inv['name']} ({inv['company'] or '-'})", value=checked, key=f"inv_{inv['id']}"):
-                if inv['id'] not in st.session_state.selected_investors:
-                    st.session_state.selected_investors.append(inv['id'])
-            else:
-                if inv['id'] in st.session_state.selected_investors:
-                    st.session_state.selected_investors.remove(inv['id'])
+    render_recipient_picker()
 
     st.markdown("---")
     
@@ -1192,6 +1323,23 @@ def render_send_mail():
             return
             
         st.success(f"📅 Planlanacak zaman: {scheduled_datetime.strftime('%d.%m.%Y %H:%M')}")
+        lag = st.session_state.scheduler.lag_stats()
+        if lag['count']:
+            st.caption(f"⏱️ Zamanlayıcı gecikmesi (son {lag['count']} mail): "
+                       f"p50 {lag['p50']:.2f} sn, p99 {lag['p99']:.2f} sn")
+    else:
+        # Plan against the shared rate limit and the rolling 24h quota before sending
+        send_plan = get_rate_limiter().plan(selected_count)
+        quota = get_rate_limiter().status()
+        st.caption(
+            f"⏱️ Tahmini süre: ~{int(send_plan['duration_seconds'] // 60) + 1} dk · "
+            f"Kalan günlük kota: {quota['remaining']}/{quota['daily_limit']}"
+        )
+        if send_plan['deferred']:
+            st.warning(
+                f"⚠️ {send_plan['deferred']} mail günlük kotaya sığmıyor. "
+                f"Seçimi azaltın veya zamanlı gönderim kullanın."
+            )
     
     st.divider()
     
@@ -1208,8 +1356,7 @@ def render_send_mail():
                     'email': st.session_state.gmail_email,
                     'category': 'TEST'
                 }
-                body = render_template(selected_template['body'], test_context)
-                subject = render_template(selected_template['subject'], test_context)
+                _, subject, body = next(render_batch(selected_template['body'], selected_template['subject'], [test_context]))
                 success, message = send_email_helper(st.session_state.gmail_email, subject, body)
                 if success: st.success(f"✅ Gönderildi: {st.session_state.gmail_email}")
                 else: st.error(message)
@@ -1222,60 +1369,88 @@ def render_send_mail():
                 st.error("Yatırımcı seçin!")
                 return
                 
-            selected_investors_data = [get_investor_by_id(inv_id) for inv_id in st.session_state.selected_investors]
+            if not is_scheduled and send_plan['deferred']:
+                st.error(f"⛔ Günlük kota yetersiz: en fazla {send_plan['sendable']} mail gönderilebilir.")
+                return
+            
+            # One query per chunk of ids, streamed into rendering
+            selected_investors_data = get_investors_by_ids(sorted(st.session_state.selected_investors))
             
             if is_scheduled:
-                # Scheduling logic
-                count = 0
-                for inv in selected_investors_data:
-                    # Parse template context
-                    context = {
-                        'name': inv['name'], 'company': inv['company'] or '',
-                        'email': inv['email'], 'category': inv['category']
-                    }
-                    body = render_template(selected_template['body'], context)
-                    subject = render_template(selected_template['subject'], context)
-                    
-                    schedule_mail(inv['id'], selected_template['id'], subject, body, scheduled_datetime)
-                    count += 1
+                # Scheduling logic: the template is stored once and rendered per mail when it is sent
+                try:
+                    count = schedule_campaign(selected_investors_data, selected_template['subject'],
+                                              selected_template['body'], scheduled_datetime, selected_template['id'])
+                except Exception as e:
+                    st.error(f"❌ Şablon hatası: {e}")
+                    return
                 
                 st.success(f"✅ {count} mail başarıyla planlandı! ({scheduled_datetime})")
-                st.session_state.selected_investors = []
+                st.session_state.selected_investors = set()
                 st.rerun()
                 
             else:
-                # Direct send logic (classic)
-                progress_bar = st.progress(0)
-                status_text = st.empty()
-                success_count = 0
-                fail_count = 0
-                
-                for idx, inv in enumerate(selected_investors_data):
-                    context = {
-                        'name': inv['name'], 'company': inv['company'] or '',
-                        'email': inv['email'], 'category': inv['category']
-                    }
-                    body = render_template(selected_template['body'], context)
-                    subject = render_template(selected_template['subject'], context)
-                    
-                    success, message = send_email_helper(inv['email'], subject, body, uploaded_files)
-                    
-                    # Update status in DB as well
-                    new_status = 'CONTACTED' if success else inv.get('status', 'NEW')
-                    # note: we don't have update_status func but update_investor handles it. 
-                    # Simpler to log to sent_mails table which we do.
-                    
-                    log_sent_mail(inv['id'], selected_template['id'], subject, 'sent' if success else 'failed', message if not success else None)
-                    
-                    if success: success_count += 1
-                    else: fail_count += 1
-                    
-                    progress_bar.progress((idx + 1) / selected_count)
-                
-                progress_bar.empty()
-                if fail_count == 0: st.success(f"🎉 Hepsi gönderildi! ({success_count})")
-                else: st.warning(f"{success_count} başarılı, {fail_count} başarısız")
-                st.session_state.selected_investors = []
+                # Queue the campaign in the outbox first, so it survives reruns and restarts
+                campaign_id = enqueue_campaign(
+                    selected_investors_data, selected_template['subject'], selected_template['body'],
+                    selected_template['id'], uploaded_files
+                )
+                st.session_state.selected_investors = set()
+                drain_campaign(campaign_id)
+
+
+def drain_campaign(campaign_id):
+    """Send a campaign's queued outbox messages with a progress bar (sent_mails is logged by the outbox)"""
+    progress = get_campaign_progress(campaign_id)
+    total = progress['total']
+    done = total - progress['queued'] - progress['sending']
+    
+    progress_bar = st.progress(done / total if total else 1.0)
+    status_text = st.empty()
+    
+    # Many messages in flight at once; results arrive as each one completes
+    quota_hit = False
+    results = None
+    try:
+        results = run_outbox(make_send_transport(), campaign_id)
+        for result in results:
+            if result['state'] == 'queued':
+                quota_hit = True
+            else:
+                done += 1
+            progress_bar.progress(min(done / total, 1.0))
+            throttle_factor = get_throttle().factor
+            slowed = f" · ⏳ Gmail yavaşlattı, hız %{throttle_factor * 100:.0f}" if throttle_factor < 1 else ""
+            status_text.text(f"📤 {done}/{total} - {result['recipient']['to_email']}{slowed}")
+    except Exception as e:
+        st.error(f"❌ Gönderim başlatılamadı: {str(e)}")
+    finally:
+        # A rerun leaves the loop early: stop sending instead of going on in the background
+        if results is not None:
+            results.close()
+    
+    status_text.empty()
+    progress_bar.empty()
+    progress = get_campaign_progress(campaign_id)
+    remaining = progress['queued'] + progress['sending']
+    if remaining:
+        if quota_hit:
+            reason = "günlük kota doldu"
+        elif progress['sending']:
+            reason = (f"{progress['sending']} mail başka bir gönderimde; o durursa en geç "
+                      f"{OUTBOX_LEASE_SECONDS} sn içinde serbest kalır")
+        else:
+            reason = "gönderim yarıda kesildi"
+        st.warning(
+            f"⏸️ {progress['sent']} gönderildi, {remaining} mail kuyrukta kaldı ({reason}). "
+            "Kampanya daha sonra kaldığı yerden devam edebilir."
+        )
+    elif progress['failed'] == 0 and progress['skipped'] == 0:
+        st.success(f"🎉 Hepsi gönderildi! ({progress['sent']})")
+    else:
+        st.warning(
+            f"{progress['sent']} başarılı, {progress['failed']} başarısız, {progress['skipped']} atlandı"
+        )
 
 
 # ============ TOOLS PAGE (ADVANCED FEATURES) ============
@@ -0,0 +1,551 @@
+"""
+Investor Mail System - Async Sending Engine
+Keeps many messages in flight over async SMTP sessions or concurrent Gmail API calls
+
+Developed by: emirgunyy & gktrk363
+"""
+import ssl
+import base64
+import queue
+import asyncio
+import smtplib
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import (
+    SMTP_SERVER, SMTP_PORT, SMTP_POOL_SIZE, SEND_CONCURRENCY, MAX_SEND_ATTEMPTS, GMAIL_BATCH_SIZE,
+    GMAIL_BATCH_CONCURRENCY
+)
+from rate_limiter import (
+    DailyQuotaExceeded, get_rate_limiter, get_throttle, SendResult, smtp_failure, QUOTA, DISCONNECTED, PERMANENT
+)
+from mime_message import message_chunks, smtp_data_chunks, prepare_attachments, close_attachments
+
+CRLF = b'\r\n'
+_WRITE_SLICE = 256 * 1024
+
+
+# ============ ASYNC SMTP ============
+
+class AsyncSMTPSession:
+    """
+    One SMTP session on asyncio streams (EHLO, STARTTLS, AUTH PLAIN, MAIL/RCPT/DATA)
+
+    Errors are raised as the matching smtplib exceptions, so callers handle them
+    exactly like MailSender does.
+    """
+
+    def __init__(self, email, app_password, server=SMTP_SERVER, port=SMTP_PORT, starttls=True, timeout=30,
+                 tls_context=None):
+        self.email = email
+        self.app_password = app_password
+        self.server = server
+        self.port = port
+        self.starttls = starttls
+        self.timeout = timeout
+        self.tls_context = tls_context  # None: ssl.create_default_context()
+        self.reader = None
+        self.writer = None
+        self._plain_writer = None
+        self.extensions = set()
+
+    @property
+    def is_connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def _reply(self):
+        """Read a (possibly multi-line) reply, returning (code, text)"""
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            if not line:
+                self.close()
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                return int(line[:3]), b'\n'.join(lines)
+
+    async def command(self, line, expected=(250,)):
+        """Send one command and check the reply code"""
+        self.writer.write(line.encode('ascii') + CRLF)
+        await self.writer.drain()
+        code, text = await self._reply()
+        if code not in expected:
+            raise smtplib.SMTPResponseException(code, text)
+        return code, text
+
+    async def _ehlo(self):
+        _, text = await self.command('EHLO localhost')
+        self.extensions = {line.split(b' ')[0].decode('ascii').lower() for line in text.split(b'\n')[1:]}
+
+    async def connect(self):
+        """Open, secure and authenticate the session"""
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.server, self.port), self.timeout
+        )
+        code, text = await self._reply()
+        if code != 220:
+            raise smtplib.SMTPConnectError(code, text)
+        await self._ehlo()
+
+        if self.starttls:
+            await self.command('STARTTLS', expected=(220,))
+            await self._start_tls()
+            await self._ehlo()
+
+        if self.app_password:
+            token = base64.b64encode(f"\0{self.email}\0{self.app_password}".encode('utf-8')).decode('ascii')
+            try:
+                await self.command(f'AUTH PLAIN {token}', expected=(235,))
+            except smtplib.SMTPResponseException as e:
+                raise smtplib.SMTPAuthenticationError(e.smtp_code, e.smtp_error)
+
+    async def _start_tls(self):
+        """
+        Upgrade the connection to TLS with loop.start_tls (StreamWriter.start_tls needs Python 3.11)
+
+        The TLS transport gets a new stream protocol, so reader and writer are rebuilt on it.
+        The plain writer is kept: on Python 3.11+ collecting it would close the socket.
+        """
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(reader)
+        transport = await asyncio.wait_for(loop.start_tls(
+            self.writer.transport, protocol, self.tls_context or ssl.create_default_context(),
+            server_hostname=self.server
+        ), self.timeout)
+        protocol.connection_made(transport)
+        self._plain_writer = self.writer
+        self.reader = reader
+        self.writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+
+    async def noop(self):
+        """Health check"""
+        await self.command('NOOP')
+
+    async def sendmail(self, from_email, to_email, chunks):
+        """Send one serialized message (mime_message.message_chunks, CRLF line endings)"""
+        try:
+            await self.command(f'MAIL FROM:<{from_email}>')
+        except smtplib.SMTPResponseException as e:
+            await self._reset()
+            raise smtplib.SMTPSenderRefused(e.smtp_code, e.smtp_error, from_email)
+        try:
+            await self.command(f'RCPT TO:<{to_email}>', expected=(250, 251))
+        except smtplib.SMTPResponseException as e:
+            await self._reset()
+            raise smtplib.SMTPRecipientsRefused({to_email: (e.smtp_code, e.smtp_error)})
+
+        await self.command('DATA', expected=(354,))
+        for chunk in smtp_data_chunks(chunks):
+            # Slices with a drain in between: at most one slice of a spooled part is copied to the heap
+            for start in range(0, len(chunk), _WRITE_SLICE):
+                self.writer.write(chunk[start:start + _WRITE_SLICE])
+                await self.writer.drain()
+        self.writer.write(b'.' + CRLF)
+        await self.writer.drain()
+        code, text = await self._reply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, text)
+
+    async def _reset(self):
+        try:
+            await self.command('RSET')
+        except (smtplib.SMTPException, OSError):
+            pass
+
+    async def quit(self):
+        if self.is_connected:
+            try:
+                await self.command('QUIT', expected=(221,))
+            except (smtplib.SMTPException, OSError, asyncio.TimeoutError):
+                pass
+        self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.writer = None
+        self._plain_writer = None
+
+
+class AsyncSMTPTransport:
+    """Pool of AsyncSMTPSessions; a session that dropped is reconnected on next use"""
+
+    def __init__(self, email, app_password, size=SMTP_POOL_SIZE, server=SMTP_SERVER, port=SMTP_PORT, starttls=True,
+                 tls_context=None):
+        self.email = email
+        self.sessions = [
+            AsyncSMTPSession(email, app_password, server, port, starttls, tls_context=tls_context)
+            for _ in range(size)
+        ]
+        self._idle = None
+        self.reconnects = 0
+
+    @property
+    def concurrency(self):
+        return len(self.sessions)
+
+    async def start(self):
+        """Connect every session"""
+        self._idle = asyncio.Queue()
+        await asyncio.gather(*(session.connect() for session in self.sessions))
+        for session in self.sessions:
+            self._idle.put_nowait(session)
+
+    async def send(self, to_email, subject, body_html, attachments, message_id=None):
+        """Send one message, returning a SendResult like MailSender.send_email (attachments prepared by the engine)"""
+        message = message_chunks(self.email, to_email, subject, body_html, attachments, message_id)
+        session = await self._idle.get()
+        try:
+            for attempt in range(2):
+                try:
+                    if not session.is_connected:
+                        await session.connect()
+                        self.reconnects += 1
+                    await session.sendmail(self.email, to_email, message)
+                    return SendResult(True, "✅ Gönderildi")
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    session.close()
+                    if attempt:
+                        return SendResult(False, "❌ SMTP bağlantısı koptu", DISCONNECTED)
+        except Exception as e:
+            # Not the builtin TimeoutError before Python 3.11
+            if isinstance(e, (asyncio.TimeoutError, TimeoutError)):
+                session.close()  # A late reply would be read as the next command's
+            return smtp_failure(e)
+        finally:
+            self._idle.put_nowait(session)
+
+    async def stop(self):
+        await asyncio.gather(*(session.quit() for session in self.sessions))
+
+
+# ============ GMAIL API ============
+
+class AsyncGmailTransport:
+    """Concurrent GmailOAuth.send_email calls on a thread pool"""
+
+    def __init__(self, oauth, max_workers=SEND_CONCURRENCY):
+        self.oauth = oauth
+        self.max_workers = max_workers
+        self._executor = None
+
+    @property
+    def concurrency(self):
+        return self.max_workers
+
+    async def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='gmail-send')
+
+    async def send(self, to_email, subject, body_html, attachments, message_id=None):
+        loop = asyncio.get_running_loop()
+        # The engine already took the rate limit slot and reports the outcome to the throttle
+        return await loop.run_in_executor(
+            self._executor, functools.partial(
+                self.oauth.send_email, to_email, subject, body_html, attachments, throttle=False,
+                message_id=message_id
+            )
+        )
+
+    async def stop(self):
+        self._executor.shutdown(wait=True)
+
+
+class AsyncGmailBatchTransport(AsyncGmailTransport):
+    """
+    GmailOAuth.send_batch calls on a thread pool, batch_size messages per HTTP round trip
+
+    AsyncSendEngine sees send_batch and hands over whole batches instead of single messages.
+    """
+
+    def __init__(self, oauth, batch_size=GMAIL_BATCH_SIZE, max_workers=GMAIL_BATCH_CONCURRENCY):
+        super().__init__(oauth, max_workers)
+        self.batch_size = batch_size
+
+    async def send_batch(self, items, attachments):
+        """items: list of (to_email, subject, body_html, message_id); returns SendResults in order"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(self.oauth.send_batch, items, attachments, self.batch_size)
+        )
+
+
+# ============ ENGINE ============
+
+class AsyncSendEngine:
+    """
+    Sends many messages concurrently over a transport (AsyncSMTPTransport or AsyncGmailTransport)
+
+    A semaphore caps messages in flight across every campaign of the engine, and
+    each send waits for the adaptive throttle and a slot of the shared rate
+    limiter. Transient failures are sent again, up to MAX_SEND_ATTEMPTS tries.
+    On a transport with send_batch (AsyncGmailBatchTransport) the semaphore counts
+    batches: each batch waits for all of its slots, then goes out in one request,
+    and failed items are retried in a later batch.
+    Results come back as an async iterator of dicts in completion order:
+    {'key', 'recipient', 'subject', 'success', 'message', 'error_kind', 'attempts'}.
+    """
+
+    def __init__(self, transport, concurrency=None, rate_limiter=None, throttle=None):
+        self.transport = transport
+        self.concurrency = concurrency or transport.concurrency
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+        self.throttle = throttle or get_throttle()
+        self.batch_size = getattr(transport, 'batch_size', 1) if hasattr(transport, 'send_batch') else 1
+        self._semaphore = None
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        await self.transport.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.transport.stop()
+
+    async def _reserve(self, count):
+        """
+        Wait for the throttle and `count` rate limiter slots
+
+        Returns (slots granted, DailyQuotaExceeded or None); fewer slots are granted
+        when the daily quota runs out part way.
+        """
+        delay = max(self.throttle.reserve() for _ in range(count))
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # SendQuotaLimiter.reserve is a SQLite write that may wait on busy_timeout: keep it off the loop
+        loop = asyncio.get_running_loop()
+        delay, granted, quota_error = await loop.run_in_executor(None, self._reserve_slots, count)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return granted, quota_error
+
+    def _reserve_slots(self, count):
+        """Take `count` rate limiter slots (blocking), returning (delay, granted, DailyQuotaExceeded or None)"""
+        delay, granted = 0, 0
+        try:
+            for _ in range(count):
+                delay = max(delay, self.rate_limiter.reserve())
+                granted += 1
+        except DailyQuotaExceeded as e:
+            return delay, granted, e
+        return delay, granted, None
+
+    async def _refund(self, count):
+        """Give back the quota slots of `count` sends that did not go out"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.rate_limiter.refund, count)
+
+    async def _transport_send(self, jobs):
+        """SendResults for jobs, one request per job or one batch for all of them"""
+        try:
+            if self.batch_size > 1:
+                items = [(to_email, subject, body_html, message_id)
+                         for _, _, to_email, subject, body_html, message_id, _, _ in jobs]
+                results = await self.transport.send_batch(items, jobs[0][6])
+            else:
+                _, _, to_email, subject, body_html, message_id, attachments, _ = jobs[0]
+                if message_id:
+                    results = [await self.transport.send(to_email, subject, body_html, attachments, message_id)]
+                else:
+                    results = [await self.transport.send(to_email, subject, body_html, attachments)]
+            return [result if isinstance(result, SendResult) else SendResult(*result) for result in results]
+        except Exception as e:
+            return [SendResult(False, f"❌ Hata: {str(e)}")] * len(jobs)
+
+    async def _send_jobs(self, jobs):
+        """Send one job (or one batch of jobs), returning [(result, job to requeue or None), ...]"""
+        async with self._semaphore:
+            granted, quota_error = await self._reserve(len(jobs))
+            results = await self._transport_send(jobs[:granted]) if granted else []
+            for result in results:
+                self.throttle.record(result.error_kind, result.retry_after)
+            failed = sum(not result.success for result in results)
+            if failed:
+                # Failed and retried sends do not count against the daily quota
+                await self._refund(failed)
+            results += [SendResult(False, f"⛔ {str(quota_error)}", QUOTA)] * (len(jobs) - granted)
+        return [self._outcome(job, result) for job, result in zip(jobs, results)]
+
+    @staticmethod
+    def _outcome(job, result):
+        key, recipient, _, subject, _, _, _, attempts = job
+        if result.transient and attempts < MAX_SEND_ATTEMPTS:
+            return None, job[:-1] + (attempts + 1,)
+        return {'key': key, 'recipient': recipient, 'subject': subject, 'success': result.success,
+                'message': result.message, 'error_kind': result.error_kind, 'attempts': attempts}, None
+
+    def _schedule(self, jobs, pending):
+        """Start sending jobs, batch_size per task"""
+        for start in range(0, len(jobs), self.batch_size):
+            pending.add(asyncio.create_task(self._send_jobs(jobs[start:start + self.batch_size])))
+
+    def _finished(self, done, pending):
+        """Results of completed sends; requeued jobs go back into pending"""
+        retries = []
+        for task in done:
+            for result, retry in task.result():
+                if retry is not None:
+                    retries.append(retry)
+                else:
+                    yield result
+        self._schedule(retries, pending)
+
+    async def send_messages(self, messages, attachments=None):
+        """
+        Send already rendered messages
+
+        messages: iterable of (key, recipient, to_email, subject, body_html), optionally
+                  with a Message-ID as sixth item; key is passed back in the result
+                  (e.g. a scheduled_mails id)
+        attachments: PreparedAttachments passed in stay open, the caller owns them
+        """
+        prepared = prepare_attachments(attachments)
+        pending = set()
+        batch = []
+        try:
+            for key, recipient, to_email, subject, body_html, *message_id in messages:
+                batch.append((key, recipient, to_email, subject, body_html,
+                              message_id[0] if message_id else None, prepared, 1))
+                if len(batch) < self.batch_size:
+                    continue
+                if len(pending) >= self.concurrency * 2:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for result in self._finished(done, pending):
+                        yield result
+                self._schedule(batch, pending)
+                batch = []
+            self._schedule(batch, pending)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for result in self._finished(done, pending):
+                    yield result
+        finally:
+            for task in pending:
+                task.cancel()
+            close_attachments([a for a in prepared if a not in (attachments or [])])
+
+    async def send_campaign(self, recipients, subject_template, body_template, attachments=None, footer=None):
+        """
+        Personalize and send a template to recipients (dicts with 'email', 'name', ...)
+
+        Unsubscribed recipients and template errors are reported without sending.
+        """
+        from database import is_unsubscribed
+        from template_engine import render_batch
+
+        skipped = []
+
+        def messages():
+            rendered = render_batch(body_template, subject_template, recipients,
+                                    return_errors=True, footer=footer, as_bytes=True)
+            for idx, (recipient, subject, body) in enumerate(rendered):
+                email = recipient.get('email', '')
+                if is_unsubscribed(email):
+                    skipped.append({'key': idx, 'recipient': recipient, 'subject': subject, 'success': False,
+                                    'message': "⚠️ Kullanıcı abonelikten çıkmış (Unsubscribed)",
+                                    'error_kind': PERMANENT, 'attempts': 0})
+                elif subject is None:
+                    skipped.append({'key': idx, 'recipient': recipient, 'subject': None, 'success': False,
+                                    'message': f"❌ Şablon hatası: {str(body)}",
+                                    'error_kind': PERMANENT, 'attempts': 0})
+                else:
+                    yield idx, recipient, email, subject, body
+
+        async for result in self.send_messages(messages(), attachments):
+            while skipped:
+                yield skipped.pop(0)
+            yield result
+        while skipped:
+            yield skipped.pop(0)
+
+
+async def stream_campaign(transport, recipients, subject_template, body_template, attachments=None,
+                          footer=None, concurrency=None, rate_limiter=None, throttle=None):
+    """Start an engine on transport, send one campaign and yield its results"""
+    async with AsyncSendEngine(transport, concurrency, rate_limiter, throttle) as engine:
+        async for result in engine.send_campaign(recipients, subject_template, body_template, attachments, footer):
+            yield result
+
+
+async def stream_messages(transport, messages, attachments=None, concurrency=None, rate_limiter=None,
+                          throttle=None):
+    """Start an engine on transport, send rendered messages and yield their results"""
+    async with AsyncSendEngine(transport, concurrency, rate_limiter, throttle) as engine:
+        async for result in engine.send_messages(messages, attachments):
+            yield result
+
+
+# ============ SYNC BRIDGE ============
+
+def iterate_in_background(make_async_iterator):
+    """
+    Consume an async iterator from synchronous code (Streamlit, scheduler)
+
+    make_async_iterator: function returning the async iterator (e.g. an async
+    generator function), called inside a private event loop on a background
+    thread. Results are yielded here as they complete, so the caller can update
+    progress while messages are in flight. Closing this generator before the end
+    (or dropping it, as a Streamlit rerun does) cancels the producer, so an
+    abandoned iterator does not keep sending.
+    """
+    results = queue.Queue()
+    done = object()
+    stopped = threading.Event()
+    producer = {}  # 'loop' and 'task' once the event loop runs
+
+    def run():
+        async def drain():
+            producer['loop'], producer['task'] = asyncio.get_running_loop(), asyncio.current_task()
+            if stopped.is_set():
+                return
+            async for item in make_async_iterator():
+                results.put(item)
+
+        try:
+            asyncio.run(drain())
+        except BaseException as e:
+            results.put(e)
+        finally:
+            results.put(done)
+
+    def stop():
+        stopped.set()
+        if 'task' in producer:
+            try:
+                producer['loop'].call_soon_threadsafe(producer['task'].cancel)
+            except RuntimeError:
+                pass  # The loop already finished
+
+    thread = threading.Thread(target=run, daemon=True, name='async-send')
+    thread.start()
+    try:
+        while True:
+            item = results.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                thread.join()
+                raise item
+            yield item
+    except GeneratorExit:
+        # Not joined: the producer's cleanup (leases, transport) finishes on its own thread
+        stop()
+        raise
+    thread.join()
+
+
+def run_campaign(transport, recipients, subject_template, body_template, attachments=None, footer=None,
+                 concurrency=None, rate_limiter=None, throttle=None):
+    """Synchronous iterator over stream_campaign results"""
+    return iterate_in_background(lambda: stream_campaign(
+        transport, recipients, subject_template, body_template, attachments, footer, concurrency, rate_limiter,
+        throttle
+    ))
+
+
+def run_messages(transport, messages, attachments=None, concurrency=None, rate_limiter=None, throttle=None):
+    """Synchronous iterator over stream_messages results"""
+    return iterate_in_background(lambda: stream_messages(
+        transport, messages, attachments, concurrency, rate_limiter, throttle
+    ))
@@ -10,16 +10,90 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "data")
 TEMPLATES_DIR = os.path.join(BASE_DIR, "templates")
 UPLOADS_DIR = os.path.join(BASE_DIR, "uploads")
-DATABASE_PATH = os.path.join(DATA_DIR, "investors.db")
+DATABASE_PATH = os.environ.get("INVESTOR_MAIL_DB", os.path.join(DATA_DIR, "investors.db"))
 
 # Gmail SMTP Settings
 SMTP_SERVER = "smtp.gmail.com"
 SMTP_PORT = 587
+SMTP_POOL_SIZE = 4  # Parallel SMTP sessions used by MailSenderPool
+SMTP_HEALTH_CHECK_SECONDS = 30  # NOOP a pooled session idle longer than this before reusing it
+SEND_CONCURRENCY = 8  # Messages in flight in the async sending engine (Gmail API calls)
+GMAIL_BATCH_SIZE = 10  # Gmail API sends per batch request (one HTTP round trip, Google allows up to 100)
+GMAIL_BATCH_MAX_BYTES = 4 * 1024 * 1024  # Larger encoded messages are sent in a request of their own
+GMAIL_BATCH_CONCURRENCY = 2  # Gmail API batch requests in flight
+TOKEN_REFRESH_MARGIN = 600  # Refresh OAuth tokens this many seconds before they expire
+TOKEN_REFRESH_INTERVAL = 60  # Seconds between checks of the background token refresher
+GMAIL_HTTP_TIMEOUT = 60  # Seconds per Gmail API HTTP request
+
+# Database Connections
+DB_POOL_SIZE = 8  # Max pooled connections shared by short-lived (Streamlit script) threads
+DB_POOL_TIMEOUT = 30  # Seconds to wait for a free pooled connection
+
+# Database Storage Profiles (pragmas applied by database.init_db and every new connection)
+DB_STORAGE_PROFILES = {
+    # WAL: UI reads run against a snapshot and never wait for the scheduler's writes
+    "wal": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",  # Durable at checkpoints, safe against corruption in WAL mode
+        "cache_size_kb": 16384,  # Page cache per connection
+        "mmap_size": 64 * 1024 * 1024,  # Memory-mapped reads
+        "busy_timeout_ms": 5000,  # Wait for a competing writer instead of failing
+        "wal_autocheckpoint": 1000,  # Pages before SQLite checkpoints on commit
+        "checkpoint_interval_seconds": 300,  # Periodic passive checkpoint from the app
+    },
+    # Classic rollback journal, e.g. for databases on network drives where WAL is unsupported
+    "rollback": {
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+        "cache_size_kb": 2048,
+        "mmap_size": 0,
+        "busy_timeout_ms": 5000,
+        "wal_autocheckpoint": 0,
+        "checkpoint_interval_seconds": 0,
+    },
+}
+DB_STORAGE_PROFILE = os.environ.get("INVESTOR_MAIL_DB_PROFILE", "wal")
+DATA_CACHE_TTL_SECONDS = 60  # Cached reads are reloaded after this long even without a local write (other processes)
+DATA_CACHE_SIZE = 256  # Cached read results kept in memory (LRU)
+
+# Investor Import
+IMPORT_CHUNK_SIZE = 5000  # Rows per streamed chunk / committed transaction
+
+# Template Rendering
+TEMPLATE_CACHE_SIZE = 128  # Compiled templates kept in memory (LRU)
+TEMPLATE_BYTECODE_CACHE_DIR = os.path.join(DATA_DIR, "template_cache")  # None disables the disk cache
+TEMPLATE_FAST_PATH = True  # Render plain {{var}} templates without jinja2
+RENDER_CHUNK_SIZE = 500  # Recipients per task when render_batch uses a process pool
+
+# Outbox (durable campaign queue)
+OUTBOX_BATCH_SIZE = 50  # Messages leased per claim
+OUTBOX_LEASE_SECONDS = 60  # Renewed every third of it while the sender runs; a crashed sender's messages free up after it
+
+# Scheduler
+SCHEDULER_RESYNC_SECONDS = 300  # Reload upcoming send times from the database (mails scheduled by other processes)
+SCHEDULER_RETRY_SECONDS = 60  # Wait before retrying a scheduled mail deferred by a transient error or the quota
+SCHEDULER_LAG_SAMPLES = 1000  # Dispatch lag samples kept for the p50/p99 figures
+SCHEDULER_WORKERS = 2  # Threads per process sending claimed scheduled mails
+SCHEDULER_CLAIM_BATCH = 50  # Scheduled mails leased per claim
+SCHEDULER_LEASE_SECONDS = 600  # A claimed mail goes back to pending if its lease is not renewed by then
+
+# Attachments
+ATTACHMENT_SPOOL_THRESHOLD = 1024 * 1024  # Encoded attachments above this size are kept in a temp file
 
 # Rate Limiting
 RATE_LIMIT_SECONDS = 1.5  # Wait between emails
+RATE_LIMIT_BURST = 5  # Emails that may go out back to back before the wait applies
 DAILY_LIMIT = 500  # Gmail free limit
 
+# Adaptive Throttling (reacts to 421/450/454 SMTP replies and Gmail API 429/rateLimitExceeded)
+THROTTLE_MIN_FACTOR = 0.05  # Slowest pace, as a fraction of the normal send rate
+THROTTLE_DECREASE = 0.5  # Rate factor multiplier on every transient error
+THROTTLE_INCREASE = 0.05  # Rate factor regained with every successful send
+BACKOFF_BASE_SECONDS = 2  # First pause after a transient error, doubled for each one in a row
+BACKOFF_MAX_SECONDS = 300  # Longest pause (also used when the provider quota is hit)
+MAX_SEND_ATTEMPTS = 4  # Tries per message before a transient error counts as failed
+THROTTLE_METRICS_WINDOW = 3600  # Seconds of send history kept for the rate chart
+
 # App Settings
 APP_TITLE = "🎮 Yatırımcı Mail Sistemi"
 PAGE_ICON = "📧"
@@ -0,0 +1,123 @@
+"""
+Investor Mail System - Cached Data Access
+Read functions of database.py served from memory across Streamlit reruns,
+reloaded only when a table they read has been written since
+
+Developed by: emirgunyy & gktrk363
+"""
+import time
+import threading
+from collections import OrderedDict
+import database
+from config import DATA_CACHE_TTL_SECONDS, DATA_CACHE_SIZE
+
+
+class TableCache:
+    """
+    Process-wide cache of query results keyed on the generations of the tables they read
+
+    Every write through database.py moves its tables' generation on after it commits,
+    so a cached result is reused exactly until one of its tables changes. Writes made
+    by other processes (e.g. `python scheduler.py`) are not seen that way, so entries
+    are also reloaded after ttl seconds. Results are shared between reruns and
+    sessions: treat them as read-only. Entries of a table that changed are dropped
+    when the next result of that table is loaded, and at most max_size entries are
+    kept (least recently used go first), so per-argument results such as
+    get_template_by_id cannot pile up.
+    """
+
+    def __init__(self, ttl=DATA_CACHE_TTL_SECONDS, max_size=DATA_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # (name, args) -> ({table or None: generation}, loaded at, result)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, name, tables, loader, *args):
+        """Result of loader(*args), from memory while tables are unchanged"""
+        key = (name, args)
+        # Read before loading: a write committing meanwhile makes this entry stale, never the reverse
+        generations = dict(zip((None,) + tuple(tables), database.get_table_generations(*tables)))  # None: the file
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == generations and now - entry[1] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        result = loader(*args)
+        with self._lock:
+            self._drop_stale(generations)
+            self._entries[key] = (generations, now, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return result
+
+    def _drop_stale(self, generations):
+        """Drop entries loaded before the current generations of these tables; caller holds the lock"""
+        stale = [
+            key for key, (loaded, _, _) in self._entries.items()
+            if any(table in generations and generation != generations[table] for table, generation in loaded.items())
+        ]
+        for key in stale:
+            del self._entries[key]
+
+    def stats(self):
+        """Hit/miss/eviction counters for monitoring"""
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def clear(self):
+        """Drop all cached results (counters are kept)"""
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = TableCache()
+
+
+def get_data_cache():
+    """Get the shared cache"""
+    return _cache
+
+
+def get_all_investors():
+    """Get all active investors (cached)"""
+    return _cache.get('get_all_investors', ('investors',), database.get_all_investors)
+
+
+def get_categories():
+    """Get all unique categories (cached)"""
+    return _cache.get('get_categories', ('investors',), database.get_categories)
+
+
+def get_status_counts():
+    """Count the active investors per CRM status (cached)"""
+    return _cache.get('get_status_counts', ('investors',), database.get_status_counts)
+
+
+def get_all_templates():
+    """Get all templates (cached)"""
+    return _cache.get('get_all_templates', ('templates',), database.get_all_templates)
+
+
+def get_template_by_id(template_id):
+    """Get a template by ID (cached)"""
+    return _cache.get('get_template_by_id', ('templates',), database.get_template_by_id, template_id)
+
+
+def get_stats():
+    """Get dashboard statistics (cached)"""
+    return _cache.get('get_stats', ('investors', 'sent_mails', 'templates'), database.get_stats)
+
+
+def get_sent_mails(limit=50):
+    """Get recent sent mails with investor info (cached)"""
+    return _cache.get('get_sent_mails', ('sent_mails', 'investors', 'templates'), database.get_sent_mails, limit)
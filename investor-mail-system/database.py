@@ -6,24 +6,308 @@ Developed by: emirgunyy & gktrk363
 """
 import sqlite3
 import os
+import re
+import json
+import queue
+import itertools
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
-from config import DATABASE_PATH, DATA_DIR
+from config import (
+    DATABASE_PATH, DATA_DIR, DB_POOL_SIZE, DB_POOL_TIMEOUT,
+    DB_STORAGE_PROFILES, DB_STORAGE_PROFILE
+)
 
 # Ensure data directory exists
 os.makedirs(DATA_DIR, exist_ok=True)
 
 
+# ============ CONNECTION MANAGEMENT ============
+
+def get_storage_profile(name=None):
+    """Get the pragma settings of a storage profile (defaults to DB_STORAGE_PROFILE)"""
+    name = name or DB_STORAGE_PROFILE
+    if name not in DB_STORAGE_PROFILES:
+        raise ValueError(f"Unknown storage profile: {name}")
+    return DB_STORAGE_PROFILES[name]
+
+
+def apply_connection_pragmas(conn, profile):
+    """Apply the per-connection pragmas of a storage profile"""
+    conn.execute(f"PRAGMA busy_timeout = {int(profile['busy_timeout_ms'])}")
+    conn.execute(f"PRAGMA synchronous = {profile['synchronous']}")
+    # Negative cache_size is in KiB rather than pages
+    conn.execute(f"PRAGMA cache_size = -{int(profile['cache_size_kb'])}")
+    conn.execute(f"PRAGMA mmap_size = {int(profile['mmap_size'])}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    if profile['journal_mode'].upper() == 'WAL':
+        conn.execute(f"PRAGMA wal_autocheckpoint = {int(profile['wal_autocheckpoint'])}")
+
+
+def _lower(value):
+    """py_lower() SQL function: Python's str.lower, which also folds non-ASCII letters (Ş, Ü...) unlike LOWER()"""
+    return value.lower() if isinstance(value, str) else value
+
+
+def register_functions(conn):
+    """Register the SQL functions used by the queries in this module"""
+    conn.create_function("py_lower", 1, _lower, deterministic=True)
+
+
+class ConnectionManager:
+    """
+    Thread-aware SQLite connection manager
+
+    Long-lived threads (the scheduler) pin their own connection for their whole
+    lifetime. Short-lived threads (every Streamlit script run) borrow one from a
+    bounded pool and hand it back when the outermost `connection()` block exits.
+
+    Writes mark the tables they change (mark_changed); each table has a generation
+    number that moves on once such a transaction commits, so cached reads know
+    when to reload (see data_cache).
+    """
+    _serials = itertools.count(1)
+
+    def __init__(self, path, pool_size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT, profile=None):
+        self.serial = next(self._serials)
+        self.path = path
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.profile = get_storage_profile(profile)
+        self._last_checkpoint = time.monotonic()
+        self._checkpoint_lock = threading.Lock()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._pinned = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._generations = {}  # table -> generation, bumped after each committed write
+
+    def _create(self):
+        """Open a new connection (may be used from any thread, one at a time)"""
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.profile['busy_timeout_ms'] / 1000,
+            check_same_thread=False
+        )
+        conn.row_factory = sqlite3.Row
+        apply_connection_pragmas(conn, self.profile)
+        register_functions(conn)
+        return conn
+
+    def _acquire(self):
+        """Get the pinned connection of this thread or borrow one from the pool"""
+        pinned = getattr(self._local, 'pinned', None)
+        if pinned is not None:
+            return pinned
+
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.pool_size
+            if can_create:
+                self._created += 1
+
+        if can_create:
+            try:
+                return self._create()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError(
+                f"No free database connection after {self.timeout}s (pool size {self.pool_size})"
+            )
+
+    def _release(self, conn):
+        """Return a borrowed connection to the pool"""
+        self._maybe_checkpoint(conn)
+        if conn is not getattr(self._local, 'pinned', None):
+            self._idle.put(conn)
+
+    def _maybe_checkpoint(self, conn):
+        """Run a passive WAL checkpoint once per checkpoint interval"""
+        interval = self.profile['checkpoint_interval_seconds']
+        if not interval or time.monotonic() - self._last_checkpoint < interval:
+            return
+        # Only one thread checkpoints, the others carry on immediately
+        if not self._checkpoint_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_checkpoint = time.monotonic()
+            checkpoint(conn)
+        except sqlite3.Error as e:
+            print(f"WAL checkpoint error: {e}")
+        finally:
+            self._checkpoint_lock.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Use a connection for one unit of work
+
+        Commits when the outermost block exits cleanly and rolls back on error.
+        Nested blocks in the same thread share the outer connection and transaction.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+
+        conn = self._acquire()
+        self._local.conn = conn
+        self._local.changed = set()
+        try:
+            yield conn
+            conn.commit()
+            # Only after the commit, so a reader never caches old rows under the new generation
+            self._bump(self._local.changed)
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            self._release(conn)
+
+    def mark_changed(self, *tables):
+        """Record that the current transaction writes to tables"""
+        if getattr(self._local, 'conn', None) is not None:
+            self._local.changed.update(tables)
+        else:
+            self._bump(tables)
+
+    def _bump(self, tables):
+        with self._lock:
+            for table in tables:
+                self._generations[table] = self._generations.get(table, 0) + 1
+
+    def generations(self, *tables):
+        """Current generation of each table"""
+        with self._lock:
+            return tuple(self._generations.get(table, 0) for table in tables)
+
+    def pin_thread(self):
+        """Give the calling (long-lived) thread its own dedicated connection"""
+        conn = getattr(self._local, 'pinned', None)
+        if conn is None:
+            conn = self._create()
+            self._local.pinned = conn
+            with self._lock:
+                self._pinned.append(conn)
+        return conn
+
+    def unpin_thread(self):
+        """Close the dedicated connection of the calling thread"""
+        conn = getattr(self._local, 'pinned', None)
+        if conn is not None:
+            self._local.pinned = None
+            with self._lock:
+                self._pinned.remove(conn)
+            conn.close()
+
+    def close_all(self):
+        """Close every idle pooled and pinned connection"""
+        with self._lock:
+            pinned, self._pinned = self._pinned, []
+        for conn in pinned:
+            conn.close()
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+_manager = ConnectionManager(DATABASE_PATH)
+
+
+def db_connection():
+    """Context manager yielding a managed connection (see ConnectionManager.connection)"""
+    return _manager.connection()
+
+
+def mark_changed(*tables):
+    """Mark tables written by the current transaction, so cached reads of them reload after it commits"""
+    _manager.mark_changed(*tables)
+
+
+def get_table_generations(*tables):
+    """
+    Generation of each table, moving on with every committed write through this module
+    
+    The manager's serial is included, so after open_database generations never
+    match those of the previous file.
+    """
+    return (_manager.serial,) + _manager.generations(*tables)
+
+
+def pin_thread_connection():
+    """Keep a dedicated connection for the calling thread (for background workers)"""
+    return _manager.pin_thread()
+
+
+def unpin_thread_connection():
+    """Release the dedicated connection of the calling thread"""
+    _manager.unpin_thread()
+
+
+def open_database(path):
+    """Switch all database operations to another file (used by tests and benchmarks)"""
+    global _manager, DATABASE_PATH
+    _manager.close_all()
+    DATABASE_PATH = path
+    _manager = ConnectionManager(path)
+    init_db()
+
+
 def get_connection():
-    """Create a database connection"""
+    """Create a standalone database connection (caller must close it)"""
     conn = sqlite3.connect(DATABASE_PATH)
     conn.row_factory = sqlite3.Row
+    apply_connection_pragmas(conn, get_storage_profile())
+    register_functions(conn)
     return conn
 
 
+def checkpoint(conn, mode="PASSIVE"):
+    """
+    Copy committed WAL pages back into the database file
+
+    PASSIVE never blocks readers or writers; TRUNCATE also resets the WAL file
+    (e.g. before a backup). Returns (busy, wal_pages, checkpointed_pages).
+    """
+    if mode not in ("PASSIVE", "FULL", "RESTART", "TRUNCATE"):
+        raise ValueError(f"Unknown checkpoint mode: {mode}")
+    return tuple(conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone())
+
+
 def init_db():
     """Initialize the database with required tables"""
-    conn = get_connection()
-    cursor = conn.cursor()
+    # journal_mode is persistent, it only has to be set once per database file
+    journal_mode = _manager.profile['journal_mode']
+    with db_connection() as conn:
+        mode = conn.execute(f"PRAGMA journal_mode = {journal_mode}").fetchone()[0]
+        if mode.upper() != journal_mode.upper():
+            print(f"Storage profile: journal_mode {journal_mode} not available, using {mode}")
+        _create_tables(conn.cursor())
+
+    # Run migrations for existing databases
+    run_migrations()
+
+
+def _create_tables(cursor):
+    """Create all tables that do not exist yet"""
     
     # Investors table
     cursor.execute('''
@@ -130,18 +414,286 @@ def init_db():
         )
     ''')
 
-    conn.commit()
-    conn.close()
+
+
+def _add_outbox_scheduled_mail_id(conn):
+    """Link outbox rows to the scheduled mail they came from (skipped when the column is there)"""
+    columns = [info[1] for info in conn.execute("PRAGMA table_info(outbox)").fetchall()]
+    if 'scheduled_mail_id' not in columns:
+        conn.execute("ALTER TABLE outbox ADD COLUMN scheduled_mail_id INTEGER REFERENCES scheduled_mails (id)")
+
+
+def _compact_scheduled_mails(conn):
+    """
+    Turn pending pre-rendered scheduled mails into template snapshot + context rows
     
-    # Run migrations for existing databases
-    run_migrations()
+    Only where the mail's saved template, rendered for its investor as it is now,
+    gives back exactly the stored subject and body; any other mail (template edited
+    or deleted since, or a one-off message) keeps its rendered copy.
+    """
+    from template_engine import render_batch, snapshot_context, template_variables
+    
+    rows = conn.execute('''
+        SELECT sm.id, sm.template_id, sm.subject, sm.body, sm.investor_id,
+               t.subject AS subject_template, t.body AS body_template
+        FROM scheduled_mails sm
+        JOIN templates t ON sm.template_id = t.id
+        WHERE sm.status = 'pending' AND sm.campaign_id IS NULL
+        ORDER BY sm.template_id, sm.id
+    ''').fetchall()
+    
+    investors = {investor['id']: investor for investor in get_investors_by_ids({row['investor_id'] for row in rows})}
+    campaigns = {}
+    for row in rows:
+        investor = investors.get(row['investor_id'])
+        if investor is None:
+            continue
+        _, subject, body = next(render_batch(row['body_template'], row['subject_template'], [investor],
+                                             return_errors=True))
+        if subject != row['subject'] or body != row['body']:
+            continue
+        
+        if row['template_id'] not in campaigns:
+            campaigns[row['template_id']] = conn.execute(
+                'INSERT INTO scheduled_campaigns (template_id, subject_template, body_template) VALUES (?, ?, ?)',
+                (row['template_id'], row['subject_template'], row['body_template'])
+            ).lastrowid
+        variables = template_variables(row['subject_template']) | template_variables(row['body_template'])
+        context = snapshot_context(investor, variables)
+        conn.execute(
+            'UPDATE scheduled_mails SET campaign_id = ?, context = ?, subject = NULL, body = NULL WHERE id = ?',
+            (campaigns[row['template_id']], json.dumps(context, ensure_ascii=False, default=str), row['id'])
+        )
+
+
+def _fts_fold(expression):
+    """
+    SQL folding a text for investors_fts: dotted/dotless Turkish i become a plain i
+    
+    The unicode61 tokenizer (remove_diacritics 2) folds case and ş/ç/ğ/ö/ü itself,
+    but keeps ı apart from i. search_investors folds queries the same way.
+    """
+    return f"replace(replace(COALESCE({expression}, ''), 'İ', 'i'), 'ı', 'i')"
+
+
+def _fts_interactions(investor_id):
+    """SQL giving all interaction notes of an investor as one folded text"""
+    return _fts_fold(f"(SELECT group_concat(content, ' ') FROM interactions WHERE investor_id = {investor_id})")
+
+
+# Versioned schema migrations: (version, description, steps).
+# A step is an SQL statement or a function of the connection; each migration
+# runs in its own explicit transaction together with its PRAGMA user_version
+# bump, so a failing step leaves neither its schema changes nor the version behind.
+SCHEMA_MIGRATIONS = [
+    (1, "Indexes for hot queries", [
+        # get_all_investors / get_investors_by_category / get_categories / get_stats
+        "CREATE INDEX IF NOT EXISTS idx_investors_active_category_name ON investors (is_active, category, name)",
+        # get_pending_scheduled_mails
+        "CREATE INDEX IF NOT EXISTS idx_scheduled_mails_status_time ON scheduled_mails (status, scheduled_time)",
+        # get_stats (covering for the sent/failed/today counts)
+        "CREATE INDEX IF NOT EXISTS idx_sent_mails_status_sent_at ON sent_mails (status, sent_at)",
+        # get_sent_mails
+        "CREATE INDEX IF NOT EXISTS idx_sent_mails_sent_at ON sent_mails (sent_at)",
+        # get_investor_interactions
+        "CREATE INDEX IF NOT EXISTS idx_interactions_investor_date ON interactions (investor_id, date)",
+        # get_audit_logs
+        "CREATE INDEX IF NOT EXISTS idx_audit_logs_timestamp ON audit_logs (timestamp)",
+    ]),
+    (2, "Shared send rate limit and rolling daily quota", [
+        # Token bucket state, one row per limiter
+        """CREATE TABLE IF NOT EXISTS rate_limit_state (
+            name TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )""",
+        # One row per send slot taken (unix time), pruned after 24 hours
+        """CREATE TABLE IF NOT EXISTS send_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sent_at REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_send_log_sent_at ON send_log (sent_at)",
+        # Count what was already sent in the last 24 hours against the quota
+        """INSERT INTO send_log (sent_at)
+           SELECT CAST(strftime('%s', sent_at) AS REAL) FROM sent_mails
+           WHERE status = 'sent' AND sent_at >= datetime('now', '-1 day')""",
+    ]),
+    (3, "Retry counter for scheduled mails", [
+        # Scheduler runs that ended in a transient error (421/450/429), see defer_scheduled_mail
+        "ALTER TABLE scheduled_mails ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE scheduled_mails ADD COLUMN last_error TEXT",
+    ]),
+    (4, "Durable outbox for campaigns", [
+        """CREATE TABLE IF NOT EXISTS campaigns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            template_id INTEGER,
+            subject TEXT,
+            status TEXT DEFAULT 'running', -- running, done, cancelled
+            total INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP,
+            FOREIGN KEY (template_id) REFERENCES templates (id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS campaign_attachments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            campaign_id INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            content_type TEXT,
+            content BLOB NOT NULL,
+            FOREIGN KEY (campaign_id) REFERENCES campaigns (id)
+        )""",
+        # One row per recipient with the rendered message; state moves
+        # queued -> sending (leased) -> sent / failed, or is skipped at enqueue time
+        """CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            campaign_id INTEGER NOT NULL,
+            investor_id INTEGER,
+            to_email TEXT NOT NULL,
+            subject TEXT,
+            body BLOB,
+            idempotency_key TEXT UNIQUE NOT NULL,
+            state TEXT NOT NULL DEFAULT 'queued', -- queued, sending, sent, failed, skipped, cancelled
+            attempts INTEGER NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            lease_expires_at REAL,
+            last_error TEXT,
+            sent_at TIMESTAMP,
+            FOREIGN KEY (campaign_id) REFERENCES campaigns (id),
+            FOREIGN KEY (investor_id) REFERENCES investors (id)
+        )""",
+        # claim_outbox_items / get_campaign_progress
+        "CREATE INDEX IF NOT EXISTS idx_outbox_campaign_state ON outbox (campaign_id, state, id)",
+        # renew_outbox_leases
+        "CREATE INDEX IF NOT EXISTS idx_outbox_lease_owner ON outbox (lease_owner) WHERE lease_owner IS NOT NULL",
+        # get_unfinished_campaigns
+        "CREATE INDEX IF NOT EXISTS idx_campaigns_status ON campaigns (status)",
+    ]),
+    (5, "Lease-based claiming of scheduled mails", [
+        # status moves pending -> claimed (leased to one scheduler worker) -> sent / failed,
+        # or from claimed to queued (handed to the outbox, schema v10) -> sent / failed
+        "ALTER TABLE scheduled_mails ADD COLUMN lease_owner TEXT",
+        "ALTER TABLE scheduled_mails ADD COLUMN lease_expires_at REAL",
+        # Unix time before which a deferred mail is not claimed again
+        "ALTER TABLE scheduled_mails ADD COLUMN next_attempt_at REAL",
+        # claim_scheduled_mails reclaims expired leases, get_scheduled_wakeups
+        "CREATE INDEX IF NOT EXISTS idx_scheduled_mails_lease ON scheduled_mails (status, lease_expires_at)",
+    ]),
+    (6, "Scheduled mails as template snapshot + context", [
+        # The templates of one scheduling run, stored once instead of a rendered copy per recipient
+        """CREATE TABLE IF NOT EXISTS scheduled_campaigns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            template_id INTEGER,
+            subject_template TEXT NOT NULL,
+            body_template TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (template_id) REFERENCES templates (id)
+        )""",
+        # Set: rendered at send time from the campaign's templates and this JSON context
+        # (subject and body are NULL). Unset: subject and body are the message as is.
+        "ALTER TABLE scheduled_mails ADD COLUMN campaign_id INTEGER REFERENCES scheduled_campaigns (id)",
+        "ALTER TABLE scheduled_mails ADD COLUMN context TEXT",
+        _compact_scheduled_mails,
+    ]),
+    (7, "Index for the CRM status counts", [
+        # get_status_counts (covering)
+        "CREATE INDEX IF NOT EXISTS idx_investors_active_status ON investors (is_active, status)",
+    ]),
+    (8, "Full-text search over investors and their interactions", [
+        # One row per investor (rowid = investors.id) with folded copies of the searchable text
+        """CREATE VIRTUAL TABLE IF NOT EXISTS investors_fts USING fts5(
+            name, company, notes, tags, interactions,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )""",
+        f"""INSERT INTO investors_fts (rowid, name, company, notes, tags, interactions)
+            SELECT id, {_fts_fold('name')}, {_fts_fold('company')}, {_fts_fold('notes')}, {_fts_fold('tags')},
+                   {_fts_interactions('investors.id')}
+            FROM investors""",
+        # Kept in sync by triggers, so every writer (imports, the CRM form, upserts) is covered
+        f"""CREATE TRIGGER IF NOT EXISTS investors_fts_insert AFTER INSERT ON investors BEGIN
+            INSERT INTO investors_fts (rowid, name, company, notes, tags, interactions)
+            VALUES (new.id, {_fts_fold('new.name')}, {_fts_fold('new.company')}, {_fts_fold('new.notes')},
+                    {_fts_fold('new.tags')}, {_fts_interactions('new.id')});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS investors_fts_update AFTER UPDATE OF name, company, notes, tags ON investors BEGIN
+            UPDATE investors_fts
+            SET name = {_fts_fold('new.name')}, company = {_fts_fold('new.company')},
+                notes = {_fts_fold('new.notes')}, tags = {_fts_fold('new.tags')}
+            WHERE rowid = new.id;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS investors_fts_delete AFTER DELETE ON investors BEGIN
+            DELETE FROM investors_fts WHERE rowid = old.id;
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS interactions_fts_insert AFTER INSERT ON interactions BEGIN
+            UPDATE investors_fts SET interactions = {_fts_interactions('new.investor_id')}
+            WHERE rowid = new.investor_id;
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS interactions_fts_update AFTER UPDATE ON interactions BEGIN
+            UPDATE investors_fts SET interactions = {_fts_interactions('old.investor_id')}
+            WHERE rowid = old.investor_id;
+            UPDATE investors_fts SET interactions = {_fts_interactions('new.investor_id')}
+            WHERE rowid = new.investor_id;
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS interactions_fts_delete AFTER DELETE ON interactions BEGIN
+            UPDATE investors_fts SET interactions = {_fts_interactions('old.investor_id')}
+            WHERE rowid = old.investor_id;
+        END""",
+    ]),
+    (9, "Import jobs as a versioned table", [
+        # Resumable chunked spreadsheet imports; created by init_db before schema v9
+        """CREATE TABLE IF NOT EXISTS import_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_key TEXT UNIQUE NOT NULL,  -- content hash of the uploaded file
+            filename TEXT,
+            import_type TEXT,
+            chunk_size INTEGER NOT NULL,
+            rows_committed INTEGER DEFAULT 0,
+            added INTEGER DEFAULT 0,
+            updated INTEGER DEFAULT 0,
+            skipped INTEGER DEFAULT 0,
+            invalid INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'running', -- running, done
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+    ]),
+    (10, "Scheduled mails sent through the outbox", [
+        # Set on the outbox row of a due scheduled mail; the scheduled mail (status 'queued'
+        # meanwhile) is finished together with it
+        _add_outbox_scheduled_mail_id,
+    ]),
+]
+
+
+def get_schema_version():
+    """Get the schema version recorded in the database file"""
+    with db_connection() as conn:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
 
 
 def run_migrations():
     """Run database migrations to update schema"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        _add_missing_investor_columns(cursor)
+
+    current_version = get_schema_version()
+    for version, description, steps in SCHEMA_MIGRATIONS:
+        if version <= current_version:
+            continue
+        print(f"Migrating: schema v{version} - {description}...")
+        with db_connection() as conn:
+            # sqlite3 opens no implicit transaction for DDL, every CREATE/ALTER would commit on its own
+            conn.execute("BEGIN IMMEDIATE")
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f"PRAGMA user_version = {int(version)}")
+
+
+def _add_missing_investor_columns(cursor):
+    """Add CRM columns introduced after the first release"""
     # Check if new columns exist in investors table
     cursor.execute("PRAGMA table_info(investors)")
     columns = [info[1] for info in cursor.fetchall()]
@@ -161,252 +713,467 @@ def run_migrations():
                 cursor.execute(f"ALTER TABLE investors ADD COLUMN {col} {type_def}")
             except sqlite3.OperationalError as e:
                 print(f"Migration error for {col}: {e}")
-                
-    conn.commit()
-    conn.close()
 
 
 # ============ INVESTOR OPERATIONS ============
 
 def add_investor(name, email, company="", category="GENEL", notes="", phone="", linkedin="", status="NEW", tags=""):
     """Add a new investor"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('''
-            INSERT INTO investors (name, email, company, category, notes, phone, linkedin, status, tags)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (name, email, company, category, notes, phone, linkedin, status, tags))
-        conn.commit()
-        return cursor.lastrowid
-    except sqlite3.IntegrityError:
-        return None  # Email already exists
-    finally:
-        conn.close()
+    with db_connection() as conn:
+        mark_changed('investors')
+        try:
+            cursor = conn.execute('''
+                INSERT INTO investors (name, email, company, category, notes, phone, linkedin, status, tags)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (name, email, company, category, notes, phone, linkedin, status, tags))
+            return cursor.lastrowid
+        except sqlite3.IntegrityError:
+            return None  # Email already exists
 
 
 def get_all_investors():
     """Get all active investors"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM investors WHERE is_active = 1 ORDER BY category, name')
-    investors = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return investors
+    with db_connection() as conn:
+        cursor = conn.execute('SELECT * FROM investors WHERE is_active = 1 ORDER BY category, name')
+        return [dict(row) for row in cursor.fetchall()]
 
 
 def get_investors_by_category(category):
     """Get investors by category"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM investors WHERE category = ? AND is_active = 1', (category,))
-    investors = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return investors
+    with db_connection() as conn:
+        cursor = conn.execute('SELECT * FROM investors WHERE category = ? AND is_active = 1', (category,))
+        return [dict(row) for row in cursor.fetchall()]
 
 
 def get_investor_by_id(investor_id):
     """Get a single investor by ID"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM investors WHERE id = ?', (investor_id,))
-    row = cursor.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    with db_connection() as conn:
+        row = conn.execute('SELECT * FROM investors WHERE id = ?', (investor_id,)).fetchone()
+        return dict(row) if row else None
+
+
+# bm25 weights of the investors_fts columns: name, company, notes, tags, interactions
+FTS_WEIGHTS = (10.0, 5.0, 1.0, 3.0, 1.0)
+
+
+def fts_query(text):
+    """
+    FTS5 MATCH expression for a search box text, or None when it has no words
+    
+    Every word must match, as a prefix ("yat" finds "Yatırım"); case, Turkish
+    diacritics and dotted/dotless i are ignored (see _fts_fold).
+    """
+    words = re.findall(r'\w+', text.replace('İ', 'i').replace('ı', 'i'))
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def search_investors(query, limit=20, offset=0):
+    """
+    Full-text search of the active investors, best matches first
+    
+    Looks at the name, company, notes, tags and interaction notes, with the
+    name and company weighted highest. Returns investor dicts.
+    """
+    match = fts_query(query)
+    if match is None:
+        return []
+    with db_connection() as conn:
+        cursor = conn.execute(f'''
+            SELECT i.* FROM investors_fts
+            JOIN investors i ON i.id = investors_fts.rowid
+            WHERE investors_fts MATCH ? AND i.is_active = 1
+            ORDER BY bm25(investors_fts, {', '.join(str(weight) for weight in FTS_WEIGHTS)})
+            LIMIT ? OFFSET ?
+        ''', (match, limit, offset))
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def _investor_filter(category=None, search=None, status=None, tag=None):
+    """WHERE clause and parameters selecting the active investors matching a list/picker filter"""
+    clauses = ['is_active = 1']
+    params = []
+    if category:
+        clauses.append('category = ?')
+        params.append(category)
+    if search:
+        match = fts_query(search)
+        if match:
+            # Words (prefixes) of the name, company, notes, tags or interaction notes
+            clauses.append('id IN (SELECT rowid FROM investors_fts WHERE investors_fts MATCH ?)')
+            params.append(match)
+        else:
+            # No words to look up (e.g. "@"): case-insensitive substring of the name or company
+            clauses.append("(instr(py_lower(name), ?) > 0 OR instr(py_lower(COALESCE(company, '')), ?) > 0)")
+            params += [search.lower()] * 2
+    if status:
+        # Investors from before the CRM columns have no status, they count as NEW
+        clauses.append("COALESCE(status, 'NEW') = ?")
+        params.append(status)
+    if tag:
+        # One whole tag of the comma separated list, ignoring case and spaces
+        clauses.append("instr(',' || py_lower(REPLACE(COALESCE(tags, ''), ' ', '')) || ',', ?) > 0")
+        params.append(f",{tag.lower().replace(' ', '')},")
+    return ' AND '.join(clauses), params
+
+
+def count_investors(category=None, search=None, status=None, tag=None):
+    """Count the active investors matching a filter"""
+    where, params = _investor_filter(category, search, status, tag)
+    with db_connection() as conn:
+        return conn.execute(f'SELECT COUNT(*) FROM investors WHERE {where}', params).fetchone()[0]
+
+
+def get_status_counts():
+    """Count the active investors per CRM status (NULL counted as NEW)"""
+    with db_connection() as conn:
+        cursor = conn.execute('SELECT status, COUNT(*) AS count FROM investors WHERE is_active = 1 GROUP BY status')
+        counts = {}
+        for row in cursor.fetchall():
+            status = row['status'] or 'NEW'
+            counts[status] = counts.get(status, 0) + row['count']
+        return counts
+
+
+def get_investor_ids(category=None, search=None, status=None, tag=None):
+    """Get the ids of all active investors matching a filter (e.g. to select them all at once)"""
+    where, params = _investor_filter(category, search, status, tag)
+    with db_connection() as conn:
+        cursor = conn.execute(f'SELECT id FROM investors WHERE {where} ORDER BY category, name, id', params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def get_investor_page(category=None, search=None, limit=100, offset=0, status=None, tag=None):
+    """Get one page of the active investors matching a filter, ordered like get_all_investors (limit -1: all)"""
+    where, params = _investor_filter(category, search, status, tag)
+    with db_connection() as conn:
+        cursor = conn.execute(f'''
+            SELECT * FROM investors WHERE {where}
+            ORDER BY category, name, id
+            LIMIT ? OFFSET ?
+        ''', params + [limit, offset])
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def get_investors_keyset(category=None, search=None, status=None, tag=None, limit=50, after=None, before=None):
+    """
+    Get a page of the active investors matching a filter, by keyset on (category, name, id)
+    
+    after: (category, name, id) of the last row of the previous page, for the next page
+    before: (category, name, id) of the first row of the current page, for the page before it
+    Rows come in (category, name, id) order. Unlike OFFSET, the index seeks straight
+    to the page, so a page costs the same wherever it is in the list.
+    """
+    where, params = _investor_filter(category, search, status, tag)
+    # Within one category the key is (name, id), which SQLite seeks without an extra sort
+    columns = ('name', 'id') if category else ('category', 'name', 'id')
+    order = ', '.join(columns)
+    key = after if after is not None else before
+    if key is not None:
+        key = list(key)[-len(columns):]
+        where += f" AND ({order}) {'>' if after is not None else '<'} ({', '.join('?' * len(columns))})"
+        params += key
+        if after is None:
+            order = ', '.join(f'{column} DESC' for column in columns)
+    with db_connection() as conn:
+        cursor = conn.execute(f'SELECT * FROM investors WHERE {where} ORDER BY {order} LIMIT ?', params + [limit])
+        rows = [dict(row) for row in cursor.fetchall()]
+    if after is None and before is not None:
+        rows.reverse()
+    return rows
+
+
+# Ids per IN (...) list, well under SQLite's bound-parameter limit
+IN_QUERY_CHUNK_SIZE = 500
+
+
+def get_investors_by_ids(investor_ids, chunk_size=IN_QUERY_CHUNK_SIZE):
+    """
+    Get many investors by ID, one query per chunk of ids
+    
+    Lazily yields investor dicts in the order of investor_ids; ids that no longer
+    exist are skipped. Each chunk is read in its own short block, so the caller can
+    consume the rows at its own pace.
+    """
+    iterator = iter(investor_ids)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        with db_connection() as conn:
+            cursor = conn.execute(
+                f"SELECT * FROM investors WHERE id IN ({', '.join('?' * len(chunk))})", chunk
+            )
+            rows = {row['id']: dict(row) for row in cursor.fetchall()}
+        for investor_id in chunk:
+            if investor_id in rows:
+                yield rows[investor_id]
 
 
 def update_investor(investor_id, name, email, company, category, notes, phone, linkedin, status, tags):
     """Update an investor"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE investors 
-        SET name = ?, email = ?, company = ?, category = ?, notes = ?, 
-            phone = ?, linkedin = ?, status = ?, tags = ?
-        WHERE id = ?
-    ''', (name, email, company, category, notes, phone, linkedin, status, tags, investor_id))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        mark_changed('investors')
+        conn.execute('''
+            UPDATE investors 
+            SET name = ?, email = ?, company = ?, category = ?, notes = ?, 
+                phone = ?, linkedin = ?, status = ?, tags = ?
+            WHERE id = ?
+        ''', (name, email, company, category, notes, phone, linkedin, status, tags, investor_id))
 
 
 def delete_investor(investor_id):
     """Soft delete an investor"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE investors SET is_active = 0 WHERE id = ?', (investor_id,))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        mark_changed('investors')
+        conn.execute('UPDATE investors SET is_active = 0 WHERE id = ?', (investor_id,))
 
 
 def get_categories():
     """Get all unique categories"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT DISTINCT category FROM investors WHERE is_active = 1')
-    categories = [row['category'] for row in cursor.fetchall()]
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.execute('SELECT DISTINCT category FROM investors WHERE is_active = 1')
+        categories = [row['category'] for row in cursor.fetchall()]
     return categories if categories else ['GENEL']
 
 
-def bulk_add_investors(investors_list):
-    """Add multiple investors at once"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    added = 0
-    skipped = 0
-    
-    for inv in investors_list:
-        try:
-            cursor.execute('''
-                INSERT INTO investors (name, email, company, category, notes, phone, linkedin, status, tags)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                inv.get('name', ''),
-                inv.get('email', ''),
-                inv.get('company', ''),
-                inv.get('category', 'GENEL'),
-                inv.get('notes', ''),
-                inv.get('phone', ''),
-                inv.get('linkedin', ''),
-                inv.get('status', 'NEW'),
-                inv.get('tags', '')
-            ))
-            added += 1
-        except sqlite3.IntegrityError:
-            skipped += 1  # Email already exists
-    
-    conn.commit()
-    conn.close()
-    return added, skipped
+# Column order of the row tuples accepted by bulk_upsert_investors
+INVESTOR_IMPORT_COLUMNS = ('name', 'email', 'company', 'category', 'notes', 'phone', 'linkedin', 'status', 'tags')
+
+
+def bulk_upsert_investors(rows, on_conflict="skip"):
+    """
+    Insert many investors with a single executemany in one transaction
+
+    rows: iterable of tuples ordered like INVESTOR_IMPORT_COLUMNS
+    on_conflict: 'skip' keeps existing investors untouched, 'update' refreshes their
+                 contact fields (blank imported values never overwrite stored ones)
+    Returns {'added': n, 'updated': n, 'skipped': n}
+    """
+    if on_conflict not in ("skip", "update"):
+        raise ValueError(f"Unknown on_conflict mode: {on_conflict}")
+
+    if on_conflict == "skip":
+        conflict_clause = "DO NOTHING"
+    else:
+        conflict_clause = '''DO UPDATE SET
+            name = COALESCE(NULLIF(excluded.name, ''), name),
+            company = COALESCE(NULLIF(excluded.company, ''), company),
+            category = COALESCE(NULLIF(excluded.category, ''), category),
+            notes = COALESCE(NULLIF(excluded.notes, ''), notes),
+            phone = COALESCE(NULLIF(excluded.phone, ''), phone),
+            linkedin = COALESCE(NULLIF(excluded.linkedin, ''), linkedin),
+            is_active = 1'''
+
+    rows = rows if isinstance(rows, list) else list(rows)
+    emails = list({row[1] for row in rows})
+
+    with db_connection() as conn:
+        mark_changed('investors')
+        # Counted from the emails already stored, not total_changes: that also counts trigger writes
+        existing = set()
+        for start in range(0, len(emails), IN_QUERY_CHUNK_SIZE):
+            chunk = emails[start:start + IN_QUERY_CHUNK_SIZE]
+            cursor = conn.execute(
+                f"SELECT email FROM investors WHERE email IN ({', '.join('?' * len(chunk))})", chunk
+            )
+            existing.update(row['email'] for row in cursor)
+
+        conn.executemany(f'''
+            INSERT INTO investors (name, email, company, category, notes, phone, linkedin, status, tags)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(email) {conflict_clause}
+        ''', rows)
+
+    # A repeated email in the same batch conflicts with the row inserted just before it
+    added = len(emails) - len(existing)
+    conflicts = len(rows) - added
+    if on_conflict == "update":
+        return {'added': added, 'updated': conflicts, 'skipped': 0}
+    return {'added': added, 'updated': 0, 'skipped': conflicts}
+
+
+def bulk_add_investors(investors_list, on_conflict="skip"):
+    """Add multiple investors at once (dicts keyed like INVESTOR_IMPORT_COLUMNS)"""
+    rows = [
+        (
+            inv.get('name', ''),
+            inv.get('email', ''),
+            inv.get('company', ''),
+            inv.get('category', 'GENEL'),
+            inv.get('notes', ''),
+            inv.get('phone', ''),
+            inv.get('linkedin', ''),
+            inv.get('status', 'NEW'),
+            inv.get('tags', '')
+        )
+        for inv in investors_list
+    ]
+    return bulk_upsert_investors(rows, on_conflict)
+
+
+# ============ IMPORT JOB OPERATIONS ============
+
+def get_import_job(file_key):
+    """Get the import job of a file (by content hash)"""
+    with db_connection() as conn:
+        row = conn.execute('SELECT * FROM import_jobs WHERE file_key = ?', (file_key,)).fetchone()
+        return dict(row) if row else None
+
+
+def start_import_job(file_key, filename, import_type, chunk_size):
+    """Create an import job, or return the existing one to resume it"""
+    with db_connection() as conn:
+        conn.execute('''
+            INSERT INTO import_jobs (file_key, filename, import_type, chunk_size)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(file_key) DO NOTHING
+        ''', (file_key, filename, import_type, chunk_size))
+        return get_import_job(file_key)
+
+
+def record_import_chunk(job_id, rows_read, result):
+    """Add a committed chunk to the job counters (call inside the chunk's transaction)"""
+    with db_connection() as conn:
+        conn.execute('''
+            UPDATE import_jobs
+            SET rows_committed = rows_committed + ?,
+                added = added + ?, updated = updated + ?, skipped = skipped + ?, invalid = invalid + ?,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (rows_read, result['added'], result['updated'], result['skipped'], result['invalid'], job_id))
+
+
+def finish_import_job(job_id):
+    """Mark an import job as completed"""
+    with db_connection() as conn:
+        conn.execute(
+            "UPDATE import_jobs SET status = 'done', updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (job_id,)
+        )
+
+
+def delete_import_job(job_id):
+    """Forget an import job so the same file can be imported again from the start"""
+    with db_connection() as conn:
+        conn.execute('DELETE FROM import_jobs WHERE id = ?', (job_id,))
+
+
+def get_unfinished_import_jobs():
+    """Get import jobs that stopped before the end of their file"""
+    with db_connection() as conn:
+        cursor = conn.execute("SELECT * FROM import_jobs WHERE status = 'running' ORDER BY updated_at DESC")
+        return [dict(row) for row in cursor.fetchall()]
 
 
 # ============ TEMPLATE OPERATIONS ============
 
 def add_template(name, subject, body, category="GENEL"):
     """Add a new template"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO templates (name, subject, body, category)
-        VALUES (?, ?, ?, ?)
-    ''', (name, subject, body, category))
-    conn.commit()
-    template_id = cursor.lastrowid
-    conn.close()
-    return template_id
+    with db_connection() as conn:
+        mark_changed('templates')
+        cursor = conn.execute('''
+            INSERT INTO templates (name, subject, body, category)
+            VALUES (?, ?, ?, ?)
+        ''', (name, subject, body, category))
+        return cursor.lastrowid
 
 
 def get_all_templates():
     """Get all templates"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM templates ORDER BY name')
-    templates = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return templates
+    with db_connection() as conn:
+        cursor = conn.execute('SELECT * FROM templates ORDER BY name')
+        return [dict(row) for row in cursor.fetchall()]
 
 
 def get_template_by_id(template_id):
     """Get a single template by ID"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM templates WHERE id = ?', (template_id,))
-    row = cursor.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    with db_connection() as conn:
+        row = conn.execute('SELECT * FROM templates WHERE id = ?', (template_id,)).fetchone()
+        return dict(row) if row else None
 
 
 def update_template(template_id, name, subject, body, category):
     """Update a template"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE templates 
-        SET name = ?, subject = ?, body = ?, category = ?, updated_at = ?
-        WHERE id = ?
-    ''', (name, subject, body, category, datetime.now(), template_id))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        mark_changed('templates')
+        conn.execute('''
+            UPDATE templates 
+            SET name = ?, subject = ?, body = ?, category = ?, updated_at = ?
+            WHERE id = ?
+        ''', (name, subject, body, category, datetime.now(), template_id))
 
 
 def delete_template(template_id):
     """Delete a template"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM templates WHERE id = ?', (template_id,))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        mark_changed('templates')
+        conn.execute('DELETE FROM templates WHERE id = ?', (template_id,))
 
 
 # ============ SENT MAIL OPERATIONS ============
 
 def log_sent_mail(investor_id, template_id, subject, status="sent", error_message=None):
     """Log a sent mail"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO sent_mails (investor_id, template_id, subject, status, error_message)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (investor_id, template_id, subject, status, error_message))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        mark_changed('sent_mails')
+        conn.execute('''
+            INSERT INTO sent_mails (investor_id, template_id, subject, status, error_message)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (investor_id, template_id, subject, status, error_message))
 
 
 def get_sent_mails(limit=50):
     """Get recent sent mails with investor info"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT 
-            sm.id,
-            sm.subject,
-            sm.sent_at,
-            sm.status,
-            sm.error_message,
-            i.name as investor_name,
-            i.email as investor_email,
-            i.company as investor_company,
-            t.name as template_name
-        FROM sent_mails sm
-        LEFT JOIN investors i ON sm.investor_id = i.id
-        LEFT JOIN templates t ON sm.template_id = t.id
-        ORDER BY sm.sent_at DESC
-        LIMIT ?
-    ''', (limit,))
-    mails = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return mails
+    with db_connection() as conn:
+        cursor = conn.execute('''
+            SELECT 
+                sm.id,
+                sm.subject,
+                sm.sent_at,
+                sm.status,
+                sm.error_message,
+                i.name as investor_name,
+                i.email as investor_email,
+                i.company as investor_company,
+                t.name as template_name
+            FROM sent_mails sm
+            LEFT JOIN investors i ON sm.investor_id = i.id
+            LEFT JOIN templates t ON sm.template_id = t.id
+            ORDER BY sm.sent_at DESC
+            LIMIT ?
+        ''', (limit,))
+        return [dict(row) for row in cursor.fetchall()]
 
 
 def get_stats():
     """Get dashboard statistics"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    # Total investors
-    cursor.execute('SELECT COUNT(*) as count FROM investors WHERE is_active = 1')
-    total_investors = cursor.fetchone()['count']
-    
-    # Total sent mails
-    cursor.execute('SELECT COUNT(*) as count FROM sent_mails WHERE status = "sent"')
-    total_sent = cursor.fetchone()['count']
-    
-    # Total templates
-    cursor.execute('SELECT COUNT(*) as count FROM templates')
-    total_templates = cursor.fetchone()['count']
-    
-    # Failed mails
-    cursor.execute('SELECT COUNT(*) as count FROM sent_mails WHERE status = "failed"')
-    total_failed = cursor.fetchone()['count']
-    
-    # Mails sent today
-    cursor.execute('''
-        SELECT COUNT(*) as count FROM sent_mails 
-        WHERE date(sent_at) = date('now') AND status = "sent"
-    ''')
-    sent_today = cursor.fetchone()['count']
-    
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        # Total investors
+        cursor.execute('SELECT COUNT(*) as count FROM investors WHERE is_active = 1')
+        total_investors = cursor.fetchone()['count']
+        
+        # Total sent mails
+        cursor.execute("SELECT COUNT(*) as count FROM sent_mails WHERE status = 'sent'")
+        total_sent = cursor.fetchone()['count']
+        
+        # Total templates
+        cursor.execute('SELECT COUNT(*) as count FROM templates')
+        total_templates = cursor.fetchone()['count']
+        
+        # Failed mails
+        cursor.execute("SELECT COUNT(*) as count FROM sent_mails WHERE status = 'failed'")
+        total_failed = cursor.fetchone()['count']
+        
+        # Mails sent today (range on sent_at instead of date(sent_at) so the index is used)
+        cursor.execute('''
+            SELECT COUNT(*) as count FROM sent_mails 
+            WHERE status = 'sent' AND sent_at >= date('now') AND sent_at < date('now', '+1 day')
+        ''')
+        sent_today = cursor.fetchone()['count']
     
     return {
         'total_investors': total_investors,
@@ -421,118 +1188,582 @@ def get_stats():
 
 def add_interaction(investor_id, type, content):
     """Add a new interaction (note, meeting, etc.)"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO interactions (investor_id, type, content)
-        VALUES (?, ?, ?)
-    ''', (investor_id, type, content))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        conn.execute('''
+            INSERT INTO interactions (investor_id, type, content)
+            VALUES (?, ?, ?)
+        ''', (investor_id, type, content))
 
 
 def get_investor_interactions(investor_id):
     """Get all interactions for an investor"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT * FROM interactions 
-        WHERE investor_id = ? 
-        ORDER BY date DESC
-    ''', (investor_id,))
-    interactions = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return interactions
+    with db_connection() as conn:
+        cursor = conn.execute('''
+            SELECT * FROM interactions 
+            WHERE investor_id = ? 
+            ORDER BY date DESC
+        ''', (investor_id,))
+        return [dict(row) for row in cursor.fetchall()]
 
 
 # ============ SCHEDULER OPERATIONS ============
 
+# Callbacks run as callback(mail_id, scheduled_time or None when cancelled), see EmailScheduler;
+# mail_id is None for a batch of mails scheduled at once
+_schedule_listeners = []
+
+
+def add_schedule_listener(callback):
+    """Get told about every scheduled or cancelled mail"""
+    _schedule_listeners.append(callback)
+
+
+def remove_schedule_listener(callback):
+    if callback in _schedule_listeners:
+        _schedule_listeners.remove(callback)
+
+
+def _notify_schedule(mail_id, scheduled_time):
+    for callback in list(_schedule_listeners):
+        callback(mail_id, scheduled_time)
+
+
 def schedule_mail(investor_id, template_id, subject, body, scheduled_time):
-    """Schedule a mail for future sending"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO scheduled_mails (investor_id, template_id, subject, body, scheduled_time)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (investor_id, template_id, subject, body, scheduled_time))
-    conn.commit()
-    conn.close()
+    """Schedule a mail for future sending and return its id"""
+    with db_connection() as conn:
+        cursor = conn.execute('''
+            INSERT INTO scheduled_mails (investor_id, template_id, subject, body, scheduled_time)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (investor_id, template_id, subject, body, scheduled_time))
+    _notify_schedule(cursor.lastrowid, scheduled_time)
+    return cursor.lastrowid
+
+
+def get_scheduled_campaign(campaign_id):
+    """Get a scheduled campaign row (its template snapshot)"""
+    with db_connection() as conn:
+        row = conn.execute('SELECT * FROM scheduled_campaigns WHERE id = ?', (campaign_id,)).fetchone()
+        return dict(row) if row else None
+
+
+def schedule_campaign_mails(template_id, subject_template, body_template, rows, scheduled_time):
+    """
+    Schedule a template for many investors, as one template snapshot + a context per mail
+    
+    rows: (investor_id, context JSON) per mail; the mails are rendered from the
+    snapshot when they are sent. Returns the number of mails scheduled.
+    """
+    with db_connection() as conn:
+        campaign_id = conn.execute(
+            'INSERT INTO scheduled_campaigns (template_id, subject_template, body_template) VALUES (?, ?, ?)',
+            (template_id, subject_template, body_template)
+        ).lastrowid
+        before = conn.total_changes
+        conn.executemany('''
+            INSERT INTO scheduled_mails (investor_id, template_id, campaign_id, context, scheduled_time)
+            VALUES (?, ?, ?, ?, ?)
+        ''', ((investor_id, template_id, campaign_id, context, scheduled_time) for investor_id, context in rows))
+        count = conn.total_changes - before
+    if count:
+        _notify_schedule(None, scheduled_time)
+    return count
+
+
+def cancel_scheduled_mail(mail_id):
+    """Cancel a mail that has not been sent yet, returning False if it already was"""
+    with db_connection() as conn:
+        cursor = conn.execute(
+            "UPDATE scheduled_mails SET status = 'cancelled' WHERE id = ? AND status = 'pending'", (mail_id,)
+        )
+    if cursor.rowcount:
+        _notify_schedule(mail_id, None)
+    return cursor.rowcount > 0
+
+
+def get_scheduled_wakeups():
+    """
+    When the scheduler has work, for its wakeup heap
+    
+    (id, scheduled_time or the later next_attempt_at unix time) of every pending mail,
+    and (id, lease_expires_at unix time) of every claimed one, so an abandoned lease
+    is reclaimed when it runs out.
+    """
+    with db_connection() as conn:
+        cursor = conn.execute('''
+            SELECT id, COALESCE(next_attempt_at, scheduled_time) AS due FROM scheduled_mails WHERE status = 'pending'
+            UNION ALL
+            SELECT id, lease_expires_at AS due FROM scheduled_mails WHERE status = 'claimed'
+        ''')
+        return [(row['id'], row['due']) for row in cursor.fetchall()]
 
 
 def get_pending_scheduled_mails():
     """Get mails that are ready to be sent with investor details"""
-    conn = get_connection()
-    cursor = conn.cursor()
     now = datetime.now()
-    cursor.execute('''
-        SELECT 
-            sm.id, sm.investor_id, sm.template_id, sm.subject, sm.body, sm.scheduled_time,
-            i.email as investor_email, i.name as investor_name
-        FROM scheduled_mails sm
-        JOIN investors i ON sm.investor_id = i.id
-        WHERE sm.status = 'pending' AND sm.scheduled_time <= ?
-    ''', (now,))
-    mails = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return mails
+    with db_connection() as conn:
+        cursor = conn.execute('''
+            SELECT 
+                sm.id, sm.investor_id, sm.template_id, sm.subject, sm.body, sm.scheduled_time,
+                sm.attempts, sm.campaign_id, sm.context, i.email as investor_email, i.name as investor_name
+            FROM scheduled_mails sm
+            JOIN investors i ON sm.investor_id = i.id
+            WHERE sm.status = 'pending' AND sm.scheduled_time <= ?
+        ''', (now,))
+        return [dict(row) for row in cursor.fetchall()]
 
 
 def update_scheduled_mail_status(mail_id, status):
     """Update status of a scheduled mail"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE scheduled_mails SET status = ? WHERE id = ?', (status, mail_id))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        conn.execute('UPDATE scheduled_mails SET status = ? WHERE id = ?', (status, mail_id))
+
+
+def claim_scheduled_mails(owner, limit, lease_seconds, now=None):
+    """
+    Lease up to `limit` due mails to `owner`, with investor details
+    
+    Expired leases (their worker or process died) go back to pending first,
+    counted as an attempt. The claim itself is one UPDATE ... RETURNING, so
+    two workers, in this process or another, never get the same mail.
+    """
+    now = time.time() if now is None else now
+    with db_connection() as conn:
+        conn.execute('''
+            UPDATE scheduled_mails
+            SET status = 'pending', lease_owner = NULL, lease_expires_at = NULL,
+                attempts = attempts + 1, last_error = 'Lease expired'
+            WHERE status = 'claimed' AND lease_expires_at < ?
+        ''', (now,))
+        cursor = conn.execute('''
+            UPDATE scheduled_mails
+            SET status = 'claimed', lease_owner = ?, lease_expires_at = ?
+            WHERE id IN (
+                SELECT id FROM scheduled_mails
+                WHERE status = 'pending' AND scheduled_time <= ?
+                  AND (next_attempt_at IS NULL OR next_attempt_at <= ?)
+                ORDER BY scheduled_time
+                LIMIT ?
+            )
+            RETURNING id
+        ''', (owner, now + lease_seconds, datetime.fromtimestamp(now), now, limit))
+        ids = [row['id'] for row in cursor.fetchall()]
+        if not ids:
+            return []
+        cursor = conn.execute(f'''
+            SELECT 
+                sm.id, sm.investor_id, sm.template_id, sm.subject, sm.body, sm.scheduled_time,
+                sm.attempts, sm.campaign_id, sm.context, i.email as investor_email, i.name as investor_name
+            FROM scheduled_mails sm
+            JOIN investors i ON sm.investor_id = i.id
+            WHERE sm.id IN ({', '.join('?' * len(ids))})
+            ORDER BY sm.scheduled_time
+        ''', ids)
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def complete_scheduled_mail(mail_id, owner, status):
+    """
+    Finish a claimed mail as 'sent' or 'failed'
+    
+    Returns False when the lease was lost (it expired and another worker took the mail).
+    """
+    with db_connection() as conn:
+        cursor = conn.execute('''
+            UPDATE scheduled_mails SET status = ?, lease_owner = NULL, lease_expires_at = NULL
+            WHERE id = ? AND lease_owner = ? AND status = 'claimed'
+        ''', (status, mail_id, owner))
+        return cursor.rowcount == 1
+
+
+def hand_off_scheduled_mails(mail_ids, owner):
+    """
+    Move claimed mails to 'queued' once they are in the outbox, returning the ids still leased by owner
+    
+    Call it in the transaction that enqueues them, so a mail whose lease was lost
+    is left out of the outbox.
+    """
+    mail_ids = list(mail_ids)
+    if not mail_ids:
+        return []
+    with db_connection() as conn:
+        cursor = conn.execute(f'''
+            UPDATE scheduled_mails SET status = 'queued', lease_owner = NULL, lease_expires_at = NULL
+            WHERE id IN ({', '.join('?' * len(mail_ids))}) AND lease_owner = ? AND status = 'claimed'
+            RETURNING id
+        ''', mail_ids + [owner])
+        return [row['id'] for row in cursor.fetchall()]
+
+
+def release_scheduled_mail(mail_id, owner, retry_at=None):
+    """Put a claimed mail back to pending untried (e.g. the daily quota ran out), claimable again from retry_at"""
+    with db_connection() as conn:
+        cursor = conn.execute('''
+            UPDATE scheduled_mails
+            SET status = 'pending', lease_owner = NULL, lease_expires_at = NULL, next_attempt_at = ?
+            WHERE id = ? AND lease_owner = ? AND status = 'claimed'
+        ''', (retry_at, mail_id, owner))
+        return cursor.rowcount == 1
+
+
+def renew_scheduled_leases(owner, lease_seconds, now=None):
+    """Extend every lease held by owner (a long batch keeps its mails)"""
+    now = time.time() if now is None else now
+    with db_connection() as conn:
+        conn.execute(
+            "UPDATE scheduled_mails SET lease_expires_at = ? WHERE lease_owner = ? AND status = 'claimed'",
+            (now + lease_seconds, owner)
+        )
+
 
+def defer_scheduled_mail(mail_id, error_message, owner=None, retry_at=None):
+    """Put a mail back to pending after a transient error, counting the attempt; claimable again from retry_at"""
+    with db_connection() as conn:
+        conn.execute('''
+            UPDATE scheduled_mails
+            SET status = 'pending', lease_owner = NULL, lease_expires_at = NULL, next_attempt_at = ?,
+                attempts = attempts + 1, last_error = ?
+            WHERE id = ? AND (? IS NULL OR lease_owner = ?)
+        ''', (retry_at, error_message, mail_id, owner, owner))
+
+
+# ============ OUTBOX OPERATIONS ============
+
+OUTBOX_COLUMNS = ('investor_id', 'to_email', 'subject', 'body', 'idempotency_key', 'state', 'last_error',
+                  'scheduled_mail_id')
+
+
+def create_campaign(template_id, subject):
+    """Create a running campaign and return its id"""
+    with db_connection() as conn:
+        cursor = conn.execute('INSERT INTO campaigns (template_id, subject) VALUES (?, ?)', (template_id, subject))
+        return cursor.lastrowid
+
+
+def get_campaign(campaign_id):
+    """Get a campaign row"""
+    with db_connection() as conn:
+        row = conn.execute('SELECT * FROM campaigns WHERE id = ?', (campaign_id,)).fetchone()
+        return dict(row) if row else None
+
+
+def add_campaign_attachment(campaign_id, filename, content_type, content):
+    """Store an attachment so the campaign can be resumed after a restart"""
+    with db_connection() as conn:
+        conn.execute('''
+            INSERT INTO campaign_attachments (campaign_id, filename, content_type, content)
+            VALUES (?, ?, ?, ?)
+        ''', (campaign_id, filename, content_type, content))
+
+
+def get_campaign_attachments(campaign_id):
+    """Get a campaign's attachments as (filename, content, content_type) tuples"""
+    with db_connection() as conn:
+        cursor = conn.execute(
+            'SELECT filename, content, content_type FROM campaign_attachments WHERE campaign_id = ? ORDER BY id',
+            (campaign_id,)
+        )
+        return [tuple(row) for row in cursor.fetchall()]
+
+
+def enqueue_outbox(campaign_id, rows):
+    """
+    Add messages to a campaign (tuples ordered like OUTBOX_COLUMNS)
+    
+    A row whose idempotency key is already in the outbox is ignored.
+    Returns the number of rows added.
+    """
+    with db_connection() as conn:
+        before = conn.total_changes
+        conn.executemany(f'''
+            INSERT INTO outbox (campaign_id, {', '.join(OUTBOX_COLUMNS)})
+            VALUES (?, {', '.join('?' * len(OUTBOX_COLUMNS))})
+            ON CONFLICT(idempotency_key) DO NOTHING
+        ''', ((campaign_id,) + tuple(row) for row in rows))
+        added = conn.total_changes - before
+        conn.execute('UPDATE campaigns SET total = total + ? WHERE id = ?', (added, campaign_id))
+        return added
+
+
+def claim_outbox_items(campaign_id, owner, limit, lease_seconds, now=None):
+    """
+    Lease up to `limit` sendable messages of a campaign to `owner`
+    
+    Takes queued messages and messages whose lease ran out (their worker died)
+    in one UPDATE ... RETURNING, so two workers never get the same row.
+    """
+    now = time.time() if now is None else now
+    with db_connection() as conn:
+        cursor = conn.execute('''
+            UPDATE outbox
+            SET state = 'sending', lease_owner = ?, lease_expires_at = ?, attempts = attempts + 1
+            WHERE id IN (
+                SELECT id FROM outbox
+                WHERE campaign_id = ?
+                  AND (state = 'queued' OR (state = 'sending' AND lease_expires_at < ?))
+                ORDER BY id
+                LIMIT ?
+            )
+            RETURNING id, investor_id, to_email, subject, body, idempotency_key, attempts, scheduled_mail_id
+        ''', (owner, now + lease_seconds, campaign_id, now, limit))
+        return sorted((dict(row) for row in cursor.fetchall()), key=lambda item: item['id'])
+
+
+def complete_outbox_item(item_id, owner, state, error_message=None):
+    """
+    Finish a leased message as 'sent' or 'failed'
+    
+    Only the lease owner can finish it; returns False when the lease was lost
+    (it expired and another worker took the message).
+    """
+    with db_connection() as conn:
+        cursor = conn.execute('''
+            UPDATE outbox
+            SET state = ?, last_error = ?, lease_owner = NULL, lease_expires_at = NULL,
+                sent_at = CASE WHEN ? = 'sent' THEN CURRENT_TIMESTAMP END
+            WHERE id = ? AND lease_owner = ? AND state = 'sending'
+        ''', (state, error_message, state, item_id, owner))
+        return cursor.rowcount == 1
+
+
+def release_outbox_item(item_id, owner, error_message=None):
+    """Put a leased message back in the queue untried (e.g. the daily quota ran out)"""
+    with db_connection() as conn:
+        cursor = conn.execute('''
+            UPDATE outbox
+            SET state = 'queued', attempts = attempts - 1, last_error = ?, lease_owner = NULL, lease_expires_at = NULL
+            WHERE id = ? AND lease_owner = ? AND state = 'sending'
+        ''', (error_message, item_id, owner))
+        return cursor.rowcount == 1
+
+
+def renew_outbox_leases(owner, lease_seconds, now=None):
+    """Extend every lease held by owner (a long batch keeps its messages)"""
+    now = time.time() if now is None else now
+    with db_connection() as conn:
+        conn.execute(
+            "UPDATE outbox SET lease_expires_at = ? WHERE lease_owner = ? AND state = 'sending'",
+            (now + lease_seconds, owner)
+        )
+
+
+def get_outbox_lease_owners(campaign_id):
+    """Owners holding leases on a campaign's messages"""
+    with db_connection() as conn:
+        cursor = conn.execute(
+            "SELECT DISTINCT lease_owner FROM outbox WHERE campaign_id = ? AND state = 'sending'", (campaign_id,)
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def requeue_outbox_leases(campaign_id, owners):
+    """
+    Put the messages leased by owners back in the queue, without waiting for the leases to run out
+    
+    For owners known to be gone (a closed drain, a dead process). The attempt stays
+    counted: the message may have gone out before its owner stopped.
+    Returns the number of messages requeued.
+    """
+    owners = list(owners)
+    if not owners:
+        return 0
+    with db_connection() as conn:
+        cursor = conn.execute(f'''
+            UPDATE outbox SET state = 'queued', lease_owner = NULL, lease_expires_at = NULL
+            WHERE campaign_id = ? AND state = 'sending' AND lease_owner IN ({', '.join('?' * len(owners))})
+        ''', [campaign_id] + owners)
+        return cursor.rowcount
+
+
+def get_campaign_progress(campaign_id):
+    """Message counts of a campaign by state, plus 'total'"""
+    progress = dict.fromkeys(('queued', 'sending', 'sent', 'failed', 'skipped', 'cancelled'), 0)
+    with db_connection() as conn:
+        cursor = conn.execute(
+            'SELECT state, COUNT(*) FROM outbox WHERE campaign_id = ? GROUP BY state', (campaign_id,)
+        )
+        progress.update(cursor.fetchall())
+    progress['total'] = sum(progress.values())
+    return progress
+
+
+def finish_campaign(campaign_id):
+    """Mark a campaign done once nothing is queued or leased; returns False while something is"""
+    with db_connection() as conn:
+        cursor = conn.execute('''
+            UPDATE campaigns SET status = 'done', finished_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'running' AND NOT EXISTS (
+                SELECT 1 FROM outbox WHERE campaign_id = ? AND state IN ('queued', 'sending')
+            )
+        ''', (campaign_id, campaign_id))
+        return cursor.rowcount == 1
+
+
+def cancel_campaign(campaign_id):
+    """Stop a campaign; messages not sent yet are marked cancelled, with the scheduled mails they came from"""
+    with db_connection() as conn:
+        conn.execute('''
+            UPDATE outbox SET state = 'cancelled', lease_owner = NULL, lease_expires_at = NULL
+            WHERE campaign_id = ? AND state IN ('queued', 'sending')
+        ''', (campaign_id,))
+        conn.execute('''
+            UPDATE scheduled_mails SET status = 'cancelled'
+            WHERE status = 'queued' AND id IN (
+                SELECT scheduled_mail_id FROM outbox WHERE campaign_id = ? AND state = 'cancelled'
+            )
+        ''', (campaign_id,))
+        conn.execute(
+            "UPDATE campaigns SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (campaign_id,)
+        )
+
+
+def get_unfinished_campaigns(scheduled=False):
+    """
+    Get running campaigns with their progress (newest first)
+    
+    scheduled=False: campaigns started from the send page; True: the ones the
+    scheduler made of due scheduled mails (it resumes those itself).
+    """
+    with db_connection() as conn:
+        cursor = conn.execute(f'''
+            SELECT * FROM campaigns
+            WHERE status = 'running' AND {'' if scheduled else 'NOT'} EXISTS (
+                SELECT 1 FROM outbox WHERE campaign_id = campaigns.id AND scheduled_mail_id IS NOT NULL
+            )
+            ORDER BY id DESC
+        ''')
+        campaigns = [dict(row) for row in cursor.fetchall()]
+    for campaign in campaigns:
+        campaign['progress'] = get_campaign_progress(campaign['id'])
+    return campaigns
+
+
+# ============ SEND QUOTA OPERATIONS ============
+
+QUOTA_WINDOW_SECONDS = 24 * 60 * 60
+
+
+def reserve_send_slot(interval, burst, daily_limit, now=None):
+    """
+    Take one send slot from the shared token bucket and the rolling 24h quota
+    
+    Runs in one IMMEDIATE transaction, so every thread and process sees the same
+    bucket. The bucket holds up to `burst` tokens and refills one per `interval`
+    seconds; a slot taken from an empty bucket is queued behind the ones before it.
+    Returns (wait_seconds, None), or (None, retry_at) when the daily quota is used up.
+    """
+    now = time.time() if now is None else now
+    window_start = now - QUOTA_WINDOW_SECONDS
+    
+    with db_connection() as conn:
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM send_log WHERE sent_at <= ?", (window_start,))
+        count, oldest = conn.execute(
+            "SELECT COUNT(*), MIN(sent_at) FROM send_log WHERE sent_at > ?", (window_start,)
+        ).fetchone()
+        if count >= daily_limit:
+            return None, oldest + QUOTA_WINDOW_SECONDS
+        
+        tokens = _bucket_tokens(conn, interval, burst, now) - 1
+        wait = max(0.0, -tokens * interval)
+        conn.execute('''
+            INSERT INTO rate_limit_state (name, tokens, updated_at) VALUES ('send', ?, ?)
+            ON CONFLICT(name) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at
+        ''', (tokens, now))
+        conn.execute("INSERT INTO send_log (sent_at) VALUES (?)", (now + wait,))
+    return wait, None
+
+
+def refund_send_slots(count):
+    """
+    Give back quota slots of sends that did not go out (failed, or retried later)
+    
+    The newest entries are removed, so the time the quota resets stays the same.
+    Bucket tokens are not given back: the rate between attempts still holds.
+    """
+    if count <= 0:
+        return
+    with db_connection() as conn:
+        conn.execute(
+            "DELETE FROM send_log WHERE id IN (SELECT id FROM send_log ORDER BY id DESC LIMIT ?)", (count,)
+        )
+
+
+def _bucket_tokens(conn, interval, burst, now):
+    """Tokens in the bucket at `now` (refilled since the last update)"""
+    row = conn.execute("SELECT tokens, updated_at FROM rate_limit_state WHERE name = 'send'").fetchone()
+    if row is None or not interval:
+        return float(burst)
+    return min(float(burst), row['tokens'] + (now - row['updated_at']) / interval)
+
+
+def get_send_quota(interval, burst, daily_limit, now=None):
+    """
+    Read the limiter state without taking a slot
+    
+    sent_24h / remaining: rolling 24h quota usage
+    tokens: current bucket level (fractional)
+    available_now: slots usable right away (bucket tokens, capped by the quota)
+    next_slot_in: seconds until a slot is free (None while the quota is used up)
+    quota_resets_at: unix time the oldest counted send leaves the window
+    """
+    now = time.time() if now is None else now
+    with db_connection() as conn:
+        count, oldest = conn.execute(
+            "SELECT COUNT(*), MIN(sent_at) FROM send_log WHERE sent_at > ?", (now - QUOTA_WINDOW_SECONDS,)
+        ).fetchone()
+        tokens = _bucket_tokens(conn, interval, burst, now)
+    
+    remaining = max(0, daily_limit - count)
+    if remaining == 0:
+        next_slot_in = None
+    else:
+        next_slot_in = max(0.0, (1 - tokens) * interval)
+    return {
+        'sent_24h': count,
+        'daily_limit': daily_limit,
+        'remaining': remaining,
+        'tokens': tokens,
+        'available_now': min(remaining, max(0, int(tokens))),
+        'next_slot_in': next_slot_in,
+        'quota_resets_at': oldest + QUOTA_WINDOW_SECONDS if oldest is not None else None
+    }
 
 
 # ============ ADVANCED FEATURES OPERATIONS ============
 
 def add_unsubscribe(email, reason="Unsubscribe link"):
     """Add email to unsubscribe list"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('''
-            INSERT INTO unsubscribes (email, reason)
-            VALUES (?, ?)
-        ''', (email, reason))
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        return False
-    finally:
-        conn.close()
+    with db_connection() as conn:
+        try:
+            conn.execute('''
+                INSERT INTO unsubscribes (email, reason)
+                VALUES (?, ?)
+            ''', (email, reason))
+            return True
+        except sqlite3.IntegrityError:
+            return False
 
 def is_unsubscribed(email):
     """Check if email is unsubscribed"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM unsubscribes WHERE email = ?', (email,))
-    result = cursor.fetchone()
-    conn.close()
+    with db_connection() as conn:
+        result = conn.execute('SELECT id FROM unsubscribes WHERE email = ?', (email,)).fetchone()
     return result is not None
 
 def log_audit(action, details, performed_by="System"):
     """Log an audit event"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO audit_logs (action, details, performed_by)
-        VALUES (?, ?, ?)
-    ''', (action, details, performed_by))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        conn.execute('''
+            INSERT INTO audit_logs (action, details, performed_by)
+            VALUES (?, ?, ?)
+        ''', (action, details, performed_by))
 
 def get_audit_logs(limit=50):
     """Get recent audit logs"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM audit_logs ORDER BY timestamp DESC LIMIT ?', (limit,))
-    logs = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return logs
+    with db_connection() as conn:
+        cursor = conn.execute('SELECT * FROM audit_logs ORDER BY timestamp DESC LIMIT ?', (limit,))
+        return [dict(row) for row in cursor.fetchall()]
 
 # Initialize database on import
-init_db()
+init_db()
\ No newline at end of file
@@ -7,13 +7,26 @@ Developed by: emirgunyy & gktrk363
 import os
 import json
 import base64
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import time
+import queue
+import threading
+import httplib2
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
-from config import DATA_DIR
+from googleapiclient.errors import HttpError
+from google_auth_httplib2 import AuthorizedHttp
+from config import (
+    DATA_DIR, SEND_CONCURRENCY, GMAIL_BATCH_SIZE, GMAIL_BATCH_MAX_BYTES, GMAIL_HTTP_TIMEOUT,
+    TOKEN_REFRESH_MARGIN, TOKEN_REFRESH_INTERVAL
+)
+from mime_message import build_message
+from rate_limiter import (
+    DailyQuotaExceeded, get_rate_limiter, get_throttle, SendResult, TRANSIENT, DISCONNECTED, PERMANENT, QUOTA
+)
 
 # OAuth scopes - only what we need
 SCOPES = [
@@ -26,6 +39,234 @@ SCOPES = [
 TOKEN_FILE = os.path.join(DATA_DIR, 'gmail_token.json')
 CREDENTIALS_FILE = os.path.join(DATA_DIR, 'credentials.json')
 
+# Gmail API error reasons (error.errors[].reason) by error kind
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded', 'backendError'}
+QUOTA_REASONS = {'dailyLimitExceeded', 'quotaExceeded'}
+
+
+def _error_reasons(error):
+    """Reasons listed in a Gmail API error response"""
+    details = error.error_details if isinstance(error.error_details, list) else []
+    return {detail.get('reason') for detail in details if isinstance(detail, dict)}
+
+
+def classify_gmail_error(error):
+    """
+    Error kind and Retry-After seconds of an exception raised by a Gmail API call
+    
+    429, 5xx and rateLimitExceeded are transient, a used up daily limit is QUOTA,
+    anything else the API rejected (bad address, missing scope) is permanent.
+    """
+    if isinstance(error, HttpError):
+        status = int(error.resp.status)
+        reasons = _error_reasons(error)
+        try:
+            retry_after = float(error.resp.get('retry-after'))
+        except (TypeError, ValueError):
+            retry_after = None
+        
+        if reasons & QUOTA_REASONS:
+            return QUOTA, retry_after
+        if status == 429 or status >= 500 or reasons & RATE_LIMIT_REASONS:
+            return TRANSIENT, retry_after
+        return PERMANENT, retry_after
+    if isinstance(error, (OSError, httplib2.HttpLib2Error)):
+        # Connection resets, timeouts, DNS failures
+        return DISCONNECTED, None
+    return PERMANENT, None
+
+
+class HttpPool:
+    """
+    Keep-alive HTTP connections for one credential
+    
+    httplib2 connections are not thread-safe, so every request checks one out.
+    Returned connections keep their open TLS socket to the Gmail API and are
+    reused by the next request instead of connecting again.
+    """
+    
+    def __init__(self, creds, size=SEND_CONCURRENCY, timeout=GMAIL_HTTP_TIMEOUT):
+        self.creds = creds
+        self.size = size
+        self.timeout = timeout
+        self.created = 0
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+    
+    def _new_http(self):
+        with self._lock:
+            self.created += 1
+        return AuthorizedHttp(self.creds, http=httplib2.Http(timeout=self.timeout))
+    
+    @contextmanager
+    def connection(self):
+        """Check out an authorized connection for one request"""
+        try:
+            http = self._idle.get_nowait()
+        except queue.Empty:
+            http = self._new_http()
+        try:
+            yield http
+        finally:
+            if self._idle.qsize() < self.size:
+                self._idle.put(http)
+
+
+# ============ SERVICE CACHE ============
+
+class GmailServiceCache:
+    """
+    Process-wide Gmail API clients, one entry per credential
+    
+    Each entry keeps the service (built once from the discovery document shipped
+    with googleapiclient, no discovery request), the HttpPool and the profile
+    email, so the UI and every scheduler tick share them. A background thread
+    refreshes tokens TOKEN_REFRESH_MARGIN seconds before they expire, so a send
+    never waits for a refresh.
+    """
+    
+    def __init__(self, refresh_margin=TOKEN_REFRESH_MARGIN, refresh_interval=TOKEN_REFRESH_INTERVAL):
+        self.refresh_margin = refresh_margin
+        self.refresh_interval = refresh_interval
+        self.builds = 0
+        self._entries = {}  # refresh token (or token) -> entry dict
+        self._files = {}  # token file -> (mtime, key) it was last loaded or saved as
+        self._lock = threading.Lock()
+        self._refresher = None
+    
+    @staticmethod
+    def _key(creds):
+        return creds.refresh_token or creds.token
+    
+    def register(self, creds, token_file=None):
+        """Start a fresh entry for creds (new login), replacing one of the same account"""
+        service = build('gmail', 'v1', credentials=creds, static_discovery=True, cache_discovery=False)
+        entry = {'creds': creds, 'service': service, 'pool': HttpPool(creds), 'email': None,
+                 'token_file': token_file}
+        with self._lock:
+            self.builds += 1
+            self._entries[self._key(creds)] = entry
+            if token_file:
+                self._files[token_file] = (self._mtime(token_file), self._key(creds))
+        self._start_refresher()
+        return entry
+    
+    def _entry(self, creds):
+        with self._lock:
+            entry = self._entries.get(self._key(creds))
+        if entry is None or entry['creds'] is not creds:
+            entry = self.register(creds)
+        return entry
+    
+    def service(self, creds):
+        """Gmail API service for creds"""
+        return self._entry(creds)['service']
+    
+    def pool(self, creds):
+        """Keep-alive connections for creds"""
+        return self._entry(creds)['pool']
+    
+    def user_email(self, creds):
+        """Address of the account behind creds, asked from the API once"""
+        entry = self._entry(creds)
+        if entry['email'] is None:
+            with entry['pool'].connection() as http:
+                profile = entry['service'].users().getProfile(userId='me').execute(http=http)
+            entry['email'] = profile.get('emailAddress')
+        return entry['email']
+    
+    def forget(self, creds):
+        """Drop the entry of creds (logout)"""
+        with self._lock:
+            self._entries.pop(self._key(creds), None)
+            self._files = {path: loaded for path, loaded in self._files.items() if loaded[1] != self._key(creds)}
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._files.clear()
+    
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+    
+    def load(self, token_file, scopes):
+        """
+        Credentials saved in token_file, or None
+        
+        The file is read again only when it changed since the last load; otherwise
+        the cached credentials (kept fresh by the refresher) are returned.
+        """
+        mtime = self._mtime(token_file)
+        if mtime is None:
+            return None
+        with self._lock:
+            loaded_mtime, key = self._files.get(token_file, (None, None))
+            entry = self._entries.get(key)
+        if entry is not None and loaded_mtime == mtime:
+            return entry['creds']
+        
+        creds = Credentials.from_authorized_user_file(token_file, scopes)
+        if creds.expired and creds.refresh_token:
+            creds.refresh(Request())
+            self._save(creds, token_file)
+        self.register(creds, token_file)
+        return creds
+    
+    def _save(self, creds, token_file):
+        with open(token_file, 'w') as token:
+            token.write(creds.to_json())
+    
+    def refresh_due(self):
+        """Refresh every cached token that expires within refresh_margin, returning how many were refreshed"""
+        deadline = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(seconds=self.refresh_margin)
+        with self._lock:
+            entries = list(self._entries.values())
+        
+        refreshed = 0
+        for entry in entries:
+            creds = entry['creds']
+            if not creds.refresh_token or creds.expiry is None or creds.expiry > deadline:
+                continue
+            try:
+                creds.refresh(Request())
+            except Exception as e:
+                print(f"Token refresh failed: {e}")
+                continue
+            refreshed += 1
+            if entry['token_file']:
+                self._save(creds, entry['token_file'])
+                with self._lock:
+                    self._files[entry['token_file']] = (self._mtime(entry['token_file']), self._key(creds))
+        return refreshed
+    
+    def _start_refresher(self):
+        with self._lock:
+            if self._refresher is not None:
+                return
+            self._refresher = threading.Thread(target=self._refresh_loop, daemon=True, name='gmail-token-refresh')
+        self._refresher.start()
+    
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh_due()
+            except Exception as e:
+                print(f"Token refresher error: {e}")
+
+
+# One cache for the app and the scheduler
+_service_cache = GmailServiceCache()
+
+
+def get_service_cache():
+    """Get the shared Gmail service cache"""
+    return _service_cache
+
 
 class GmailOAuth:
     """Gmail OAuth2 authentication and email sending"""
@@ -34,6 +275,7 @@ class GmailOAuth:
         self.creds = None
         self.service = None
         self.user_email = None
+        self.round_trips = 0  # Gmail API send requests made (a batch counts once)
     
     def is_authenticated(self):
         """Check if user is authenticated"""
@@ -47,12 +289,8 @@ class GmailOAuth:
         """Load credentials from saved token file"""
         if os.path.exists(TOKEN_FILE):
             try:
-                self.creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
-                
-                # Refresh if expired
-                if self.creds and self.creds.expired and self.creds.refresh_token:
-                    self.creds.refresh(Request())
-                    self._save_credentials()
+                # Cached until the token file changes; refreshed if expired
+                self.creds = get_service_cache().load(TOKEN_FILE, SCOPES)
                 
                 if self.creds and self.creds.valid:
                     self._init_service()
@@ -69,14 +307,28 @@ class GmailOAuth:
             token.write(self.creds.to_json())
     
     def _init_service(self):
-        """Initialize Gmail API service"""
-        self.service = build('gmail', 'v1', credentials=self.creds)
+        """Initialize Gmail API service (shared with every GmailOAuth of the same credential)"""
+        self.service = get_service_cache().service(self.creds)
+    
+    def _pool(self):
+        """
+        Pooled HTTP connections of the current credential
+        
+        The service object only builds requests and is shared by every thread;
+        each execute() runs on a connection checked out of this pool.
+        """
+        return get_service_cache().pool(self.creds)
+    
+    def _execute(self, request):
+        """Run an API request or batch on a pooled keep-alive connection"""
+        with self._pool().connection() as http:
+            self.round_trips += 1
+            return request.execute(http=http)
     
     def _get_user_info(self):
         """Get user email from Gmail profile"""
         try:
-            profile = self.service.users().getProfile(userId='me').execute()
-            self.user_email = profile.get('emailAddress')
+            self.user_email = get_service_cache().user_email(self.creds)
         except Exception as e:
             print(f"Error getting user info: {e}")
     
@@ -115,6 +367,7 @@ class GmailOAuth:
             self._save_credentials()
             
             # Initialize service
+            get_service_cache().register(self.creds, TOKEN_FILE)
             self._init_service()
             self._get_user_info()
             
@@ -127,81 +380,124 @@ class GmailOAuth:
         """Remove saved credentials"""
         if os.path.exists(TOKEN_FILE):
             os.remove(TOKEN_FILE)
+        if self.creds is not None:
+            get_service_cache().forget(self.creds)
         self.creds = None
         self.service = None
         self.user_email = None
     
-    def send_email(self, to_email, subject, body_html, attachments=None):
+    def send_email(self, to_email, subject, body_html, attachments=None, throttle=True, message_id=None):
         """
         Send an email using Gmail API
-        attachments: list of (filename, file_content_bytes, mime_type) or streamlit UploadedFile objects
+        attachments: list of (filename, file_content_bytes, mime_type), streamlit UploadedFile
+                     objects or PreparedAttachments from prepare_attachments()
+        throttle: wait for the adaptive throttle and the shared rate limiter, and report
+                  the outcome to the throttle (False when the caller does both)
+        message_id: optional fixed Message-ID header (see mime_message.build_message)
+        
+        Returns a SendResult: (success, message) with the error kind of a failure
         """
         if not self.is_authenticated():
-            return False, "Gmail'e bağlı değil!"
+            return SendResult(False, "Gmail'e bağlı değil!", PERMANENT)
         
         try:
-            # Create message
-            message = MIMEMultipart('mixed')
-            message['to'] = to_email
-            message['subject'] = subject
-            
-            # Message body
-            msg_alternative = MIMEMultipart('alternative')
-            message.attach(msg_alternative)
-            msg_alternative.attach(MIMEText(body_html, 'html', 'utf-8'))
-            
-            # Handle attachments
-            if attachments:
-                from email.mime.base import MIMEBase
-                from email import encoders
-                import mimetypes
-                
-                for attachment in attachments:
-                    # Determine filename and content
-                    if hasattr(attachment, 'name') and hasattr(attachment, 'read'):
-                        # Streamlit UploadedFile
-                        filename = attachment.name
-                        content = attachment.getvalue()
-                        ctype = attachment.type
-                    else:
-                        # (filename, content, type) tuple
-                        filename, content, ctype = attachment
-                        
-                    if not ctype:
-                        ctype, encoding = mimetypes.guess_type(filename)
-                        if ctype is None or encoding is not None:
-                            # No guess could be made, or the file is encoded (compressed), so
-                            # use a generic bag-of-bits type.
-                            ctype = 'application/octet-stream'
-                            
-                    main_type, sub_type = ctype.split('/', 1)
-                    
-                    part = MIMEBase(main_type, sub_type)
-                    part.set_payload(content)
-                    encoders.encode_base64(part)
-                    
-                    part.add_header(
-                        'Content-Disposition',
-                        f'attachment; filename="{filename}"'
-                    )
-                    message.attach(part)
-            
-            # Encode for Gmail API
-            raw = base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
-            
-            # Send
-            self.service.users().messages().send(
-                userId='me',
-                body={'raw': raw}
-            ).execute()
-            
-            return True, "✅ Gönderildi"
-            
+            if throttle:
+                get_throttle().wait()
+                get_rate_limiter().wait()
+        except DailyQuotaExceeded as e:
+            return SendResult(False, f"⛔ {str(e)}", QUOTA)
+        
+        result = self._send(to_email, subject, body_html, attachments, message_id)
+        if throttle:
+            get_throttle().record(result.error_kind, result.retry_after)
+            if not result.success:
+                # Not sent: its slot does not count against the daily quota
+                get_rate_limiter().refund()
+        return result
+    
+    def _send(self, to_email, subject, body_html, attachments, message_id=None):
+        """One Gmail API send, errors classified"""
+        try:
+            raw = self._raw(to_email, subject, body_html, attachments, message_id)
+            self._execute(self._send_request(raw))
+            return SendResult(True, "✅ Gönderildi")
+        except Exception as e:
+            return self._failure(e)
+    
+    @staticmethod
+    def _raw(to_email, subject, body_html, attachments, message_id):
+        """Message encoded for the Gmail API (prepared attachments are reused as they are)"""
+        message = build_message(None, to_email, subject, body_html, attachments, message_id)
+        return base64.urlsafe_b64encode(message).decode('ascii')
+    
+    def _send_request(self, raw):
+        return self.service.users().messages().send(userId='me', body={'raw': raw})
+    
+    @staticmethod
+    def _failure(error):
+        """SendResult for a failed send, classified by classify_gmail_error"""
+        error_msg = str(error)
+        kind, retry_after = classify_gmail_error(error)
+        if 'insufficient' in error_msg.lower():
+            return SendResult(False, "❌ Gmail API yetkisi yetersiz. Scopes kontrol et.", PERMANENT)
+        if kind == QUOTA:
+            return SendResult(False, f"⛔ Gmail gönderim limiti: {error_msg}", QUOTA, retry_after)
+        if kind in (TRANSIENT, DISCONNECTED):
+            return SendResult(False, f"⏳ Geçici hata: {error_msg}", kind, retry_after)
+        return SendResult(False, f"❌ Gönderim hatası: {error_msg}", PERMANENT)
+    
+    def send_batch(self, messages, attachments=None, batch_size=GMAIL_BATCH_SIZE):
+        """
+        Send several messages with one Gmail API batch request per batch_size messages
+        
+        messages: list of (to_email, subject, body_html, message_id or None)
+        Returns one SendResult per message, in order; every item of a batch succeeds
+        or fails on its own. There is no rate limiting or retrying here:
+        AsyncSendEngine reserves the slots for a whole batch and puts transient
+        failures into its next batch. Messages larger than GMAIL_BATCH_MAX_BYTES
+        go in a request of their own.
+        """
+        if not self.is_authenticated():
+            return [SendResult(False, "Gmail'e bağlı değil!", PERMANENT)] * len(messages)
+        
+        results = [None] * len(messages)
+        batchable = []
+        for idx, (to_email, subject, body_html, message_id) in enumerate(messages):
+            try:
+                raw = self._raw(to_email, subject, body_html, attachments, message_id)
+            except Exception as e:
+                results[idx] = self._failure(e)
+                continue
+            if len(raw) > GMAIL_BATCH_MAX_BYTES:
+                try:
+                    self._execute(self._send_request(raw))
+                    results[idx] = SendResult(True, "✅ Gönderildi")
+                except Exception as e:
+                    results[idx] = self._failure(e)
+            else:
+                batchable.append((idx, raw))
+        
+        for start in range(0, len(batchable), batch_size):
+            self._send_one_batch(batchable[start:start + batch_size], results)
+        return results
+    
+    def _send_one_batch(self, items, results):
+        """One batch HTTP request; fills results[idx] for each (idx, raw) item"""
+        def on_response(request_id, response, exception):
+            idx = int(request_id)
+            results[idx] = self._failure(exception) if exception else SendResult(True, "✅ Gönderildi")
+        
+        batch = self.service.new_batch_http_request(callback=on_response)
+        for idx, raw in items:
+            batch.add(self._send_request(raw), request_id=str(idx))
+        try:
+            self._execute(batch)
         except Exception as e:
-            error_msg = str(e)
-            if 'insufficient' in error_msg.lower():
-                return False, "❌ Gmail API yetkisi yetersiz. Scopes kontrol et."
-            return False, f"❌ Gönderim hatası: {error_msg}"
+            # The batch request itself failed (connection, 429 on the batch): every item shares it
+            failure = self._failure(e)
+            for idx, _ in items:
+                if results[idx] is None:
+                    results[idx] = failure
 
 
 def create_credentials_template():
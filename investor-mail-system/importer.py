@@ -0,0 +1,244 @@
+"""
+Investor Mail System - Investor Importer
+Excel/CSV and LinkedIn export import into the investors table
+
+Developed by: emirgunyy & gktrk363
+"""
+import os
+import hashlib
+import pandas as pd
+from openpyxl import load_workbook
+from config import IMPORT_CHUNK_SIZE
+from database import (
+    bulk_upsert_investors, db_connection, start_import_job, record_import_chunk,
+    finish_import_job, delete_import_job, get_import_job
+)
+
+# Accepted spreadsheet headers per investor field (first non-empty one wins)
+STANDARD_COLUMNS = {
+    'name': ['İsim', 'Name'],
+    'email': ['Email', 'E-posta'],
+    'company': ['Şirket', 'Company'],
+    'category': ['Kategori', 'Category'],
+    'notes': ['Notlar', 'Notes'],
+    'phone': ['Telefon', 'Phone'],
+    'linkedin': ['LinkedIn'],
+}
+
+IMPORT_TYPES = ('standard', 'linkedin')
+
+
+def _clean(series):
+    """Turn a column into stripped strings with '' for missing cells"""
+    return series.fillna('').astype(str).str.strip()
+
+
+def _pick_column(df, aliases, default=''):
+    """Merge alias columns left to right, falling back to default for empty cells"""
+    values = None
+    for alias in aliases:
+        if alias in df.columns:
+            column = _clean(df[alias])
+            values = column if values is None else values.mask(values == '', column)
+
+    if values is None:
+        return pd.Series(default, index=df.index, dtype=object)
+    if default:
+        values = values.mask(values == '', default)
+    return values
+
+
+def _standard_fields(df):
+    """Map a standard Excel/CSV sheet to investor fields"""
+    fields = {field: _pick_column(df, aliases) for field, aliases in STANDARD_COLUMNS.items()}
+    fields['category'] = fields['category'].mask(fields['category'] == '', 'GENEL')
+    return fields
+
+
+def _linkedin_fields(df):
+    """Map a LinkedIn Connections.csv export to investor fields"""
+    first = _pick_column(df, ['First Name'])
+    last = _pick_column(df, ['Last Name'])
+    return {
+        'name': (first + ' ' + last).str.strip(),
+        'email': _pick_column(df, ['Email Address']),
+        'company': _pick_column(df, ['Company']),
+        'category': pd.Series('GENEL', index=df.index, dtype=object),
+        'notes': 'LinkedIn Import. Position: ' + _pick_column(df, ['Position']),
+        'phone': pd.Series('', index=df.index, dtype=object),
+        'linkedin': _pick_column(df, ['URL']),  # Some exports have URL
+    }
+
+
+def dataframe_to_investor_rows(df, import_type='standard'):
+    """
+    Build bulk insert rows from a DataFrame, column by column (no iterrows)
+
+    Returns (rows, invalid) where rows are ordered like database.INVESTOR_IMPORT_COLUMNS
+    and invalid counts rows without a name or email.
+    """
+    if import_type not in IMPORT_TYPES:
+        raise ValueError(f"Unknown import type: {import_type}")
+
+    fields = _standard_fields(df) if import_type == 'standard' else _linkedin_fields(df)
+    valid = (fields['name'] != '') & (fields['email'] != '')
+
+    rows = list(zip(
+        fields['name'][valid],
+        fields['email'][valid],
+        fields['company'][valid],
+        fields['category'][valid],
+        fields['notes'][valid],
+        fields['phone'][valid],
+        fields['linkedin'][valid],
+        ['NEW'] * int(valid.sum()),
+        [''] * int(valid.sum()),
+    ))
+    return rows, int((~valid).sum())
+
+
+def import_dataframe(df, import_type='standard', on_conflict='skip'):
+    """
+    Import a whole DataFrame in one transaction
+
+    Returns {'added': n, 'updated': n, 'skipped': n, 'invalid': n}
+    """
+    rows, invalid = dataframe_to_investor_rows(df, import_type)
+    result = bulk_upsert_investors(rows, on_conflict)
+    result['invalid'] = invalid
+    return result
+
+
+def read_investor_file(uploaded_file, import_type='standard'):
+    """Read an uploaded CSV/XLSX file as strings (keeps phone numbers and zip codes intact)"""
+    if import_type == 'linkedin':
+        df = pd.read_csv(uploaded_file, skiprows=2, dtype=str)  # LinkedIn csv often has header text
+        if 'Email Address' not in df.columns:
+            # Try reloading without skiprows if failed
+            uploaded_file.seek(0)
+            df = pd.read_csv(uploaded_file, dtype=str)
+        return df
+
+    if uploaded_file.name.endswith('.csv'):
+        return pd.read_csv(uploaded_file, dtype=str)
+    return pd.read_excel(uploaded_file, dtype=str)
+
+
+# ============ STREAMING IMPORT ============
+
+def file_fingerprint(fileobj, block_size=1024 * 1024):
+    """Hash a file block by block (identifies it for resuming) and rewind it"""
+    digest = hashlib.sha256()
+    fileobj.seek(0)
+    for block in iter(lambda: fileobj.read(block_size), b''):
+        digest.update(block)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+
+def _file_size(fileobj):
+    """Size of a seekable file object in bytes"""
+    position = fileobj.tell()
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell()
+    fileobj.seek(position)
+    return size
+
+
+def _linkedin_skiprows(fileobj):
+    """LinkedIn exports often start with a notice above the real header"""
+    header = pd.read_csv(fileobj, skiprows=2, nrows=0, dtype=str)
+    fileobj.seek(0)
+    return 2 if 'Email Address' in header.columns else 0
+
+
+def _cell_to_str(value):
+    """Excel cell value as text (whole-number floats lose their .0)"""
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def iter_csv_chunks(fileobj, chunk_size=IMPORT_CHUNK_SIZE, skiprows=0):
+    """Yield a CSV file as DataFrames of at most chunk_size rows"""
+    with pd.read_csv(fileobj, chunksize=chunk_size, dtype=str, skiprows=skiprows) as reader:
+        for chunk in reader:
+            yield chunk
+
+
+def iter_xlsx_chunks(fileobj, chunk_size=IMPORT_CHUNK_SIZE):
+    """Yield the first sheet of an XLSX file as DataFrames, reading rows lazily"""
+    workbook = load_workbook(fileobj, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [_cell_to_str(cell) for cell in header]
+        width = len(columns)
+
+        chunk = []
+        for row in rows:
+            values = [_cell_to_str(cell) for cell in row[:width]]
+            values += [''] * (width - len(values))
+            chunk.append(values)
+            if len(chunk) >= chunk_size:
+                yield pd.DataFrame(chunk, columns=columns)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=columns)
+    finally:
+        workbook.close()
+
+
+def stream_import(fileobj, filename, import_type='standard', on_conflict='skip',
+                  chunk_size=IMPORT_CHUNK_SIZE, progress_callback=None):
+    """
+    Import a CSV/XLSX file of any size chunk by chunk with bounded memory
+    
+    Each chunk is written together with the job progress in one transaction, so an
+    interrupted import continues after the last committed chunk when the same file
+    is uploaded again. A file that was fully imported before is imported again.
+    
+    progress_callback(rows_done, fraction): called after every chunk, fraction is
+    None when the total size is unknown (XLSX)
+    Returns the import job dict with cumulative added/updated/skipped/invalid counts
+    """
+    file_key = file_fingerprint(fileobj)
+    job = start_import_job(file_key, filename, import_type, chunk_size)
+    if job['status'] == 'done':
+        delete_import_job(job['id'])
+        job = start_import_job(file_key, filename, import_type, chunk_size)
+
+    # Resume with the chunk boundaries the job started with
+    chunk_size = job['chunk_size']
+    rows_committed = job['rows_committed']
+
+    if filename.lower().endswith('.xlsx'):
+        chunks = iter_xlsx_chunks(fileobj, chunk_size)
+        total_size = None
+    else:
+        skiprows = _linkedin_skiprows(fileobj) if import_type == 'linkedin' else 0
+        chunks = iter_csv_chunks(fileobj, chunk_size, skiprows)
+        total_size = _file_size(fileobj)
+
+    rows_done = 0
+    for chunk in chunks:
+        rows_done += len(chunk)
+        if rows_done <= rows_committed:
+            continue  # Committed before the interruption
+
+        rows, invalid = dataframe_to_investor_rows(chunk, import_type)
+        with db_connection():
+            result = bulk_upsert_investors(rows, on_conflict)
+            result['invalid'] = invalid
+            record_import_chunk(job['id'], len(chunk), result)
+
+        if progress_callback:
+            fraction = min(fileobj.tell() / total_size, 1.0) if total_size else None
+            progress_callback(rows_done, fraction)
+
+    finish_import_job(job['id'])
+    return get_import_job(file_key)
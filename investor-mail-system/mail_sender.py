@@ -1,21 +1,33 @@
 """
 Investor Mail System - Mail Sender
-Gmail SMTP integration with rate limiting
+Gmail SMTP integration with rate limiting and adaptive throttling
 
 Developed by: emirgunyy & gktrk363
 """
 import smtplib
 import time
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from config import SMTP_SERVER, SMTP_PORT, RATE_LIMIT_SECONDS
+import queue
+import threading
+from collections import deque
+from config import SMTP_SERVER, SMTP_PORT, SMTP_POOL_SIZE, SMTP_HEALTH_CHECK_SECONDS, MAX_SEND_ATTEMPTS
+from mime_message import message_chunks, smtp_data_chunks, prepare_attachments, close_attachments
+from rate_limiter import (
+    DailyQuotaExceeded, get_rate_limiter, get_throttle,
+    SendResult, smtp_failure, DISCONNECTED, QUOTA
+)
 
 
 class MailSender:
-    def __init__(self, email, app_password):
-        """Initialize mail sender with Gmail credentials"""
+    def __init__(self, email, app_password, server=SMTP_SERVER, port=SMTP_PORT, starttls=True, rate_limiter=None,
+                 throttle=None):
+        """Initialize mail sender with Gmail credentials (server/port/starttls for local test servers)"""
         self.email = email
         self.app_password = app_password
+        self.server = server
+        self.port = port
+        self.starttls = starttls
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+        self.throttle = throttle or get_throttle()
         self.smtp = None
         self.is_connected = False
         self.last_send_time = 0
@@ -23,9 +35,11 @@ class MailSender:
     def connect(self):
         """Connect to Gmail SMTP server"""
         try:
-            self.smtp = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-            self.smtp.starttls()
-            self.smtp.login(self.email, self.app_password)
+            self.smtp = smtplib.SMTP(self.server, self.port)
+            if self.starttls:
+                self.smtp.starttls()
+            if self.app_password:
+                self.smtp.login(self.email, self.app_password)
             self.is_connected = True
             return True, "Gmail'e başarıyla bağlanıldı!"
         except smtplib.SMTPAuthenticationError:
@@ -54,140 +68,369 @@ class MailSender:
             return False
     
     def _rate_limit(self):
-        """Apply rate limiting between emails"""
-        elapsed = time.time() - self.last_send_time
-        if elapsed < RATE_LIMIT_SECONDS:
-            time.sleep(RATE_LIMIT_SECONDS - elapsed)
+        """Apply rate limiting between emails (adaptive backoff, then the shared bucket)"""
+        self.throttle.wait()
+        self.rate_limiter.wait()
         self.last_send_time = time.time()
     
-    def send_email(self, to_email, to_name, subject, body_html, attachments=None):
+    def send_email(self, to_email, to_name, subject, body_html, attachments=None, message_id=None):
         """
         Send a single email
-        attachments: list of (filename, file_content_bytes, mime_type) or streamlit UploadedFile objects
+        attachments: list of (filename, file_content_bytes, mime_type), streamlit UploadedFile
+                     objects or PreparedAttachments from prepare_attachments()
+        message_id: optional fixed Message-ID header (see mime_message.build_message)
+        
+        Returns a SendResult: (success, message) with error_kind telling transient
+        errors (421/450/454, dropped connection) apart from permanent ones. Every
+        outcome is fed back to the adaptive throttle.
         """
         if not self.is_connected:
-            return False, "SMTP bağlantısı yok!"
+            return SendResult(False, "SMTP bağlantısı yok!", DISCONNECTED)
         
-        # Rate limit
-        self._rate_limit()
+        try:
+            # Rate limit (adaptive backoff, shared bucket and daily quota)
+            self._rate_limit()
+        except DailyQuotaExceeded as e:
+            return SendResult(False, f"⛔ {str(e)}", QUOTA)
         
+        prepared = []
         try:
-            # Create message
-            msg = MIMEMultipart('mixed')
-            msg['From'] = self.email
-            msg['To'] = to_email
-            msg['Subject'] = subject
-            
-            # Message body
-            msg_alternative = MIMEMultipart('alternative')
-            msg.attach(msg_alternative)
-            msg_alternative.attach(MIMEText(body_html, 'html', 'utf-8'))
-            
-            # Handle attachments
-            if attachments:
-                from email.mime.base import MIMEBase
-                from email import encoders
-                import mimetypes
-                
-                for attachment in attachments:
-                    # Determine filename and content
-                    if hasattr(attachment, 'name') and hasattr(attachment, 'read'):
-                        # Streamlit UploadedFile
-                        filename = attachment.name
-                        content = attachment.getvalue()
-                        ctype = attachment.type
-                    else:
-                        # (filename, content, type) tuple
-                        filename, content, ctype = attachment
-                        
-                    if not ctype:
-                        ctype, encoding = mimetypes.guess_type(filename)
-                        if ctype is None or encoding is not None:
-                            ctype = 'application/octet-stream'
-                            
-                    main_type, sub_type = ctype.split('/', 1)
-                    
-                    part = MIMEBase(main_type, sub_type)
-                    part.set_payload(content)
-                    encoders.encode_base64(part)
-                    
-                    part.add_header(
-                        'Content-Disposition',
-                        f'attachment; filename="{filename}"'
-                    )
-                    msg.attach(part)
+            # Create message (prepared attachments are reused as they are)
+            prepared = prepare_attachments(attachments)
+            chunks = message_chunks(self.email, to_email, subject, body_html, prepared, message_id)
             
             # Send
-            self.smtp.sendmail(self.email, to_email, msg.as_string())
-            
-            return True, "✅ Gönderildi"
+            self._sendmail(to_email, chunks)
         
-        except smtplib.SMTPRecipientsRefused:
-            return False, "❌ Geçersiz mail adresi"
-        except smtplib.SMTPServerDisconnected:
-             self.is_connected = False
-             return False, "❌ SMTP bağlantısı koptu"
         except Exception as e:
-            return False, f"❌ Hata: {str(e)}"
+            if isinstance(e, (smtplib.SMTPServerDisconnected, ConnectionError)):
+                self.is_connected = False
+            result = smtp_failure(e)
+            self.throttle.record(result.error_kind)
+            # Not sent: its slot does not count against the daily quota
+            self.rate_limiter.refund()
+            return result
+        finally:
+            # Only the ones prepared for this message; the caller's stay open
+            close_attachments([a for a in prepared if a not in (attachments or [])])
+        
+        self.throttle.record()
+        return SendResult(True, "✅ Gönderildi")
     
-    def send_bulk(self, recipients, subject, body_template, template_engine, progress_callback=None, attachments=None):
+    def _sendmail(self, to_email, chunks):
+        """
+        smtplib's sendmail for mime_message.message_chunks
+        
+        The DATA stream is written chunk by chunk, so a spooled attachment goes from
+        its mmap to the socket without a per-message copy. Errors are raised as the
+        same smtplib exceptions sendmail raises.
+        """
+        smtp = self.smtp
+        smtp.ehlo_or_helo_if_needed()
+        code, resp = smtp.mail(self.email)
+        if code != 250:
+            self._abort(code)
+            raise smtplib.SMTPSenderRefused(code, resp, self.email)
+        code, resp = smtp.rcpt(to_email)
+        if code not in (250, 251):
+            self._abort(code)
+            raise smtplib.SMTPRecipientsRefused({to_email: (code, resp)})
+        code, resp = smtp.docmd('data')
+        if code != 354:
+            self._abort(code)
+            raise smtplib.SMTPDataError(code, resp)
+        for chunk in smtp_data_chunks(chunks):
+            smtp.send(chunk)
+        smtp.send(b'.\r\n')
+        code, resp = smtp.getreply()
+        if code != 250:
+            self._abort(code)
+            raise smtplib.SMTPDataError(code, resp)
+    
+    def _abort(self, code):
+        """After a refused command: 421 closes the session, anything else resets the transaction"""
+        if code == 421:
+            self.smtp.close()
+            return
+        try:
+            self.smtp.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
+    
+    def send_bulk(self, recipients, subject, body_template, template_engine=None, progress_callback=None, attachments=None):
         """
         Send bulk emails with personalization
         
         recipients: list of dicts with 'email', 'name', 'company' etc.
         body_template: Jinja2 template string
-        template_engine: function to render template
+        template_engine: optional function to render template per recipient
+                         (default: template_engine.render_batch, compiled once)
         progress_callback: function to call with progress updates
-        attachments: list of files to attach to all emails
+        attachments: list of files to attach to all emails (encoded once for the whole list)
+        
+        Transient failures go to the back of the queue and are tried again, up to
+        MAX_SEND_ATTEMPTS times; results keep the recipient order.
         """
+        from database import is_unsubscribed
+        
         results = []
+        retries = deque()
         total = len(recipients)
+        done = 0
         
-        for idx, recipient in enumerate(recipients):
-            recipient_email = recipient.get('email', '')
-            
-            # Check unsubscribe status
-            from database import is_unsubscribed
-            if is_unsubscribed(recipient_email):
-                results.append({
-                    'recipient': recipient,
-                    'success': False,
-                    'message': "⚠️ Kullanıcı abonelikten çıkmış (Unsubscribed)"
-                })
-                continue
-            
-            # Render personalized body
-            try:
-                body_html = template_engine(body_template, recipient)
-                rendered_subject = template_engine(subject, recipient)
-            except Exception as e:
-                results.append({
-                    'recipient': recipient,
-                    'success': False,
-                    'message': f"❌ Şablon hatası: {str(e)}"
-                })
-                continue
-            
-            # Send email
-            success, message = self.send_email(
+        if template_engine is None:
+            from template_engine import render_batch
+            rendered = render_batch(body_template, subject, recipients, return_errors=True, as_bytes=True)
+        else:
+            rendered = self._render_each(recipients, subject, body_template, template_engine)
+        
+        def deliver(slot, recipient, rendered_subject, body_html, attempts):
+            nonlocal done
+            success, message = result = self.send_email(
                 to_email=recipient.get('email', ''),
                 to_name=recipient.get('name', ''),
                 subject=rendered_subject,
                 body_html=body_html,
                 attachments=attachments
             )
+            if result.transient and attempts < MAX_SEND_ATTEMPTS:
+                retries.append((slot, recipient, rendered_subject, body_html, attempts + 1))
+                return
             
-            results.append({
+            results[slot] = {
                 'recipient': recipient,
                 'success': success,
                 'message': message
-            })
+            }
+            done += 1
             
             # Progress callback
             if progress_callback:
-                progress_callback(idx + 1, total, recipient, success, message)
+                progress_callback(done, total, recipient, success, message)
+        
+        # Encode attachments once for the whole list
+        attachments = prepare_attachments(attachments)
+        try:
+            for recipient, rendered_subject, body_html in rendered:
+                recipient_email = recipient.get('email', '')
+                
+                # Check unsubscribe status
+                if is_unsubscribed(recipient_email):
+                    results.append({
+                        'recipient': recipient,
+                        'success': False,
+                        'message': "⚠️ Kullanıcı abonelikten çıkmış (Unsubscribed)"
+                    })
+                    done += 1
+                    continue
+                
+                # Rendering failed for this recipient
+                if rendered_subject is None:
+                    results.append({
+                        'recipient': recipient,
+                        'success': False,
+                        'message': f"❌ Şablon hatası: {str(body_html)}"
+                    })
+                    done += 1
+                    continue
+                
+                # Send email
+                results.append(None)
+                deliver(len(results) - 1, recipient, rendered_subject, body_html, 1)
+            
+            # Requeued transient failures (the throttle's backoff applies before each)
+            while retries:
+                deliver(*retries.popleft())
+        finally:
+            close_attachments(attachments)
         
         return results
+    
+    @staticmethod
+    def _render_each(recipients, subject, body_template, template_engine):
+        """Render with a custom per-recipient function, yielding like render_batch"""
+        for recipient in recipients:
+            try:
+                body_html = template_engine(body_template, recipient)
+                rendered_subject = template_engine(subject, recipient)
+            except Exception as e:
+                yield recipient, None, e
+                continue
+            yield recipient, rendered_subject, body_html
+
+
+class MailSenderPool:
+    """
+    N authenticated SMTP sessions sending one campaign in parallel
+    
+    Worker threads take messages from a shared queue. All sessions share one
+    RateLimiter and AdaptiveThrottle, so the configured rate and any backoff hold
+    for the pool as a whole. Sessions idle for longer than health_check_seconds
+    are checked with NOOP before use, and dropped sessions reconnect transparently.
+    Transient failures are put back on the queue, up to MAX_SEND_ATTEMPTS tries.
+    """
+    
+    def __init__(self, email, app_password, size=SMTP_POOL_SIZE, server=SMTP_SERVER, port=SMTP_PORT,
+                 starttls=True, rate_limiter=None, health_check_seconds=SMTP_HEALTH_CHECK_SECONDS, throttle=None):
+        self.email = email
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+        self.throttle = throttle or get_throttle()
+        self.health_check_seconds = health_check_seconds
+        self.senders = [
+            MailSender(email, app_password, server, port, starttls, self.rate_limiter, self.throttle)
+            for _ in range(size)
+        ]
+        self._last_used = [0.0] * size
+        self.reconnects = 0
+    
+    @property
+    def is_connected(self):
+        """True while at least one session is up"""
+        return any(sender.is_connected for sender in self.senders)
+    
+    def connect(self):
+        """Open and authenticate every session"""
+        for sender in self.senders:
+            success, message = sender.connect()
+            if not success:
+                self.disconnect()
+                return False, message
+        self._last_used = [time.monotonic()] * len(self.senders)
+        return True, f"Gmail'e {len(self.senders)} bağlantı ile bağlanıldı!"
+    
+    def disconnect(self):
+        """Close every session"""
+        for sender in self.senders:
+            sender.disconnect()
+    
+    def _ensure_connected(self, index):
+        """Health-check an idle session and reconnect it if it is gone"""
+        sender = self.senders[index]
+        idle = time.monotonic() - self._last_used[index]
+        if sender.is_connected and idle > self.health_check_seconds:
+            sender.test_connection()
+        if not sender.is_connected:
+            sender.disconnect()
+            success, _ = sender.connect()
+            if success:
+                self.reconnects += 1
+        return sender.is_connected
+    
+    def _send(self, index, to_email, to_name, subject, body_html, attachments):
+        """Send on one session, reconnecting and retrying once if it dropped"""
+        sender = self.senders[index]
+        if not self._ensure_connected(index):
+            return SendResult(False, "SMTP bağlantısı yok!", DISCONNECTED)
+        
+        result = sender.send_email(to_email, to_name, subject, body_html, attachments)
+        if not result.success and not sender.test_connection() and self._ensure_connected(index):
+            result = sender.send_email(to_email, to_name, subject, body_html, attachments)
+        
+        self._last_used[index] = time.monotonic()
+        return result
+    
+    def _worker(self, index, jobs, results, stopped):
+        """Send queued messages until the None sentinel; once stopped is set they are discarded unsent"""
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            if stopped.is_set():
+                continue
+            idx, recipient, subject, body_html, attachments, attempts = job
+            try:
+                result = self._send(
+                    index, recipient.get('email', ''), recipient.get('name', ''), subject, body_html, attachments
+                )
+            except Exception as e:
+                result = SendResult(False, f"❌ Hata: {str(e)}")
+            results.put((idx, recipient, result, job))
+    
+    def _produce(self, recipients, rendered, attachments, jobs, results, stopped):
+        """Queue rendered messages until stopped is set; unsubscribed and template errors go straight to results"""
+        from database import is_unsubscribed
+        
+        queued = 0
+        try:
+            for idx, (recipient, rendered_subject, body_html) in enumerate(rendered):
+                if stopped.is_set():
+                    return
+                if is_unsubscribed(recipient.get('email', '')):
+                    results.put((idx, recipient, SendResult(False, "⚠️ Kullanıcı abonelikten çıkmış (Unsubscribed)"), None))
+                elif rendered_subject is None:
+                    results.put((idx, recipient, SendResult(False, f"❌ Şablon hatası: {str(body_html)}"), None))
+                else:
+                    jobs.put((idx, recipient, rendered_subject, body_html, attachments, 1))
+                queued = idx + 1
+        except Exception as e:
+            # Fail the rest of the list instead of leaving send_bulk waiting
+            for rest in range(queued, len(recipients)):
+                results.put((rest, recipients[rest], SendResult(False, f"❌ Hata: {str(e)}"), None))
+    
+    def send_bulk(self, recipients, subject, body_template, template_engine=None, progress_callback=None, attachments=None):
+        """
+        Send bulk emails with personalization over all sessions
+        
+        Same arguments and results as MailSender.send_bulk (results keep the recipient
+        order). progress_callback runs on the calling thread, in completion order.
+        """
+        recipients = list(recipients)
+        total = len(recipients)
+        
+        if template_engine is None:
+            from template_engine import render_batch
+            rendered = render_batch(body_template, subject, recipients, return_errors=True, as_bytes=True)
+        else:
+            rendered = MailSender._render_each(recipients, subject, body_template, template_engine)
+        
+        attachments = prepare_attachments(attachments)
+        jobs = queue.Queue(maxsize=len(self.senders) * 2)
+        results = queue.Queue()
+        stopped = threading.Event()
+        
+        workers = [
+            threading.Thread(target=self._worker, args=(index, jobs, results, stopped), daemon=True)
+            for index in range(len(self.senders))
+        ]
+        producer = threading.Thread(
+            target=self._produce, args=(recipients, rendered, attachments, jobs, results, stopped), daemon=True
+        )
+        for thread in workers + [producer]:
+            thread.start()
+        
+        ordered = [None] * total
+        try:
+            done = 0
+            while done < total:
+                idx, recipient, result, job = results.get()
+                if job is not None and result.transient and job[-1] < MAX_SEND_ATTEMPTS:
+                    # Requeue; the shared throttle holds every worker back until the backoff ends
+                    jobs.put(job[:-1] + (job[-1] + 1,))
+                    continue
+                
+                done += 1
+                success, message = result
+                ordered[idx] = {
+                    'recipient': recipient,
+                    'success': success,
+                    'message': message
+                }
+                if progress_callback:
+                    progress_callback(done, total, recipient, success, message)
+        except BaseException:
+            # progress_callback raised (e.g. a Streamlit rerun): send nothing more, the workers
+            # discard what is queued, which also unblocks the producer
+            stopped.set()
+            raise
+        finally:
+            producer.join()
+            for _ in workers:
+                jobs.put(None)
+            for thread in workers:
+                thread.join()
+            close_attachments(attachments)
+        
+        return ordered
 
 
 def validate_email(email):
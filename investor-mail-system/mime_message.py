@@ -0,0 +1,223 @@
+"""
+Investor Mail System - MIME Message Builder
+Builds outgoing messages for SMTP and the Gmail API, with attachments encoded once per campaign
+
+Developed by: emirgunyy & gktrk363
+"""
+import re
+import base64
+import mimetypes
+import mmap
+import tempfile
+from email import base64mime
+from email.generator import BytesGenerator
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from email.mime.nonmultipart import MIMENonMultipart
+from email.policy import compat32
+from io import BytesIO
+from config import ATTACHMENT_SPOOL_THRESHOLD
+
+CRLF = b'\r\n'
+_LEADING_DOT = re.compile(rb'(?m)^\.')
+
+# Same header handling as MIMEMultipart.as_string(), with SMTP line endings
+_SMTP_POLICY = compat32.clone(linesep='\r\n')
+
+# base64 input per output line (57 bytes -> 76 characters) and per encoding step
+_LINE_BYTES = 57
+_ENCODE_BLOCK = _LINE_BYTES * 16384
+
+
+def html_part(body_html):
+    """
+    HTML body part; body_html may be str or UTF-8 bytes (e.g. render_batch(as_bytes=True))
+
+    Bytes are base64-encoded as they are, giving the same part as MIMEText(str, 'html', 'utf-8')
+    without decoding and re-encoding the body.
+    """
+    if isinstance(body_html, str):
+        return MIMEText(body_html, 'html', 'utf-8')
+    part = MIMENonMultipart('text', 'html', charset='utf-8')
+    part['Content-Transfer-Encoding'] = 'base64'
+    part.set_payload(base64mime.body_encode(body_html))
+    return part
+
+
+# ============ ATTACHMENTS ============
+
+class PreparedAttachment:
+    """
+    An attachment serialized once as a complete base64 MIME part
+
+    The encoded part is read-only and shared by every message of a campaign. Parts
+    larger than ATTACHMENT_SPOOL_THRESHOLD live in a memory-mapped temp file
+    instead of the Python heap; SMTP sends write them to the socket from there.
+    The Gmail API needs each message in one piece, so it still copies them (see
+    build_message).
+    """
+
+    __slots__ = ('filename', 'content_type', 'size', '_data', '_spool')
+
+    def __init__(self, filename, content, content_type=None, spool_threshold=ATTACHMENT_SPOOL_THRESHOLD):
+        if not content_type:
+            content_type, encoding = mimetypes.guess_type(filename)
+            if content_type is None or encoding is not None:
+                # No guess could be made, or the file is encoded (compressed), so
+                # use a generic bag-of-bits type.
+                content_type = 'application/octet-stream'
+
+        self.filename = filename
+        self.content_type = content_type
+        self.size = len(content)
+        self._spool = None
+
+        headers = self._headers()
+        if len(content) <= spool_threshold:
+            self._data = headers + b''.join(self._encode(content))
+        else:
+            self._spool = tempfile.TemporaryFile(prefix='attachment_')
+            self._spool.write(headers)
+            for block in self._encode(content):
+                self._spool.write(block)
+            self._spool.flush()
+            self._data = mmap.mmap(self._spool.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _headers(self):
+        """Part headers, as MIMEBase + encode_base64 + add_header would write them"""
+        main_type, sub_type = self.content_type.split('/', 1)
+        part = MIMENonMultipart(main_type, sub_type)
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.add_header('Content-Disposition', f'attachment; filename="{self.filename}"')
+        return part.as_bytes(policy=_SMTP_POLICY)  # headers + blank line (empty payload)
+
+    @staticmethod
+    def _encode(content):
+        """Yield base64 lines of 76 characters with CRLF endings, block by block"""
+        view = memoryview(content)
+        for start in range(0, len(view), _ENCODE_BLOCK):
+            encoded = base64.b64encode(view[start:start + _ENCODE_BLOCK])
+            yield CRLF.join(encoded[i:i + 76] for i in range(0, len(encoded), 76)) + CRLF
+
+    @property
+    def data(self):
+        """The encoded MIME part (bytes or a read-only mmap)"""
+        return self._data
+
+    @property
+    def spooled(self):
+        """True when the encoded part lives on disk"""
+        return self._spool is not None
+
+    def close(self):
+        """Release the spool file (in-memory parts need no cleanup)"""
+        if self._spool is not None:
+            self._data.close()
+            self._spool.close()
+            self._spool = None
+            self._data = b''
+
+
+def prepare_attachments(attachments):
+    """
+    Encode attachments once so every message of a campaign can reuse them
+
+    attachments: list of (filename, file_content_bytes, mime_type), streamlit UploadedFile
+                 objects or PreparedAttachments (kept as they are)
+    """
+    prepared = []
+    for attachment in attachments or []:
+        if isinstance(attachment, PreparedAttachment):
+            prepared.append(attachment)
+        elif hasattr(attachment, 'name') and hasattr(attachment, 'read'):
+            # Streamlit UploadedFile
+            prepared.append(PreparedAttachment(attachment.name, attachment.getvalue(), attachment.type))
+        else:
+            # (filename, content, type) tuple
+            filename, content, ctype = attachment
+            prepared.append(PreparedAttachment(filename, content, ctype))
+    return prepared
+
+
+def close_attachments(prepared):
+    """Release spooled attachments after a campaign"""
+    for attachment in prepared:
+        attachment.close()
+
+
+# ============ MESSAGES ============
+
+def message_chunks(from_email, to_email, subject, body_html, attachments=None, message_id=None):
+    """
+    Serialize a multipart/mixed message as a list of chunks with CRLF line endings
+
+    The headers and HTML body go through the email package; each prepared
+    attachment part is put in the list as the shared object itself (bytes or the
+    spool's mmap), so building a message copies no attachment. Senders write the
+    chunks one after the other (see smtp_data_chunks) instead of joining them.
+    attachments: PreparedAttachments (see prepare_attachments); the chunks refer to
+                 their data, so the caller keeps them open until the chunks are sent
+    message_id: fixed Message-ID header, so a resent copy (outbox retry) is the
+                same message to the receiving side
+    """
+    attachments = list(attachments or [])
+    if not all(isinstance(attachment, PreparedAttachment) for attachment in attachments):
+        raise TypeError("message_chunks needs PreparedAttachments (see prepare_attachments)")
+
+    msg = MIMEMultipart('mixed')
+    if from_email:
+        msg['From'] = from_email
+    msg['To'] = to_email
+    msg['Subject'] = subject
+    if message_id:
+        msg['Message-ID'] = message_id
+
+    # Message body
+    msg_alternative = MIMEMultipart('alternative')
+    msg.attach(msg_alternative)
+    msg_alternative.attach(html_part(body_html))
+
+    buffer = BytesIO()
+    BytesGenerator(buffer, mangle_from_=False, policy=_SMTP_POLICY).flatten(msg)
+    head = buffer.getvalue()
+    if not attachments:
+        return [head]
+
+    # Reopen the closing delimiter and append the shared attachment parts
+    boundary = msg.get_boundary().encode('ascii')
+    closing = b'--' + boundary + b'--' + CRLF
+    if not head.endswith(closing):
+        raise ValueError("Unexpected multipart layout")
+
+    chunks = [head[:-len(closing)]]
+    for attachment in attachments:
+        chunks += [b'--' + boundary + CRLF, attachment.data, CRLF]
+    chunks.append(closing)
+    return chunks
+
+
+def build_message(from_email, to_email, subject, body_html, attachments=None, message_id=None):
+    """
+    The whole message as one bytes object (see message_chunks)
+
+    This copies every attachment into a new object per message, spooled ones
+    included. Only for the Gmail API, whose raw field needs the complete message;
+    SMTP senders stream message_chunks instead. Raw attachments are prepared here
+    and closed again once they are copied.
+    """
+    prepared = prepare_attachments(attachments)
+    try:
+        return b''.join(message_chunks(from_email, to_email, subject, body_html, prepared, message_id))
+    finally:
+        close_attachments([a for a in prepared if a not in (attachments or [])])
+
+
+def smtp_data_chunks(chunks):
+    """
+    message_chunks dot-stuffed for the SMTP DATA command, without the final "."
+
+    Every chunk starts at the beginning of a line. Spooled attachment parts are
+    passed through as they are: headers and base64 lines never start with a dot.
+    """
+    for chunk in chunks:
+        yield _LEADING_DOT.sub(b'..', chunk) if isinstance(chunk, bytes) else chunk
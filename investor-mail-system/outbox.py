@@ -0,0 +1,224 @@
+"""
+Investor Mail System - Durable Outbox
+Campaigns are rendered into a persistent outbox and sent from there, so a send
+survives Streamlit reruns, closed tabs and restarts and resumes where it stopped
+
+Developed by: emirgunyy & gktrk363
+"""
+import os
+import uuid
+import asyncio
+import socket
+import hashlib
+from itertools import islice
+from config import OUTBOX_BATCH_SIZE, OUTBOX_LEASE_SECONDS, MAX_SEND_ATTEMPTS
+from database import (
+    db_connection, is_unsubscribed, log_sent_mail, create_campaign, get_campaign, add_campaign_attachment,
+    get_campaign_attachments, enqueue_outbox, claim_outbox_items, complete_outbox_item, release_outbox_item,
+    renew_outbox_leases, get_outbox_lease_owners, requeue_outbox_leases, finish_campaign,
+    hand_off_scheduled_mails, update_scheduled_mail_status
+)
+from mime_message import prepare_attachments, close_attachments
+from rate_limiter import QUOTA
+from async_sender import AsyncSendEngine, iterate_in_background
+
+ENQUEUE_CHUNK_SIZE = 500
+
+
+def idempotency_key(campaign_id, email):
+    """Key of one campaign message; the same address twice in a campaign maps to one message"""
+    return hashlib.sha256(f"{campaign_id}:{email.strip().lower()}".encode('utf-8')).hexdigest()[:32]
+
+
+def message_id(key):
+    """Message-ID header of an outbox message (the same for every retry of it)"""
+    return f"<{key}@investor-mail-system>"
+
+
+def worker_id():
+    """Lease owner name, unique per drain run"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def _is_dead_owner(owner):
+    """True for a worker_id() of a process on this machine that is no longer running"""
+    host, _, rest = owner.partition(':')
+    pid = rest.partition(':')[0]
+    # os.kill(pid, 0) only probes on POSIX (on Windows it would terminate the process)
+    if host != socket.gethostname() or not pid.isdigit() or os.name != 'posix':
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        return False
+    return False
+
+
+def _raw_attachments(attachments):
+    """(filename, content, content_type) tuples from tuples or streamlit UploadedFiles"""
+    for attachment in attachments or []:
+        if hasattr(attachment, 'name') and hasattr(attachment, 'read'):
+            yield attachment.name, attachment.getvalue(), attachment.type
+        else:
+            yield attachment
+
+
+def _outbox_rows(campaign_id, rendered):
+    """Outbox rows (database.OUTBOX_COLUMNS) from render_batch output"""
+    for recipient, subject, body in rendered:
+        email = recipient.get('email', '')
+        key = idempotency_key(campaign_id, email)
+        if is_unsubscribed(email):
+            yield (recipient.get('id'), email, subject, None, key, 'skipped',
+                   "⚠️ Kullanıcı abonelikten çıkmış (Unsubscribed)", None)
+        elif subject is None:
+            yield recipient.get('id'), email, None, None, key, 'skipped', f"❌ Şablon hatası: {str(body)}", None
+        else:
+            yield recipient.get('id'), email, subject, body, key, 'queued', None, None
+
+
+def enqueue_campaign(recipients, subject_template, body_template, template_id=None, attachments=None, footer=None):
+    """
+    Render a campaign into the outbox and return its campaign id
+    
+    Everything is written in one transaction, so a campaign is either fully queued
+    or not at all. Unsubscribed recipients and template errors are stored as
+    'skipped' with the reason, so the campaign accounts for every recipient.
+    """
+    from template_engine import render_batch
+    
+    with db_connection():
+        campaign_id = create_campaign(template_id, subject_template)
+        for filename, content, content_type in _raw_attachments(attachments):
+            add_campaign_attachment(campaign_id, filename, content_type, content)
+        
+        rendered = render_batch(body_template, subject_template, recipients, return_errors=True,
+                                footer=footer, as_bytes=True)
+        rows = _outbox_rows(campaign_id, rendered)
+        while True:
+            chunk = list(islice(rows, ENQUEUE_CHUNK_SIZE))
+            if not chunk:
+                break
+            enqueue_outbox(campaign_id, chunk)
+    return campaign_id
+
+
+def enqueue_scheduled_mails(mails, owner):
+    """
+    Move claimed, rendered scheduled mails into the outbox and return the new campaign ids
+    
+    One campaign per template. The mails become 'queued' in the same transaction,
+    and one whose lease was lost meanwhile is left out; its idempotency key comes
+    from the scheduled mail, so it is never in the outbox twice.
+    """
+    campaign_ids = []
+    with db_connection():
+        handed_off = set(hand_off_scheduled_mails([mail['id'] for mail in mails], owner))
+        by_template = {}
+        for mail in mails:
+            if mail['id'] in handed_off:
+                by_template.setdefault(mail['template_id'], []).append(mail)
+        for template_id, group in by_template.items():
+            campaign_id = create_campaign(template_id, f"⏰ Planlı gönderim ({len(group)} mail)")
+            enqueue_outbox(campaign_id, [
+                (mail['investor_id'], mail['investor_email'], mail['subject'],
+                 mail['body'].encode('utf-8') if isinstance(mail['body'], str) else mail['body'],
+                 idempotency_key(f"scheduled-{mail['id']}", mail['investor_email']), 'queued', None, mail['id'])
+                for mail in group
+            ])
+            campaign_ids.append(campaign_id)
+    return campaign_ids
+
+
+def _finish(item, owner, template_id, state, error_message):
+    """Commit a message's final state and its sent_mails entry (and scheduled mail) together"""
+    with db_connection():
+        if not complete_outbox_item(item['id'], owner, state, error_message):
+            print(f"Outbox message {item['id']}: lease lost, left to the worker that took it over")
+            return False
+        log_sent_mail(item['investor_id'], template_id, item['subject'], state, error_message)
+        if item['scheduled_mail_id'] is not None:
+            update_scheduled_mail_status(item['scheduled_mail_id'], state)
+        return True
+
+
+async def _renew_leases(owner, lease_seconds):
+    """Keep owner's leases from running out while its drain runs"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(lease_seconds / 3)
+        # A SQLite write that may wait on busy_timeout: keep it off the loop
+        await loop.run_in_executor(None, renew_outbox_leases, owner, lease_seconds)
+
+
+async def stream_outbox(transport, campaign_id, concurrency=None, rate_limiter=None, throttle=None,
+                        batch_size=OUTBOX_BATCH_SIZE, lease_seconds=OUTBOX_LEASE_SECONDS):
+    """
+    Send a campaign's queued messages and yield a result per finished message
+    
+    Messages are leased batch by batch and each outcome is committed before it
+    is yielded, so a crash loses at most the messages in flight (sent again with
+    the same Message-ID). Leases are short and renewed while the drain runs: a
+    drain that is closed or fails puts its leased messages back in the queue, the
+    leases of a dead process on this machine are taken back when the next drain
+    starts, and any other stale lease runs out after lease_seconds. Results are
+    the engine's dicts plus 'state' ('sent', 'failed' or 'queued' when the daily
+    quota stopped the run; the campaign then stays running and can be resumed later).
+    """
+    owner = worker_id()
+    template_id = get_campaign(campaign_id)['template_id']
+    stale = [lease_owner for lease_owner in get_outbox_lease_owners(campaign_id) if _is_dead_owner(lease_owner)]
+    if requeue_outbox_leases(campaign_id, stale):
+        print(f"Outbox campaign {campaign_id}: requeued the messages of stopped senders {stale}")
+    attachments = prepare_attachments(get_campaign_attachments(campaign_id))
+    renewer = asyncio.create_task(_renew_leases(owner, lease_seconds))
+    try:
+        async with AsyncSendEngine(transport, concurrency, rate_limiter, throttle) as engine:
+            while True:
+                items = claim_outbox_items(campaign_id, owner, batch_size, lease_seconds)
+                if not items:
+                    break
+                
+                messages = []
+                for item in items:
+                    if item['attempts'] > MAX_SEND_ATTEMPTS:
+                        # Claimed again and again by workers that died: give up on it
+                        error = "❌ Çok fazla deneme, gönderim yarıda kaldı"
+                        _finish(item, owner, template_id, 'failed', error)
+                        yield {'key': item['id'], 'recipient': item, 'subject': item['subject'], 'success': False,
+                               'message': error, 'error_kind': None, 'attempts': item['attempts'], 'state': 'failed'}
+                        continue
+                    messages.append((item['id'], item, item['to_email'], item['subject'], item['body'],
+                                     message_id(item['idempotency_key'])))
+                
+                quota_hit = False
+                async for result in engine.send_messages(messages, attachments):
+                    item = result['recipient']
+                    if result['error_kind'] == QUOTA:
+                        quota_hit = True
+                        release_outbox_item(item['id'], owner, result['message'])
+                        result['state'] = 'queued'
+                    else:
+                        result['state'] = 'sent' if result['success'] else 'failed'
+                        _finish(item, owner, template_id, result['state'],
+                                None if result['success'] else result['message'])
+                    yield result
+                
+                if quota_hit:
+                    break
+    finally:
+        renewer.cancel()
+        close_attachments(attachments)
+        # Closed or failed part way: what is still leased can be sent again right away
+        requeue_outbox_leases(campaign_id, [owner])
+    
+    finish_campaign(campaign_id)
+
+
+def run_outbox(transport, campaign_id, concurrency=None, rate_limiter=None, throttle=None):
+    """Synchronous iterator over stream_outbox results"""
+    return iterate_in_background(lambda: stream_outbox(
+        transport, campaign_id, concurrency, rate_limiter, throttle
+    ))
@@ -0,0 +1,344 @@
+"""
+Investor Mail System - Rate Limiting
+Token bucket for bursts plus a rolling 24h quota, shared by every send path and process,
+and adaptive throttling driven by the mail provider's responses
+
+Developed by: emirgunyy & gktrk363
+"""
+import time
+import random
+import asyncio
+import smtplib
+import threading
+from collections import deque
+from datetime import datetime
+from config import (
+    RATE_LIMIT_SECONDS, RATE_LIMIT_BURST, DAILY_LIMIT, THROTTLE_MIN_FACTOR, THROTTLE_DECREASE,
+    THROTTLE_INCREASE, BACKOFF_BASE_SECONDS, BACKOFF_MAX_SECONDS, THROTTLE_METRICS_WINDOW
+)
+
+
+class DailyQuotaExceeded(Exception):
+    """The rolling 24h send quota is used up"""
+
+    def __init__(self, retry_at):
+        self.retry_at = retry_at
+        super().__init__(f"Günlük gönderim limiti doldu, {format_time(retry_at)} sonrası tekrar dene")
+
+
+def format_time(timestamp):
+    """Unix time as local 'YYYY-MM-DD HH:MM'"""
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M')
+
+
+class RateLimiter:
+    """
+    Minimum interval between sends, in this process only (tests and benchmarks)
+
+    Each caller reserves the next free slot under a lock and sleeps outside it,
+    so N parallel senders together still send at most one mail per interval.
+    """
+
+    def __init__(self, interval=RATE_LIMIT_SECONDS):
+        self.interval = interval
+        self._next_slot = 0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take the next free slot, returning the seconds to wait for it"""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        return slot - now
+
+    def wait(self):
+        """Block until this caller's slot"""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def refund(self, count=1):
+        """No quota to give back here (see SendQuotaLimiter.refund)"""
+
+
+class SendQuotaLimiter:
+    """
+    Token bucket plus rolling 24h quota, persisted in SQLite
+
+    State lives in the database, so the UI, the scheduler and other processes all
+    draw from the same bucket and quota. Same reserve()/wait()/refund() interface
+    as RateLimiter; both raise DailyQuotaExceeded instead of waiting for hours.
+    A slot is charged when it is reserved; senders refund() the slots of sends
+    that did not go out, so only delivered mails count against the daily quota.
+    """
+
+    def __init__(self, interval=RATE_LIMIT_SECONDS, burst=RATE_LIMIT_BURST, daily_limit=DAILY_LIMIT):
+        self.interval = interval
+        self.burst = burst
+        self.daily_limit = daily_limit
+
+    def reserve(self):
+        """Take a slot, returning the seconds to wait for it"""
+        from database import reserve_send_slot
+        wait, retry_at = reserve_send_slot(self.interval, self.burst, self.daily_limit)
+        if wait is None:
+            raise DailyQuotaExceeded(retry_at)
+        return wait
+
+    def wait(self):
+        """Block until this caller's slot"""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def refund(self, count=1):
+        """Give back the quota of `count` reserved slots whose sends failed or will be retried"""
+        from database import refund_send_slots
+        refund_send_slots(count)
+
+    def status(self):
+        """How many can be sent now and today, and when the next slot is (see database.get_send_quota)"""
+        from database import get_send_quota
+        return get_send_quota(self.interval, self.burst, self.daily_limit)
+
+    def plan(self, count):
+        """
+        Estimate a campaign of `count` mails
+
+        Returns {'sendable': n that fit in the remaining quota, 'deferred': the rest,
+        'duration_seconds': time to send the sendable part at the current rate}
+        """
+        status = self.status()
+        sendable = min(count, status['remaining'])
+        return {
+            'sendable': sendable,
+            'deferred': count - sendable,
+            'duration_seconds': max(0.0, sendable - status['tokens']) * self.interval
+        }
+
+
+# One limiter for every send path (UI, pools, async engine, scheduler)
+_rate_limiter = SendQuotaLimiter()
+
+
+def get_rate_limiter():
+    """Get the shared, persisted rate limiter"""
+    return _rate_limiter
+
+
+# ============ SEND RESULTS ============
+
+# Error kinds: provider asked to slow down, connection lost, never retry, provider's daily quota used up
+TRANSIENT = 'transient'
+DISCONNECTED = 'disconnected'
+PERMANENT = 'permanent'
+QUOTA = 'quota'
+
+# SMTP replies that mean "try again later" (RFC 5321 4yz codes Gmail uses for throttling)
+TRANSIENT_SMTP_CODES = {421, 450, 451, 452, 454}
+
+
+class SendResult(tuple):
+    """
+    (success, message) as every send_email returns it, plus why it failed
+
+    Unpacks like the plain tuple; error_kind is TRANSIENT, DISCONNECTED, PERMANENT,
+    QUOTA or None on success, retry_after the pause the provider asked for (seconds).
+    """
+
+    def __new__(cls, success, message, error_kind=None, retry_after=None):
+        result = super().__new__(cls, (success, message))
+        result.error_kind = error_kind
+        result.retry_after = retry_after
+        return result
+
+    @property
+    def success(self):
+        return self[0]
+
+    @property
+    def message(self):
+        return self[1]
+
+    @property
+    def transient(self):
+        """Worth requeueing (a quota error only clears after hours)"""
+        return self.error_kind in (TRANSIENT, DISCONNECTED)
+
+
+def _smtp_text(error):
+    text = getattr(error, 'smtp_error', b'')
+    return text.decode('utf-8', 'replace') if isinstance(text, bytes) else str(text)
+
+
+def classify_smtp_error(error):
+    """Error kind of an exception raised while sending over SMTP (smtplib or AsyncSMTPSession)"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        if codes and all(code in TRANSIENT_SMTP_CODES for code in codes):
+            return TRANSIENT
+        return PERMANENT
+    if isinstance(error, smtplib.SMTPResponseException):
+        # Gmail: "550 5.4.5 Daily user sending limit exceeded"
+        if '5.4.5' in _smtp_text(error):
+            return QUOTA
+        return TRANSIENT if error.smtp_code in TRANSIENT_SMTP_CODES else PERMANENT
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return DISCONNECTED
+    if isinstance(error, smtplib.SMTPException):
+        return PERMANENT
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+        # An AsyncSMTPSession reply that did not come in time (not an OSError before Python 3.11)
+        return DISCONNECTED
+    if isinstance(error, OSError):
+        # Connection resets and timeouts
+        return DISCONNECTED
+    return PERMANENT
+
+
+def smtp_failure(error):
+    """SendResult for an SMTP exception, with the same messages MailSender always used"""
+    kind = classify_smtp_error(error)
+    if kind == QUOTA:
+        return SendResult(False, f"⛔ Gmail gönderim limiti: {_smtp_text(error)}", QUOTA)
+    if isinstance(error, smtplib.SMTPRecipientsRefused) and kind == PERMANENT:
+        return SendResult(False, "❌ Geçersiz mail adresi", PERMANENT)
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return SendResult(False, "❌ SMTP bağlantısı koptu", DISCONNECTED)
+    if kind in (TRANSIENT, DISCONNECTED):
+        return SendResult(False, f"⏳ Geçici hata: {str(error)}", kind)
+    return SendResult(False, f"❌ Hata: {str(error)}", PERMANENT)
+
+
+# ============ ADAPTIVE THROTTLING ============
+
+class AdaptiveThrottle:
+    """
+    AIMD pacing on top of the rate limiter, driven by the provider's responses
+
+    Every transient error multiplies the rate factor by `decrease` and pauses all
+    senders for an exponential backoff with jitter; every success adds `increase`
+    back, up to 1. While the factor is below 1, sends are spaced interval / factor
+    apart. At full rate the throttle adds no delay of its own.
+    """
+
+    def __init__(self, interval=RATE_LIMIT_SECONDS, min_factor=THROTTLE_MIN_FACTOR, decrease=THROTTLE_DECREASE,
+                 increase=THROTTLE_INCREASE, backoff_base=BACKOFF_BASE_SECONDS, backoff_max=BACKOFF_MAX_SECONDS,
+                 window=THROTTLE_METRICS_WINDOW):
+        self.interval = interval
+        self.min_factor = min_factor
+        self.decrease = decrease
+        self.increase = increase
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.window = window
+        self.factor = 1.0
+        self.failures = 0  # Transient errors in a row
+        self._backoff_until = 0
+        self._next_slot = 0
+        self._events = deque()  # (unix time, error kind or None, factor after it)
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take the next send slot, returning the seconds to wait for it"""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._backoff_until)
+            if self.factor < 1:
+                slot = max(slot, self._next_slot)
+                self._next_slot = slot + self.interval / self.factor
+            return slot - now
+
+    def wait(self):
+        """Block until this caller's slot"""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def backoff_delay(self, failures):
+        """Exponential backoff with equal jitter for the n-th transient error in a row"""
+        ceiling = min(self.backoff_max, self.backoff_base * 2 ** (failures - 1))
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+    def record(self, error_kind=None, retry_after=None):
+        """
+        Feed back the outcome of one send (error_kind None for success)
+
+        Returns the backoff started by a transient error, otherwise 0. Dropped
+        connections and permanent errors (bad address, rejected content) are
+        counted but leave the rate alone.
+        """
+        with self._lock:
+            delay = 0
+            if error_kind is None:
+                self.failures = 0
+                self.factor = min(1.0, self.factor + self.increase)
+            elif error_kind in (TRANSIENT, QUOTA):
+                self.failures += 1
+                self.factor = max(self.min_factor, self.factor * self.decrease)
+                delay = self.backoff_max if error_kind == QUOTA else self.backoff_delay(self.failures)
+                delay = max(delay, retry_after or 0)
+                self._backoff_until = max(self._backoff_until, time.monotonic() + delay)
+
+            now = time.time()
+            self._events.append((now, error_kind, self.factor))
+            while self._events and self._events[0][0] < now - self.window:
+                self._events.popleft()
+            return delay
+
+    def metrics(self, bucket_seconds=60):
+        """
+        Current state and the effective send rate over time
+
+        Returns {'factor', 'backoff_seconds', 'failures', 'sent', 'transient', 'permanent',
+        'sent_per_minute' (last bucket), 'series': [{'time', 'sent_per_minute',
+        'errors', 'factor'}, ...] one entry per bucket_seconds of the window}
+        """
+        with self._lock:
+            events = list(self._events)
+            backoff = max(0.0, self._backoff_until - time.monotonic())
+            factor = self.factor
+            failures = self.failures
+
+        now = time.time()
+        first = (now - self.window) // bucket_seconds * bucket_seconds
+        buckets = {}
+        for timestamp, kind, event_factor in events:
+            bucket = buckets.setdefault(timestamp // bucket_seconds * bucket_seconds, [0, 0, event_factor])
+            if kind is None:
+                bucket[0] += 1
+            elif kind != PERMANENT:
+                bucket[1] += 1
+            bucket[2] = event_factor
+
+        series = []
+        start = min(buckets) if buckets else now // bucket_seconds * bucket_seconds
+        for bucket_start in range(int(max(start, first)), int(now) + 1, bucket_seconds):
+            sent, errors, event_factor = buckets.get(bucket_start, (0, 0, series[-1]['factor'] if series else factor))
+            series.append({
+                'time': datetime.fromtimestamp(bucket_start),
+                'sent_per_minute': sent * 60 / bucket_seconds,
+                'errors': errors,
+                'factor': event_factor
+            })
+
+        return {
+            'factor': factor,
+            'backoff_seconds': backoff,
+            'failures': failures,
+            'sent': sum(1 for _, kind, _ in events if kind is None),
+            'transient': sum(1 for _, kind, _ in events if kind not in (None, PERMANENT)),
+            'permanent': sum(1 for _, kind, _ in events if kind == PERMANENT),
+            'sent_per_minute': series[-1]['sent_per_minute'] if series else 0.0,
+            'series': series
+        }
+
+
+# One throttle for every send path of this process
+_throttle = AdaptiveThrottle()
+
+
+def get_throttle():
+    """Get the shared adaptive throttle"""
+    return _throttle
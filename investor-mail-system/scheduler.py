@@ -1,18 +1,112 @@
 """
 Background scheduler for handling scheduled emails.
-Runs in a separate thread and checks for pending mails every minute.
+A dispatcher thread sleeps until the next scheduled mail is due, then worker
+threads claim due mails with a lease, move them into the durable outbox and
+send them from there. Mails scheduled for many
+recipients at once are stored as one template snapshot plus a small context per
+recipient, and rendered only when they are sent.
 
 Developed by: emirgunyy & gktrk363
 """
+import json
 import time
+import heapq
+import itertools
 import threading
+from collections import deque
 from datetime import datetime
-from database import get_pending_scheduled_mails, update_scheduled_mail_status, log_sent_mail
+from database import (
+    claim_scheduled_mails, complete_scheduled_mail, log_sent_mail, pin_thread_connection, get_scheduled_wakeups,
+    add_schedule_listener, remove_schedule_listener, schedule_campaign_mails, get_scheduled_campaign,
+    get_unfinished_campaigns
+)
+from config import (
+    MAX_SEND_ATTEMPTS, SCHEDULER_RESYNC_SECONDS, SCHEDULER_RETRY_SECONDS, SCHEDULER_LAG_SAMPLES,
+    SCHEDULER_WORKERS, SCHEDULER_CLAIM_BATCH, SCHEDULER_LEASE_SECONDS
+)
 from gmail_oauth import GmailOAuth, check_credentials_file
 from mail_sender import MailSender
+from async_sender import AsyncGmailBatchTransport
+from outbox import worker_id, enqueue_scheduled_mails, run_outbox
+from rate_limiter import get_rate_limiter
+from template_engine import render_batch, snapshot_context, template_variables
 # Note: config import might be needed for app password, but we'll focus on OAuth for now or need to pass credentials
 
+# Heap key of a wakeup that is not tied to one mail (retry after a deferral or the quota)
+_RECHECK = 0
+
+
+def _timestamp(due):
+    """Unix time of a scheduled_time (datetime, or the text SQLite gives back) or lease expiry"""
+    if isinstance(due, (int, float)):
+        return float(due)
+    if isinstance(due, str):
+        due = datetime.fromisoformat(due)
+    return due.timestamp()
+
+
+def _percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def schedule_campaign(recipients, subject_template, body_template, scheduled_time, template_id=None):
+    """
+    Schedule a template for a list of investors (dicts with 'id'), returning the number of mails
+    
+    The templates are stored once, and each mail only with the context variables
+    the templates use; it is rendered when it is sent. The templates are compiled
+    here, so a syntax error is raised before anything is scheduled.
+    """
+    variables = template_variables(subject_template) | template_variables(body_template)
+    rows = (
+        (recipient['id'], json.dumps(snapshot_context(recipient, variables), ensure_ascii=False, default=str))
+        for recipient in recipients
+    )
+    return schedule_campaign_mails(template_id, subject_template, body_template, rows, scheduled_time)
+
+
+def render_scheduled_mails(mails):
+    """
+    Render claimed mails stored as template snapshot + context, in place
+    
+    Fills in 'subject' and 'body' of each such mail (the body as UTF-8 bytes) and
+    returns the (mail, error) pairs of the ones whose template failed to render.
+    """
+    failures = []
+    compact = sorted((mail for mail in mails if mail['campaign_id'] is not None), key=lambda m: m['campaign_id'])
+    for campaign_id, group in itertools.groupby(compact, key=lambda m: m['campaign_id']):
+        group = list(group)
+        campaign = get_scheduled_campaign(campaign_id)
+        if campaign is None:
+            failures.extend((mail, "kampanya bulunamadı") for mail in group)
+            continue
+        contexts = [json.loads(mail['context']) for mail in group]
+        rendered = render_batch(campaign['body_template'], campaign['subject_template'], contexts,
+                                return_errors=True, as_bytes=True)
+        for mail, (_, subject, body) in zip(group, rendered):
+            if subject is None:
+                failures.append((mail, body))
+            else:
+                mail['subject'], mail['body'] = subject, body
+    return failures
+
+
 class EmailScheduler:
+    """
+    Sends scheduled mails when they are due
+    
+    Upcoming send times are kept in a min-heap; the dispatcher thread sleeps on a
+    condition until the earliest one, and schedule_mail() / cancel_scheduled_mail()
+    wake it right away through a database listener. Due mails are then claimed
+    batch by batch by SCHEDULER_WORKERS worker threads with a lease and moved into
+    the outbox, so any number of workers and processes can run without sending a
+    mail twice, and a mail whose worker died before that is claimed again once
+    its lease runs out. The outbox then leases, sends and resumes them like any
+    campaign. The heap is reloaded from the database every SCHEDULER_RESYNC_SECONDS
+    to pick up other processes' mails and leases, and what is left in the outbox.
+    """
     _instance = None
     _lock = threading.Lock()
     _running = False
@@ -22,73 +116,255 @@ class EmailScheduler:
             with cls._lock:
                 if cls._instance is None:
                     cls._instance = super(EmailScheduler, cls).__new__(cls)
+                    cls._instance._setup()
                     cls._instance.start()
         return cls._instance
     
+    def _setup(self, workers=SCHEDULER_WORKERS):
+        self.workers = workers
+        self._heap = []  # (due unix time, mail id, _RECHECK or a batch key)
+        self._batch_keys = itertools.count(-1, -1)  # Keys of mails scheduled in one batch
+        self._due = {}  # mail id -> due time of its live heap entry (cancelled ones are dropped)
+        self._condition = threading.Condition()
+        self._resync_at = 0
+        self._work = threading.Condition()
+        self._work_generation = 0  # Bumped whenever mails are due
+        self._lags = deque(maxlen=SCHEDULER_LAG_SAMPLES)  # Seconds between due time and claim
+        add_schedule_listener(self._on_schedule)
+    
     def start(self):
         if not self._running:
             self._running = True
-            thread = threading.Thread(target=self._run_loop, daemon=True)
-            thread.start()
+            threading.Thread(target=self._run_loop, daemon=True, name='email-scheduler').start()
+            for index in range(self.workers):
+                threading.Thread(target=self._work_loop, daemon=True, name=f'email-scheduler-{index}').start()
             print("Scheduler started...")
     
+    def stop(self):
+        remove_schedule_listener(self._on_schedule)
+        self._running = False
+        for condition in (self._condition, self._work):
+            with condition:
+                condition.notify_all()
+    
+    # ============ WAKEUP HEAP ============
+    
+    def _push(self, key, due):
+        """Queue a wakeup at unix time due; caller holds the condition"""
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, key))
+        self._condition.notify()
+    
+    def _on_schedule(self, mail_id, scheduled_time):
+        """Database listener: a mail (or a batch, mail_id None) was scheduled, or cancelled (scheduled_time None)"""
+        with self._condition:
+            if mail_id is None:
+                self._push(next(self._batch_keys), _timestamp(scheduled_time))
+            elif scheduled_time is None:
+                self._due.pop(mail_id, None)
+                self._condition.notify()
+            else:
+                self._push(mail_id, _timestamp(scheduled_time))
+    
+    def _wake_at(self, due):
+        """Look for due mails again at unix time due (earliest request wins)"""
+        with self._condition:
+            if self._due.get(_RECHECK, float('inf')) > due:
+                self._push(_RECHECK, due)
+    
+    def _resync(self):
+        """Rebuild the heap from the pending and claimed mails (and scheduled outbox campaigns) in the database"""
+        wakeups = get_scheduled_wakeups()
+        leftovers = get_unfinished_campaigns(scheduled=True)
+        with self._condition:
+            recheck = self._due.get(_RECHECK)
+            if leftovers:
+                # Left in the outbox by a stopped run: send it now
+                recheck = time.time()
+            self._due = {mail_id: _timestamp(due) for mail_id, due in wakeups}
+            if recheck is not None:
+                self._due[_RECHECK] = recheck
+            self._heap = [(due, key) for key, due in self._due.items()]
+            heapq.heapify(self._heap)
+            self._resync_at = time.time() + SCHEDULER_RESYNC_SECONDS
+            self._condition.notify()
+    
+    def _wait_for_due(self):
+        """
+        Sleep until a queued mail is due or a resync is needed
+        
+        Returns True when mails are due (their heap entries are removed), False
+        for a resync or stop.
+        """
+        with self._condition:
+            while self._running:
+                # Skip entries of cancelled or re-queued mails
+                while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+                    heapq.heappop(self._heap)
+                
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    while self._heap and self._heap[0][0] <= now:
+                        due, key = heapq.heappop(self._heap)
+                        if self._due.get(key) == due:
+                            del self._due[key]
+                    return True
+                if now >= self._resync_at:
+                    return False
+                
+                next_due = self._heap[0][0] if self._heap else float('inf')
+                self._condition.wait(min(next_due, self._resync_at) - now)
+            return False
+    
+    def lag_stats(self):
+        """Dispatch lag of recent scheduled mails: {'count', 'p50', 'p99'} in seconds (None without samples)"""
+        lags = list(self._lags)
+        if not lags:
+            return {'count': 0, 'p50': None, 'p99': None}
+        return {'count': len(lags), 'p50': _percentile(lags, 0.5), 'p99': _percentile(lags, 0.99)}
+    
     def _run_loop(self):
+        """Dispatcher: wake the workers whenever mails are due"""
+        # This thread lives as long as the app, keep one connection for it
+        pin_thread_connection()
         while self._running:
             try:
-                self._check_and_send()
+                if self._wait_for_due():
+                    with self._work:
+                        self._work_generation += 1
+                        self._work.notify_all()
+                elif self._running:
+                    self._resync()
             except Exception as e:
                 print(f"Scheduler error: {e}")
-            time.sleep(60)  # Check every minute
+                time.sleep(1)
+    
+    # ============ SENDING ============
+    
+    def _work_loop(self):
+        """Worker: claim and send due mails until none are left, then wait for the dispatcher"""
+        pin_thread_connection()
+        owner = worker_id()
+        seen = 0
+        while self._running:
+            with self._work:
+                while self._running and self._work_generation == seen:
+                    self._work.wait()
+                seen = self._work_generation
+            try:
+                while self._running and self._claim_and_send(owner):
+                    pass
+            except Exception as e:
+                print(f"Scheduler worker error: {e}")
+                self._wake_at(time.time() + SCHEDULER_RETRY_SECONDS)
+    
+    def _claim_and_send(self, owner):
+        """
+        Claim one batch of due mails, move it into the outbox and send what the outbox holds
+        
+        The outbox also has what earlier runs left there (the daily quota ran out, a
+        worker or process died), and that is sent too. Returns False when there was
+        nothing to do.
+        """
+        # Only take what fits in the daily quota, the rest stays pending for a later run
+        remaining = get_rate_limiter().status()['remaining']
+        if remaining <= 0:
+            self._wake_at(time.time() + SCHEDULER_RETRY_SECONDS)
+            return False
+        
+        oauth_client = self._oauth_client()
+        mails = claim_scheduled_mails(owner, min(SCHEDULER_CLAIM_BATCH, remaining), SCHEDULER_LEASE_SECONDS)
+        if mails:
+            print(f"Claimed {len(mails)} scheduled mails")
+            now = time.time()
+            for mail in mails:
+                if mail['attempts'] == 0:
+                    self._lags.append(max(0.0, now - _timestamp(mail['scheduled_time'])))
             
-    def _check_and_send(self):
-        pending_mails = get_pending_scheduled_mails()
-        if not pending_mails:
-            return
+            if not oauth_client:
+                for mail in mails:
+                    self._record(mail, owner, False, "OAuth credentials not available for background sending")
+                return True
             
-        print(f"Found {len(pending_mails)} pending mails")
+            broken = set()
+            for mail, error in render_scheduled_mails(mails):
+                broken.add(mail['id'])
+                self._record(mail, owner, False, f"❌ Şablon hatası: {error}")
+            
+            sendable = []
+            for mail in mails:
+                if mail['id'] in broken:
+                    continue
+                if mail['attempts'] >= MAX_SEND_ATTEMPTS:
+                    # Claimed by workers that died before handing it to the outbox, too many times
+                    self._record(mail, owner, False, "❌ Çok fazla deneme, gönderim yarıda kaldı")
+                else:
+                    sendable.append(mail)
+            enqueue_scheduled_mails(sendable, owner)
         
-        # Try to initialize OAuth client
-        oauth_client = None
+        if not oauth_client:
+            return bool(mails)
+        finished = 0
+        for campaign in reversed(get_unfinished_campaigns(scheduled=True)):
+            finished += self._drain(oauth_client, campaign['id'])
+        return bool(mails) or finished > 0
+    
+    def _drain(self, oauth_client, campaign_id):
+        """Send an outbox campaign of scheduled mails, returning how many of them finished"""
+        finished = 0
+        for result in self._send(oauth_client, campaign_id):
+            mail_id = result['recipient']['scheduled_mail_id']
+            if result['state'] == 'queued':
+                # Stays in the outbox until the quota frees up
+                self._wake_at(time.time() + SCHEDULER_RETRY_SECONDS)
+                print(f"Scheduled mail {mail_id} deferred: {result['message']}")
+            else:
+                finished += 1
+                print(f"Scheduled mail {mail_id} processed: {result['state']} - {result['message']}")
+        return finished
+    
+    def _oauth_client(self):
+        """GmailOAuth with the saved credentials (cached per token), or None"""
         if check_credentials_file():
             oauth = GmailOAuth()
             if oauth.load_saved_credentials():
-                oauth_client = oauth
-        
-        for mail in pending_mails:
-            try:
-                success = False
-                error_msg = None
-                
-                # Try sending with OAuth
-                if oauth_client:
-                    success, message = oauth_client.send_email(
-                        mail['investor_email'],
-                        mail['subject'],
-                        mail['body']
-                    )
-                else:
-                    success = False
-                    message = "OAuth credentials not available for background sending"
-                
-                # Update status
-                new_status = 'sent' if success else 'failed'
-                update_scheduled_mail_status(mail['id'], new_status)
-                
-                # Log to sent mails history
-                log_sent_mail(
-                    mail['investor_id'],
-                    mail['template_id'],
-                    mail['subject'],
-                    new_status,
-                    None if success else message
-                )
-                
-                print(f"Scheduled mail {mail['id']} processed: {new_status} - {message}")
-                
-            except Exception as e:
-                print(f"Error processing mail {mail['id']}: {e}")
-                update_scheduled_mail_status(mail['id'], 'failed')
+                return oauth
+        return None
+    
+    def _send(self, oauth_client, campaign_id):
+        """Send an outbox campaign through the Gmail API, yielding stream_outbox results"""
+        return run_outbox(AsyncGmailBatchTransport(oauth_client), campaign_id)
+    
+    def _record(self, mail, owner, success, message):
+        """Finish a claimed mail that is not sent at all and log it to sent mails history"""
+        try:
+            # Update status (only while the lease is still ours)
+            new_status = 'sent' if success else 'failed'
+            if not complete_scheduled_mail(mail['id'], owner, new_status):
+                print(f"Scheduled mail {mail['id']}: lease lost, left to the worker that took it over")
+                return
+            
+            # Log to sent mails history
+            log_sent_mail(
+                mail['investor_id'],
+                mail['template_id'],
+                mail['subject'],
+                new_status,
+                None if success else message
+            )
+            
+            print(f"Scheduled mail {mail['id']} processed: {new_status} - {message}")
+            
+        except Exception as e:
+            print(f"Error processing mail {mail['id']}: {e}")
+            complete_scheduled_mail(mail['id'], owner, 'failed')
 
 # Start scheduler on import if not already running
 # We rely on app.py to import and instantiate this class
 
+
+if __name__ == '__main__':
+    # An extra scheduler process next to the app; claims keep them from sending a mail twice
+    EmailScheduler()
+    while True:
+        time.sleep(3600)
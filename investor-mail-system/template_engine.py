@@ -4,10 +4,293 @@ Jinja2-based template rendering with variable substitution
 
 Developed by: emirgunyy & gktrk363
 """
-from jinja2 import Template, Environment, BaseLoader
+import os
+import hashlib
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from jinja2 import Environment, BaseLoader, FileSystemBytecodeCache, TemplateNotFound, nodes, meta
+from config import TEMPLATE_CACHE_SIZE, TEMPLATE_BYTECODE_CACHE_DIR, TEMPLATE_FAST_PATH, RENDER_CHUNK_SIZE
 
 
-def render_template(template_str, context):
+class _SourceLoader(BaseLoader):
+    """Serves sources registered under their hash, so Jinja2 can use its bytecode cache"""
+    
+    def __init__(self):
+        self.sources = {}
+    
+    def get_source(self, environment, name):
+        if name not in self.sources:
+            raise TemplateNotFound(name)
+        return self.sources[name], None, lambda: True
+
+
+BODY_CLOSE = '</body>'
+
+# Names jinja2 resolves specially, never plain context lookups
+_RESERVED_NAMES = {'self', 'super', 'loop', 'caller', 'varargs', 'kwargs'}
+
+
+class SimpleTemplate:
+    """
+    Fast path for templates made only of text and {{var}} placeholders
+    
+    The source is pre-split into static segments and variable slots, so rendering is
+    a single join. Output is identical to the jinja2 Template it replaces.
+    A footer slot (tracking pixel, unsubscribe link...) is reserved before the last
+    </body> of the static text, or at the end, so footers need no search and replace.
+    """
+    
+    def __init__(self, segments):
+        # segments: list of ('text', str) / ('var', name)
+        self._parts = []
+        self._slots = []
+        for kind, value in segments:
+            if kind == 'var':
+                self._slots.append((len(self._parts), value))
+                self._parts.append('')
+            else:
+                self._parts.append(value)
+        
+        self._footer_index = self._reserve_footer_slot()
+        # Static segments already in UTF-8 for render_bytes()
+        self._encoded = [part.encode('utf-8') for part in self._parts]
+    
+    def _reserve_footer_slot(self):
+        """Split the static segment with the last </body>, return the slot index"""
+        slot_indexes = {index for index, _ in self._slots}
+        for index in range(len(self._parts) - 1, -1, -1):
+            if index in slot_indexes:
+                continue
+            offset = self._parts[index].rfind(BODY_CLOSE)
+            if offset != -1:
+                text = self._parts[index]
+                self._parts[index:index + 1] = [text[:offset], '', text[offset:]]
+                self._slots = [(i + 2 if i > index else i, name) for i, name in self._slots]
+                return index + 1
+        self._parts.append('')
+        return len(self._parts) - 1
+    
+    @property
+    def variables(self):
+        """Placeholder names in order of appearance"""
+        return [name for _, name in self._slots]
+    
+    def render(self, *args, **kwargs):
+        """Render like jinja2.Template.render (missing variables render as '')"""
+        return self.render_with_footer(dict(*args, **kwargs))
+    
+    def render_with_footer(self, context, footer=''):
+        """Render with footer spliced in before </body> (or at the end)"""
+        parts = self._parts[:]
+        for index, name in self._slots:
+            if name in context:
+                parts[index] = str(context[name])
+        parts[self._footer_index] = footer
+        return ''.join(parts)
+    
+    def render_bytes(self, context, footer=b''):
+        """Like render_with_footer, but straight to UTF-8 bytes (only variables get encoded)"""
+        parts = self._encoded[:]
+        for index, name in self._slots:
+            if name in context:
+                parts[index] = str(context[name]).encode('utf-8')
+        parts[self._footer_index] = footer if isinstance(footer, bytes) else footer.encode('utf-8')
+        return b''.join(parts)
+
+
+def analyze_template(environment, source):
+    """
+    Split a template into static text and variable slots if it is "simple"
+    
+    Returns the segment list for SimpleTemplate, or None when the template uses
+    anything else (filters, attributes, control flow, globals...) and needs jinja2.
+    """
+    segments = []
+    for node in environment.parse(source).body:
+        if not isinstance(node, nodes.Output):
+            return None
+        for child in node.nodes:
+            if isinstance(child, nodes.TemplateData):
+                if segments and segments[-1][0] == 'text':
+                    segments[-1] = ('text', segments[-1][1] + child.data)
+                else:
+                    segments.append(('text', child.data))
+            elif (isinstance(child, nodes.Name) and child.ctx == 'load'
+                  and child.name not in environment.globals
+                  and child.name not in _RESERVED_NAMES):
+                segments.append(('var', child.name))
+            else:
+                return None
+    return segments
+
+
+class TemplateCache:
+    """Size-bounded LRU cache of compiled templates keyed by their source"""
+    
+    def __init__(self, max_size=TEMPLATE_CACHE_SIZE, bytecode_dir=TEMPLATE_BYTECODE_CACHE_DIR,
+                 fast_path=TEMPLATE_FAST_PATH):
+        bytecode_cache = None
+        if bytecode_dir:
+            os.makedirs(bytecode_dir, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(bytecode_dir)
+        
+        self._loader = _SourceLoader()
+        # Same defaults as jinja2.Template(), so output is unchanged; caching is done here
+        self.environment = Environment(
+            loader=self._loader,
+            bytecode_cache=bytecode_cache,
+            cache_size=0,
+            auto_reload=False
+        )
+        self.max_size = max_size
+        self.fast_path = fast_path
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+        self._compile_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, source):
+        """Get the compiled template for a source string, compiling it on a miss"""
+        with self._lock:
+            template = self._templates.get(source)
+            if template is not None:
+                self._templates.move_to_end(source)
+                self.hits += 1
+                return template
+            self.misses += 1
+        
+        template = self._compile(source)
+        
+        with self._lock:
+            self._templates[source] = template
+            self._templates.move_to_end(source)
+            while len(self._templates) > self.max_size:
+                self._templates.popitem(last=False)
+                self.evictions += 1
+        return template
+    
+    def _compile(self, source):
+        """Compile a simple template to a SimpleTemplate, anything else through jinja2"""
+        if self.fast_path:
+            segments = analyze_template(self.environment, source)
+            if segments is not None:
+                return SimpleTemplate(segments)
+        
+        # Through the loader, so the bytecode cache is keyed by the source hash
+        name = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        with self._compile_lock:
+            self._loader.sources[name] = source
+            try:
+                return self.environment.get_template(name)
+            finally:
+                del self._loader.sources[name]
+    
+    def stats(self):
+        """Hit/miss counters for monitoring"""
+        with self._lock:
+            return {
+                'size': len(self._templates),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+    
+    def clear(self):
+        """Drop all compiled templates (counters are kept)"""
+        with self._lock:
+            self._templates.clear()
+
+
+_template_cache = TemplateCache()
+
+
+def get_compiled_template(template_str):
+    """Get a compiled jinja2 template from the shared cache"""
+    return _template_cache.get(template_str)
+
+
+def get_template_cache_stats():
+    """Get hit/miss counters of the compiled template cache"""
+    return _template_cache.stats()
+
+
+def template_variables(template_str):
+    """Names a template looks up in its context (placeholders, loop sources, filter inputs...)"""
+    template = get_compiled_template(template_str)
+    if isinstance(template, SimpleTemplate):
+        return set(template.variables)
+    return meta.find_undeclared_variables(_template_cache.environment.parse(template_str))
+
+
+# Tracking Pixel Logic (Framework)
+# Note: This requires a deployed server to actually track opens.
+# Currently pointing to a placeholder.
+TRACKING_PIXEL = '<img src="http://localhost:8502/track.png" width="1" height="1" style="display:none;" />'
+
+
+def build_context(recipient):
+    """
+    Normalize a recipient dict into template variables
+    
+    Both Turkish and English names are filled ({{ad}}/{{name}}, {{sirket}}/{{company}},
+    {{kategori}}/{{category}}); missing or NULL values render as ''.
+    Any other keys of the recipient are passed through unchanged.
+    """
+    get = recipient.get
+    name = get('name', get('ad', ''))
+    company = get('company', get('sirket', ''))
+    category = get('category', get('kategori', ''))
+    email = get('email', '')
+    
+    context = dict(recipient)
+    context['ad'] = context['name'] = '' if name is None else name
+    context['sirket'] = context['company'] = '' if company is None else company
+    context['kategori'] = context['category'] = '' if category is None else category
+    context['email'] = '' if email is None else email
+    return context
+
+
+def snapshot_context(recipient, variables):
+    """The part of a recipient's context a template uses (see template_variables), enough to render it later"""
+    context = build_context(recipient)
+    return {name: context[name] for name in sorted(variables) if name in context}
+
+
+def splice_footer(rendered, footer):
+    """Insert footer before the last </body> (or append it)"""
+    head, body_close, tail = rendered.rpartition(BODY_CLOSE)
+    if not body_close:
+        return rendered + footer
+    return ''.join((head, footer, body_close, tail))
+
+
+def add_tracking_pixel(rendered):
+    """Insert the tracking pixel before </body> (or append it)"""
+    return splice_footer(rendered, TRACKING_PIXEL)
+
+
+def render_message(template, context, footer='', as_bytes=False):
+    """
+    Render a compiled template with a footer before </body>
+    
+    SimpleTemplates use their precomputed footer slot (and encode only the variables
+    when as_bytes is set); jinja2 templates fall back to splice_footer.
+    """
+    if isinstance(template, SimpleTemplate):
+        if as_bytes:
+            return template.render_bytes(context, footer)
+        return template.render_with_footer(context, footer)
+    
+    rendered = splice_footer(template.render(context), footer)
+    return rendered.encode('utf-8') if as_bytes else rendered
+
+
+def render_template(template_str, context, as_bytes=False):
     """
     Render a template string with context variables
     
@@ -17,37 +300,93 @@ def render_template(template_str, context):
     - {{email}} - Email address
     - {{kategori}} or {{category}} - Category
     """
-    # Normalize context keys (support both Turkish and English)
-    normalized_context = {
-        'ad': context.get('name', context.get('ad', '')),
-        'name': context.get('name', context.get('ad', '')),
-        'sirket': context.get('company', context.get('sirket', '')),
-        'company': context.get('company', context.get('sirket', '')),
-        'email': context.get('email', ''),
-        'kategori': context.get('category', context.get('kategori', '')),
-        'category': context.get('category', context.get('kategori', '')),
-    }
-    
-    # Add any additional context
-    for key, value in context.items():
-        if key not in normalized_context:
-            normalized_context[key] = value
+    template = get_compiled_template(template_str)
+    return render_message(template, build_context(context), TRACKING_PIXEL, as_bytes)
+
+
+def _render_one(body_template, subject_template, recipient, tracking, footer, as_bytes):
+    """Render subject and body for one recipient"""
+    context = build_context(recipient)
+    footer_html = footer(recipient) if callable(footer) else (footer or '')
+    if tracking:
+        footer_html += TRACKING_PIXEL
+    body = render_message(body_template, context, footer_html, as_bytes)
+    return subject_template.render(context), body
+
+
+def _render_chunk(template_str, subject_str, recipients, tracking, footer, as_bytes):
+    """Process pool worker: render a chunk, returning (subject, body) or (None, error) per recipient"""
+    body_template = get_compiled_template(template_str)
+    subject_template = get_compiled_template(subject_str)
+    results = []
+    for recipient in recipients:
+        try:
+            results.append(_render_one(body_template, subject_template, recipient, tracking, footer, as_bytes))
+        except Exception as e:
+            results.append((None, e))
+    return results
+
+
+def _chunks(items, size):
+    """Split any iterable into lists of at most size items"""
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def render_batch(template_str, subject_str, recipients, tracking=True, processes=None,
+                 chunk_size=RENDER_CHUNK_SIZE, return_errors=False, footer=None, as_bytes=False):
+    """
+    Personalize a template for a whole recipient list, compiling it only once
     
-    # Render template
-    template = Template(template_str)
-    rendered = template.render(**normalized_context)
+    Lazily yields (recipient, subject, body) in recipient order. The tracking pixel
+    goes into the body only. With processes > 1 the list is rendered in chunks on a
+    process pool (recipients and footer must be picklable, e.g. database rows).
     
-    # Tracking Pixel Logic (Framework)
-    # Note: This requires a deployed server to actually track opens.
-    # Currently pointing to a placeholder.
-    tracking_pixel = '<img src="http://localhost:8502/track.png" width="1" height="1" style="display:none;" />'
+    return_errors: yield (recipient, None, exception) for a recipient that fails to
+                   render instead of raising
+    footer: HTML (or function of the recipient, e.g. an unsubscribe link) added
+            before </body>, ahead of the tracking pixel
+    as_bytes: yield the body as UTF-8 bytes, ready for the MIME part
+    """
+    if processes and processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            chunks = _chunks(recipients, chunk_size)
+            # Submit one chunk ahead so workers stay busy while the caller consumes
+            pending = [
+                (chunk, executor.submit(_render_chunk, template_str, subject_str, chunk, tracking, footer, as_bytes))
+                for chunk in itertools.islice(chunks, processes * 2)
+            ]
+            while pending:
+                chunk, future = pending.pop(0)
+                next_chunk = next(chunks, None)
+                if next_chunk is not None:
+                    pending.append((next_chunk, executor.submit(
+                        _render_chunk, template_str, subject_str, next_chunk, tracking, footer, as_bytes
+                    )))
+                for recipient, (subject, body) in zip(chunk, future.result()):
+                    if subject is None:
+                        if not return_errors:
+                            raise body
+                        yield recipient, None, body
+                    else:
+                        yield recipient, subject, body
+        return
     
-    if "</body>" in rendered:
-        rendered = rendered.replace("</body>", f"{tracking_pixel}</body>")
-    else:
-        rendered += tracking_pixel
-        
-    return rendered
+    body_template = get_compiled_template(template_str)
+    subject_template = get_compiled_template(subject_str)
+    for recipient in recipients:
+        try:
+            subject, body = _render_one(body_template, subject_template, recipient, tracking, footer, as_bytes)
+        except Exception as e:
+            if not return_errors:
+                raise
+            yield recipient, None, e
+            continue
+        yield recipient, subject, body
 
 
 def get_default_templates():
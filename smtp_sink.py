@@ -0,0 +1,120 @@
+"""
+Local SMTP sink for tests and benchmarks
+
+Accepts every message without TLS or auth and keeps it in memory. latency adds a
+delay before each DATA reply (like a remote server), drop_after closes a
+session after that many messages to exercise reconnection, and tempfail answers
+that many RCPT commands with Gmail's "450 4.2.1" rate limit reply. With a
+tls_context (server side) the sink also offers STARTTLS.
+"""
+import ssl
+import socketserver
+import threading
+import time
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128  # Pools connect all their sessions at once
+
+    def __init__(self, latency=0.0, drop_after=None, tempfail=0, tls_context=None):
+        super().__init__(('127.0.0.1', 0), _SMTPHandler)
+        self.latency = latency
+        self.drop_after = drop_after
+        self.tempfail = tempfail
+        self.tls_context = tls_context
+        self.messages = []
+        self.sessions = 0
+        self.tls_sessions = 0
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def finish(self):
+        super().finish()
+        if isinstance(self.connection, ssl.SSLSocket):
+            self.connection.close()  # wrap_socket detached the socket the server closes
+
+    def handle(self):
+        sink = self.server
+        with sink.lock:
+            sink.sessions += 1
+        delivered = 0
+        mail_from, rcpt_to = None, []
+
+        self.reply('220 localhost SMTP sink')
+        while True:
+            raw = self.rfile.readline()
+            if not raw:
+                return
+            command = raw.decode('ascii', 'replace').strip()
+            verb = command[:4].upper()
+            if verb == 'EHLO':
+                if sink.tls_context and not isinstance(self.connection, ssl.SSLSocket):
+                    self.reply('250-localhost\r\n250-STARTTLS\r\n250 8BITMIME')
+                else:
+                    self.reply('250-localhost\r\n250 8BITMIME')
+            elif command.upper() == 'STARTTLS' and sink.tls_context:
+                self.reply('220 Ready to start TLS')
+                self.connection = sink.tls_context.wrap_socket(self.connection, server_side=True)
+                self.rfile = self.connection.makefile('rb')
+                self.wfile = self.connection.makefile('wb', buffering=0)
+                with sink.lock:
+                    sink.tls_sessions += 1
+            elif verb == 'HELO':
+                self.reply('250 localhost')
+            elif verb == 'MAIL':
+                mail_from, rcpt_to = command[10:].strip('<> '), []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                with sink.lock:
+                    throttled = sink.tempfail > 0
+                    sink.tempfail -= throttled
+                if throttled:
+                    self.reply('450 4.2.1 The user you are trying to contact is receiving mail too quickly')
+                    continue
+                rcpt_to.append(command[8:].strip('<> '))
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                for data_line in self.rfile:
+                    if data_line == b'.\r\n':
+                        break
+                    lines.append(data_line)
+                if sink.latency:
+                    time.sleep(sink.latency)
+                with sink.lock:
+                    sink.messages.append((mail_from, rcpt_to, b''.join(lines)))
+                self.reply('250 OK queued')
+                delivered += 1
+                if sink.drop_after and delivered >= sink.drop_after:
+                    return  # Close without QUIT, like an idle-timeout drop
+            elif verb == 'RSET':
+                mail_from, rcpt_to = None, []
+                self.reply('250 OK')
+            elif verb == 'NOOP':
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
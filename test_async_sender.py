@@ -0,0 +1,257 @@
+import os
+import ssl
+import sys
+import time
+import shutil
+import asyncio
+import subprocess
+import tempfile
+import threading
+import unittest
+
+# Add project dir to path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "investor-mail-system"))
+
+import database
+from config import MAX_SEND_ATTEMPTS
+from rate_limiter import RateLimiter, SendQuotaLimiter, AdaptiveThrottle, SendResult, TRANSIENT, DISCONNECTED
+from async_sender import (
+    AsyncSMTPTransport, AsyncGmailTransport, AsyncGmailBatchTransport, AsyncSendEngine, run_campaign, run_messages
+)
+from smtp_sink import SMTPSink
+
+BODY = "<html><body>Merhaba {{ad}}</body></html>"
+SUBJECT = "{{sirket}} için"
+
+
+def recipients(count):
+    return [{'email': f'yatirimci{i}@example.com', 'name': f'Yatırımcı {i}', 'company': f'Fon {i}'}
+            for i in range(count)]
+
+
+class FakeGmail:
+    """Stands in for GmailOAuth, recording how many sends overlap"""
+
+    def __init__(self, delay=0.02, tempfail=0):
+        self.delay = delay
+        self.tempfail = tempfail
+        self.sent = []
+        self.batches = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def send_email(self, to_email, subject, body_html, attachments=None, throttle=True, message_id=None):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+            if self.tempfail:
+                self.tempfail -= 1
+                return SendResult(False, "⏳ Geçici hata: 429 rateLimitExceeded", TRANSIENT)
+            self.sent.append((to_email, subject))
+        return True, "✅ Gönderildi"
+
+    def send_batch(self, messages, attachments=None, batch_size=10):
+        self.batches.append(len(messages))
+        return [self.send_email(to_email, subject, body_html, attachments, False, message_id)
+                for to_email, subject, body_html, message_id in messages]
+
+
+class AsyncSendEngineTest(unittest.TestCase):
+    """Async engine against a local SMTP sink and a fake Gmail client"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.original_path = database.DATABASE_PATH
+        cls.tmp_dir = tempfile.mkdtemp(prefix="investor_mail_async_")
+        database.open_database(os.path.join(cls.tmp_dir, "async.db"))
+        database.add_unsubscribe("yatirimci3@example.com")
+
+    @classmethod
+    def tearDownClass(cls):
+        database.open_database(cls.original_path)
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+
+    def setUp(self):
+        self.sink = SMTPSink(latency=0.02).start()
+
+    def tearDown(self):
+        self.sink.stop()
+
+    def smtp_transport(self, size=4):
+        return AsyncSMTPTransport("me@example.com", "", size=size, server="127.0.0.1",
+                                  port=self.sink.port, starttls=False)
+
+    def campaign(self, transport, count, interval=0.0, throttle=None):
+        throttle = throttle or AdaptiveThrottle(interval, backoff_base=0.01)
+
+        async def run():
+            async with AsyncSendEngine(transport, rate_limiter=RateLimiter(interval), throttle=throttle) as engine:
+                return [r async for r in engine.send_campaign(recipients(count), SUBJECT, BODY)]
+        return asyncio.run(run())
+
+    def test_smtp_campaign(self):
+        results = self.campaign(self.smtp_transport(), 20)
+        self.assertEqual(len(results), 20)
+        self.assertEqual(sorted(r['key'] for r in results), list(range(20)))
+        failed = [r for r in results if not r['success']]
+        self.assertEqual([r['recipient']['email'] for r in failed], ["yatirimci3@example.com"])
+        self.assertEqual(len(self.sink.messages), 19)
+        self.assertEqual(self.sink.sessions, 4)
+
+    def test_messages_overlap(self):
+        self.sink.latency = 0.05
+        start = time.monotonic()
+        self.campaign(self.smtp_transport(size=8), 41)
+        # 40 deliveries at 50 ms each would take 2 s one by one
+        self.assertLess(time.monotonic() - start, 1.2)
+
+    def test_rate_limit(self):
+        start = time.monotonic()
+        self.campaign(self.smtp_transport(size=8), 11, interval=0.05)
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+
+    def test_reconnects_dropped_sessions(self):
+        self.sink.drop_after = 2
+        transport = self.smtp_transport(size=2)
+        results = self.campaign(transport, 10)
+        self.assertEqual(sum(r['success'] for r in results), 9)
+        self.assertGreater(transport.reconnects, 0)
+
+    def test_timed_out_session_is_closed(self):
+        transport = self.smtp_transport(size=1)
+        transport.sessions[0].timeout = 0.1
+
+        async def run():
+            await transport.start()
+            try:
+                self.sink.latency = 0.3
+                late = await transport.send("gec@example.com", "Konu", "<p>Gövde</p>", None)
+                self.sink.latency = 0
+                # A fresh session, not the late "250" of the timed-out DATA
+                next_result = await transport.send("sonraki@example.com", "Konu", "<p>Gövde</p>", None)
+            finally:
+                await transport.stop()
+            return late, next_result
+
+        late, next_result = asyncio.run(run())
+        self.assertFalse(late.success)
+        self.assertEqual(late.error_kind, DISCONNECTED)
+        self.assertTrue(late.transient)
+        self.assertTrue(next_result.success)
+        self.assertEqual(transport.reconnects, 1)
+
+    def test_rate_limiter_off_the_event_loop(self):
+        threads = []
+
+        class RecordingLimiter(RateLimiter):
+            def reserve(self):
+                threads.append(threading.get_ident())
+                return super().reserve()
+
+        async def run():
+            async with AsyncSendEngine(self.smtp_transport(size=2), rate_limiter=RecordingLimiter(0),
+                                       throttle=AdaptiveThrottle(0)) as engine:
+                results = [r async for r in engine.send_campaign(recipients(3), SUBJECT, BODY)]
+            return results, threading.get_ident()
+
+        results, loop_thread = asyncio.run(run())
+        self.assertEqual(len(results), 3)
+        self.assertEqual(len(threads), 3)
+        self.assertNotIn(loop_thread, threads)
+
+    @unittest.skipUnless(shutil.which("openssl"), "needs the openssl command for a test certificate")
+    def test_starttls(self):
+        cert = os.path.join(self.tmp_dir, "sink.pem")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                        "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+                        "-keyout", cert, "-out", cert], check=True, capture_output=True)
+        server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        server_context.load_cert_chain(cert)
+        sink = SMTPSink(tls_context=server_context).start()
+        self.addCleanup(sink.stop)
+
+        transport = AsyncSMTPTransport("me@example.com", "", size=2, server="127.0.0.1", port=sink.port,
+                                       tls_context=ssl.create_default_context(cafile=cert))
+        results = self.campaign(transport, 6)
+        self.assertEqual(sum(r['success'] for r in results), 5)  # yatirimci3 is unsubscribed
+        self.assertEqual((sink.sessions, sink.tls_sessions), (2, 2))
+        self.assertEqual(len(sink.messages), 5)
+
+    def test_gmail_transport_concurrency(self):
+        gmail = FakeGmail()
+        results = self.campaign(AsyncGmailTransport(gmail, max_workers=4), 20)
+        self.assertEqual(len(gmail.sent), 19)
+        self.assertTrue(all(r['success'] for r in results if r['key'] != 3))
+        self.assertGreater(gmail.max_active, 1)
+        self.assertLessEqual(gmail.max_active, 4)
+
+    def test_gmail_batches(self):
+        gmail = FakeGmail(delay=0, tempfail=2)
+        results = self.campaign(AsyncGmailBatchTransport(gmail, batch_size=5), 20)
+        self.assertEqual(sorted(r['key'] for r in results), list(range(20)))
+        # Every message sent once (yatirimci3 is unsubscribed), whichever batches the retries land in
+        expected = sorted(f'yatirimci{i}@example.com' for i in range(20) if i != 3)
+        self.assertEqual(sorted(to_email for to_email, _ in gmail.sent), expected)
+        self.assertLessEqual(max(gmail.batches), 5)
+        # 19 messages plus the two retried items, each try in some batch
+        self.assertEqual(sum(gmail.batches), 19 + 2)
+        self.assertEqual(sum(r['attempts'] for r in results if r['success']), 19 + 2)
+
+    def test_requeues_transient_failures(self):
+        self.sink.tempfail = 2
+        throttle = AdaptiveThrottle(0.01, backoff_base=0.01)
+        results = self.campaign(self.smtp_transport(size=2), 6, throttle=throttle)
+        self.assertEqual(sum(r['success'] for r in results), 5)
+        self.assertEqual(sum(r['attempts'] for r in results if r['success']), 5 + 2)
+        self.assertLess(throttle.factor, 1)
+
+        gmail = FakeGmail(delay=0, tempfail=100)
+        results = self.campaign(AsyncGmailTransport(gmail, max_workers=2), 3,
+                                throttle=AdaptiveThrottle(0.001, backoff_base=0.001))
+        # Gives up after MAX_SEND_ATTEMPTS tries
+        self.assertFalse(any(r['success'] for r in results))
+        self.assertEqual({r['attempts'] for r in results if r['key'] != 3}, {MAX_SEND_ATTEMPTS})
+
+    def test_only_delivered_mails_use_quota(self):
+        self.sink.tempfail = 2
+        limiter = SendQuotaLimiter(interval=0, burst=100, daily_limit=100)
+        before = limiter.status()['sent_24h']
+        results = list(run_campaign(self.smtp_transport(size=2), recipients(6), SUBJECT, BODY, rate_limiter=limiter,
+                                    throttle=AdaptiveThrottle(0.001, backoff_base=0.001)))
+        self.assertEqual(sum(r['success'] for r in results), 5)
+        # The two transient failures were refunded, yatirimci3 (unsubscribed) never took a slot
+        self.assertEqual(limiter.status()['sent_24h'] - before, 5)
+
+    def test_sync_bridge(self):
+        messages = [(f"id-{i}", None, f"kisi{i}@example.com", "Konu", "<p>Gövde</p>") for i in range(5)]
+        results = list(run_messages(self.smtp_transport(size=2), messages, rate_limiter=RateLimiter(0)))
+        self.assertEqual(sorted(r['key'] for r in results), [f"id-{i}" for i in range(5)])
+
+        results = list(run_campaign(self.smtp_transport(size=2), recipients(5), SUBJECT, BODY,
+                                    rate_limiter=RateLimiter(0)))
+        self.assertEqual(len(results), 5)
+
+    def test_sync_bridge_raises(self):
+        transport = AsyncSMTPTransport("me@example.com", "", server="127.0.0.1", port=1, starttls=False)
+        with self.assertRaises(OSError):
+            list(run_campaign(transport, recipients(1), SUBJECT, BODY, rate_limiter=RateLimiter(0)))
+
+    def test_sync_bridge_close_stops_sending(self):
+        self.sink.latency = 0.05
+        results = run_campaign(self.smtp_transport(size=1), recipients(20), SUBJECT, BODY,
+                               rate_limiter=RateLimiter(0))
+        next(results)
+        results.close()
+        time.sleep(0.1)
+        sent = len(self.sink.messages)
+        time.sleep(0.3)
+        self.assertEqual(len(self.sink.messages), sent)
+        self.assertLess(sent, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+# Add project dir to path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "investor-mail-system"))
+
+import database
+import data_cache
+from data_cache import TableCache
+
+
+class TableCacheTest(unittest.TestCase):
+    """Cached reads are reused until a write to their tables commits"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.original_path = database.DATABASE_PATH
+        cls.tmp_dir = tempfile.mkdtemp(prefix="investor_mail_cache_")
+        database.open_database(os.path.join(cls.tmp_dir, "cache.db"))
+
+    @classmethod
+    def tearDownClass(cls):
+        database.open_database(cls.original_path)
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+
+    def setUp(self):
+        self.cache = TableCache(ttl=3600)
+        self.loads = 0
+        patcher = mock.patch.object(data_cache, '_cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def count_loads(self):
+        original = database.get_all_investors
+
+        def loader():
+            self.loads += 1
+            return original()
+        return mock.patch.object(database, 'get_all_investors', loader)
+
+    def test_reruns_served_from_memory(self):
+        with self.count_loads():
+            first = data_cache.get_all_investors()
+            for _ in range(10):
+                self.assertIs(data_cache.get_all_investors(), first)
+        self.assertEqual(self.loads, 1)
+        self.assertEqual(self.cache.stats()['hits'], 10)
+
+    def test_writes_invalidate_their_tables(self):
+        with self.count_loads():
+            data_cache.get_all_investors()
+            stats = data_cache.get_stats()
+            database.add_investor("Cem", "cem@example.com")
+            self.assertIn("cem@example.com", [inv['email'] for inv in data_cache.get_all_investors()])
+            self.assertEqual(data_cache.get_stats()['total_investors'], stats['total_investors'] + 1)
+
+            # Templates are another table, the investor list stays cached
+            database.add_template("Yeni", "Konu", "<p>Gövde</p>")
+            data_cache.get_all_investors()
+        self.assertEqual(self.loads, 2)
+        self.assertIn("Yeni", [t['name'] for t in data_cache.get_all_templates()])
+
+    def test_invalidated_on_commit_only(self):
+        before = data_cache.get_all_investors()
+        with database.db_connection():
+            database.add_investor("Deniz", "deniz@example.com")
+            # Not committed yet: the generation has not moved
+            self.assertIs(data_cache.get_all_investors(), before)
+        self.assertIsNot(data_cache.get_all_investors(), before)
+
+        generations = database.get_table_generations('investors')
+        with self.assertRaises(RuntimeError):
+            with database.db_connection():
+                database.add_investor("Ece", "ece@example.com")
+                raise RuntimeError("rollback")
+        self.assertEqual(database.get_table_generations('investors'), generations)
+
+    def test_ttl_for_other_processes(self):
+        self.cache.ttl = 0
+        with self.count_loads():
+            data_cache.get_all_investors()
+            data_cache.get_all_investors()
+        self.assertEqual(self.loads, 2)
+
+
+    def test_size_is_bounded(self):
+        self.cache.max_size = 3
+        template_ids = [database.add_template(f"Şablon {i}", "Konu", "<p>Gövde</p>") for i in range(5)]
+        for template_id in template_ids:
+            data_cache.get_template_by_id(template_id)
+        stats = self.cache.stats()
+        self.assertEqual((stats['size'], stats['evictions']), (3, 2))
+
+        # Least recently used go first
+        data_cache.get_template_by_id(template_ids[2])
+        data_cache.get_all_investors()
+        hits = self.cache.stats()['hits']
+        data_cache.get_template_by_id(template_ids[2])
+        data_cache.get_template_by_id(template_ids[4])
+        self.assertEqual(self.cache.stats()['hits'], hits + 2)
+
+    def test_changed_tables_drop_their_entries(self):
+        template_ids = [database.add_template(f"Taslak {i}", "Konu", "<p>Gövde</p>") for i in range(3)]
+        for template_id in template_ids:
+            data_cache.get_template_by_id(template_id)
+        data_cache.get_all_investors()
+        self.assertEqual(self.cache.stats()['size'], 4)
+
+        database.delete_template(template_ids[0])
+        data_cache.get_all_templates()
+        # The per-template entries were loaded before the delete; the investors one is still good
+        self.assertEqual(self.cache.stats()['size'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+"""
+Gmail API batch sending tests
+
+GmailOAuth runs against a fake Gmail endpoint speaking the batch protocol
+(multipart/mixed of application/http parts), so the real googleapiclient
+request and batch code is exercised without network access.
+"""
+import os
+import sys
+import json
+import base64
+import email
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+import httplib2
+from google.oauth2.credentials import Credentials
+
+# Add project dir to path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "investor-mail-system"))
+
+import gmail_oauth
+from gmail_oauth import GmailOAuth, GmailServiceCache
+from rate_limiter import TRANSIENT, PERMANENT
+
+
+def _error(status, reason):
+    return json.dumps({'error': {'code': status, 'message': reason, 'errors': [{'reason': reason}]}})
+
+
+class FakeGmailServer:
+    """
+    Answers messages.send and batch requests like gmail.googleapis.com
+
+    fail: {to_email: [(status, reason), ...]} errors returned for that recipient, one per send
+    batch_status: status for the next batch request as a whole (e.g. 503)
+    """
+
+    def __init__(self, fail=None):
+        self.fail = fail or {}
+        self.batch_status = None
+        self.requests = 0
+        self.sent = []
+
+    def close(self):
+        pass
+
+    def _send(self, payload):
+        raw = json.loads(payload)['raw']
+        to_email = email.message_from_bytes(base64.urlsafe_b64decode(raw))['To']
+        if self.fail.get(to_email):
+            status, reason = self.fail[to_email].pop(0)
+            return status, _error(status, reason)
+        self.sent.append(to_email)
+        return 200, json.dumps({'id': f'm{len(self.sent)}'})
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        self.requests += 1
+        if uri.split('?')[0].endswith('/profile'):
+            return httplib2.Response({'status': '200', 'content-type': 'application/json'}), \
+                json.dumps({'emailAddress': 'ben@example.com'}).encode()
+        if not uri.endswith('/batch'):
+            status, content = self._send(body)
+            return httplib2.Response({'status': str(status), 'content-type': 'application/json'}), content.encode()
+
+        if self.batch_status:
+            status, self.batch_status = self.batch_status, None
+            return httplib2.Response({'status': str(status), 'content-type': 'application/json'}), \
+                _error(status, 'backendError').encode()
+
+        request = email.message_from_string(f"content-type: {headers['content-type']}\r\n\r\n{body}")
+        parts = []
+        for part in request.get_payload():
+            # application/http part: request line and headers, blank line, JSON body
+            status, content = self._send(part.get_payload().replace('\r\n', '\n').split('\n\n', 1)[1])
+            parts.append(
+                f"--batch\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{part['Content-ID'][1:-1]}>\r\n\r\n"
+                f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n\r\n{content}\r\n"
+            )
+        content = ''.join(parts) + "--batch--\r\n"
+        return httplib2.Response({'status': '200', 'content-type': 'multipart/mixed; boundary=batch'}), \
+            content.encode()
+
+
+class GmailBatchTest(unittest.TestCase):
+    """GmailOAuth.send_batch and the pooled keep-alive connections"""
+
+    def setUp(self):
+        self.server = FakeGmailServer()
+        patcher = mock.patch.object(gmail_oauth.httplib2, 'Http', return_value=self.server)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(gmail_oauth.get_service_cache().clear)
+
+        self.oauth = GmailOAuth()
+        self.oauth.creds = Credentials(token='token')
+        self.oauth._init_service()
+
+    def connections(self):
+        return self.oauth._pool().created
+
+    def messages(self, count):
+        return [(f'kisi{i}@example.com', f'Konu {i}', f'<p>Gövde {i}</p>', None) for i in range(count)]
+
+    def test_batches_round_trips(self):
+        results = self.oauth.send_batch(self.messages(25), batch_size=10)
+        self.assertTrue(all(success for success, _ in results))
+        self.assertEqual(sorted(self.server.sent), sorted(f'kisi{i}@example.com' for i in range(25)))
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(self.oauth.round_trips, 3)
+        # Every request reused the one keep-alive connection
+        self.assertEqual(self.connections(), 1)
+
+        self.oauth.send_email('tek@example.com', 'Konu', '<p>Gövde</p>', throttle=False)
+        self.assertEqual(self.connections(), 1)
+
+    def test_per_item_results(self):
+        self.server.fail = {'kisi1@example.com': [(429, 'rateLimitExceeded')],
+                            'kisi3@example.com': [(400, 'invalidArgument')]}
+        results = self.oauth.send_batch(self.messages(5))
+        self.assertEqual([r.success for r in results], [True, False, True, False, True])
+        self.assertEqual(results[1].error_kind, TRANSIENT)
+        self.assertEqual(results[3].error_kind, PERMANENT)
+
+    def test_whole_batch_failure(self):
+        self.server.batch_status = 503
+        results = self.oauth.send_batch(self.messages(4))
+        self.assertTrue(all(r.error_kind == TRANSIENT for r in results))
+        self.assertEqual(self.server.sent, [])
+
+    def test_large_messages_go_alone(self):
+        messages = self.messages(3)
+        messages[1] = ('buyuk@example.com', 'Konu', '<p>' + 'x' * 5000 + '</p>', None)
+        with mock.patch.object(gmail_oauth, 'GMAIL_BATCH_MAX_BYTES', 4000):
+            results = self.oauth.send_batch(messages)
+        self.assertTrue(all(r.success for r in results))
+        self.assertEqual(self.server.requests, 2)
+
+    def test_new_credentials_new_pool(self):
+        self.oauth.send_batch(self.messages(2))
+        first = self.oauth._pool()
+        self.oauth.creds = Credentials(token='other')
+        self.oauth.send_batch(self.messages(2))
+        self.assertIsNot(self.oauth._pool(), first)
+        self.assertEqual(self.connections(), 1)
+
+
+class GmailServiceCacheTest(unittest.TestCase):
+    """One service, profile lookup and token file read per credential"""
+
+    def setUp(self):
+        self.server = FakeGmailServer()
+        patcher = mock.patch.object(gmail_oauth.httplib2, 'Http', return_value=self.server)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.tmp_dir = tempfile.mkdtemp(prefix="investor_mail_oauth_")
+        self.addCleanup(shutil.rmtree, self.tmp_dir, ignore_errors=True)
+        self.token_file = os.path.join(self.tmp_dir, 'gmail_token.json')
+        self.write_token('ilk', datetime.utcnow() + timedelta(hours=1))
+        self.cache = GmailServiceCache(refresh_margin=600)
+
+    def write_token(self, token, expiry):
+        with open(self.token_file, 'w') as f:
+            json.dump({'token': token, 'refresh_token': 'yenileme', 'client_id': 'istemci',
+                       'client_secret': 'gizli', 'expiry': expiry.strftime('%Y-%m-%dT%H:%M:%SZ')}, f)
+
+    def test_reuses_service_and_profile(self):
+        with mock.patch.object(gmail_oauth, 'get_service_cache', return_value=self.cache), \
+                mock.patch.object(gmail_oauth, 'TOKEN_FILE', self.token_file):
+            clients = [GmailOAuth() for _ in range(3)]
+            for oauth in clients:
+                self.assertTrue(oauth.load_saved_credentials())
+
+        self.assertEqual({oauth.get_user_email() for oauth in clients}, {'ben@example.com'})
+        self.assertEqual(len({id(oauth.service) for oauth in clients}), 1)
+        self.assertEqual(self.cache.builds, 1)
+        self.assertEqual(self.server.requests, 1)  # getProfile
+
+    def test_reloads_changed_token_file(self):
+        creds = self.cache.load(self.token_file, gmail_oauth.SCOPES)
+        self.assertIs(self.cache.load(self.token_file, gmail_oauth.SCOPES), creds)
+
+        self.write_token('yeni', datetime.utcnow() + timedelta(hours=1))
+        os.utime(self.token_file, (0, os.path.getmtime(self.token_file) + 10))
+        self.assertEqual(self.cache.load(self.token_file, gmail_oauth.SCOPES).token, 'yeni')
+
+    def test_refreshes_ahead_of_expiry(self):
+        self.write_token('ilk', datetime.utcnow() + timedelta(minutes=5))
+        creds = self.cache.load(self.token_file, gmail_oauth.SCOPES)
+        self.assertTrue(creds.valid)
+
+        def refresh(request):
+            creds.token = 'yenilendi'
+            creds.expiry = datetime.utcnow() + timedelta(hours=1)
+
+        with mock.patch.object(creds, 'refresh', side_effect=refresh):
+            self.assertEqual(self.cache.refresh_due(), 1)
+            self.assertEqual(self.cache.refresh_due(), 0)
+
+        # Saved for the next start, and the rewritten file is not read again
+        with open(self.token_file) as f:
+            self.assertEqual(json.load(f)['token'], 'yenilendi')
+        self.assertIs(self.cache.load(self.token_file, gmail_oauth.SCOPES), creds)
+
+
+if __name__ == '__main__':
+    unittest.main()
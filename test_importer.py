@@ -0,0 +1,184 @@
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import pandas as pd
+
+# Add project dir to path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "investor-mail-system"))
+
+import database
+import importer
+from importer import dataframe_to_investor_rows, import_dataframe, stream_import, file_fingerprint
+
+
+class ImportRowsTest(unittest.TestCase):
+    """Column-wise row building and the executemany upsert behind it"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.original_path = database.DATABASE_PATH
+        cls.tmp_dir = tempfile.mkdtemp(prefix="investor_mail_import_")
+        database.open_database(os.path.join(cls.tmp_dir, "import.db"))
+
+    @classmethod
+    def tearDownClass(cls):
+        database.open_database(cls.original_path)
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+
+    def investor(self, email):
+        with database.db_connection() as conn:
+            row = conn.execute("SELECT * FROM investors WHERE email = ?", (email,)).fetchone()
+        return dict(row) if row else None
+
+    def test_rows_from_standard_sheet(self):
+        df = pd.DataFrame({
+            'İsim': ["  Ali Veli ", "", "Boş Mail", np.nan, "Ece"],
+            'Name': [np.nan, "Ayşe", "", "Adsız", np.nan],
+            'Email': ["ali@example.com", "ayse@example.com", "  ", "adsiz@example.com", np.nan],
+            'E-posta': [np.nan, np.nan, np.nan, np.nan, "ece@example.com"],
+            'Kategori': ["VC", np.nan, "", "MELEK", ""],
+            'Telefon': ["05321234567", "", "", "", ""],
+        })
+        rows, invalid = dataframe_to_investor_rows(df)
+
+        self.assertEqual(invalid, 1)  # Blank email
+        self.assertEqual(rows, [
+            ("Ali Veli", "ali@example.com", "", "VC", "", "05321234567", "", "NEW", ""),
+            ("Ayşe", "ayse@example.com", "", "GENEL", "", "", "", "NEW", ""),
+            ("Adsız", "adsiz@example.com", "", "MELEK", "", "", "", "NEW", ""),
+            ("Ece", "ece@example.com", "", "GENEL", "", "", "", "NEW", ""),
+        ])
+        self.assertEqual(len(rows[0]), len(database.INVESTOR_IMPORT_COLUMNS))
+
+    def test_rows_from_linkedin_export(self):
+        df = pd.DataFrame({
+            'First Name': ["Can", "Gizli"],
+            'Last Name': ["Tan", "Kişi"],
+            'Email Address': ["can@example.com", np.nan],
+            'Company': ["Tan Capital", "X"],
+            'Position': ["Partner", "CEO"],
+        })
+        rows, invalid = dataframe_to_investor_rows(df, 'linkedin')
+        self.assertEqual(invalid, 1)
+        self.assertEqual(rows, [("Can Tan", "can@example.com", "Tan Capital", "GENEL",
+                                 "LinkedIn Import. Position: Partner", "", "", "NEW", "")])
+
+        with self.assertRaises(ValueError):
+            dataframe_to_investor_rows(df, 'vcard')
+
+    def test_counts_and_conflicts(self):
+        first = pd.DataFrame({
+            'İsim': ["Deniz", "Efe", ""],
+            'Email': ["deniz@example.com", "efe@example.com", "isimsiz@example.com"],
+            'Şirket': ["Deniz VC", "Efe Fon", ""],
+        })
+        self.assertEqual(import_dataframe(first), {'added': 2, 'updated': 0, 'skipped': 0, 'invalid': 1})
+
+        # Keep existing: stored values stay, new emails are added
+        second = pd.DataFrame({
+            'İsim': ["Deniz Yeni", "Fatma"],
+            'Email': ["deniz@example.com", "fatma@example.com"],
+            'Şirket': ["Başka Şirket", ""],
+        })
+        self.assertEqual(import_dataframe(second), {'added': 1, 'updated': 0, 'skipped': 1, 'invalid': 0})
+        self.assertEqual(self.investor("deniz@example.com")['company'], "Deniz VC")
+
+        # Overwrite: imported values win, blank cells never erase stored ones
+        database.delete_investor(self.investor("efe@example.com")['id'])
+        third = pd.DataFrame({
+            'İsim': ["Deniz Yeni", "Efe", "Efe Tekrar"],
+            'Email': ["deniz@example.com", "efe@example.com", "efe@example.com"],
+            'Şirket': ["", "Efe Holding", ""],
+        })
+        self.assertEqual(import_dataframe(third, on_conflict='update'),
+                         {'added': 0, 'updated': 3, 'skipped': 0, 'invalid': 0})
+        deniz = self.investor("deniz@example.com")
+        self.assertEqual((deniz['name'], deniz['company']), ("Deniz Yeni", "Deniz VC"))
+        efe = self.investor("efe@example.com")
+        self.assertEqual((efe['name'], efe['company'], efe['is_active']), ("Efe Tekrar", "Efe Holding", 1))
+
+        with self.assertRaises(ValueError):
+            import_dataframe(first, on_conflict='replace')
+
+
+class Interrupted(Exception):
+    pass
+
+
+class StreamImportTest(unittest.TestCase):
+    """Chunked imports resume after the last committed chunk of the same file"""
+
+    def setUp(self):
+        self.original_path = database.DATABASE_PATH
+        self.tmp_dir = tempfile.mkdtemp(prefix="investor_mail_stream_")
+        database.open_database(os.path.join(self.tmp_dir, "stream.db"))
+        self.addCleanup(shutil.rmtree, self.tmp_dir, ignore_errors=True)
+        self.addCleanup(database.open_database, self.original_path)
+
+        lines = ["İsim,Email,Şirket"] + [f"Kişi {i},kisi{i}@example.com,Fon {i % 7}" for i in range(95)]
+        lines.append(",eksik@example.com,")  # No name: invalid
+        self.csv = io.BytesIO("\n".join(lines).encode('utf-8'))
+
+        self.upserted = []
+        original = importer.bulk_upsert_investors
+
+        def counting_upsert(rows, on_conflict="skip"):
+            self.upserted.extend(row[1] for row in rows)
+            return original(rows, on_conflict)
+        patcher = mock.patch.object(importer, 'bulk_upsert_investors', counting_upsert)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_resumes_after_interruption(self):
+        def interrupt_after_three_chunks(rows_done, fraction):
+            if rows_done >= 30:
+                raise Interrupted()
+
+        with self.assertRaises(Interrupted):
+            stream_import(self.csv, "yatirimcilar.csv", chunk_size=10,
+                          progress_callback=interrupt_after_three_chunks)
+        job = database.get_import_job(file_fingerprint(self.csv))
+        self.assertEqual((job['status'], job['rows_committed'], job['added']), ('running', 30, 30))
+        self.assertEqual([j['id'] for j in database.get_unfinished_import_jobs()], [job['id']])
+
+        # Uploaded again with another chunk size: the job keeps its own chunk boundaries
+        progress = []
+        job = stream_import(self.csv, "yatirimcilar.csv", chunk_size=25,
+                            progress_callback=lambda rows_done, fraction: progress.append(rows_done))
+        self.assertEqual(progress, [40, 50, 60, 70, 80, 90, 96])
+        self.assertEqual(len(self.upserted), 95)
+        self.assertEqual(len(set(self.upserted)), 95)  # No chunk written twice
+        self.assertEqual((job['status'], job['rows_committed']), ('done', 96))
+        self.assertEqual((job['added'], job['updated'], job['skipped'], job['invalid']), (95, 0, 0, 1))
+        self.assertEqual(database.count_investors(), 95)
+        self.assertEqual(database.get_unfinished_import_jobs(), [])
+
+    def test_finished_file_imports_again(self):
+        stream_import(self.csv, "yatirimcilar.csv", chunk_size=40)
+        job = stream_import(self.csv, "yatirimcilar.csv", chunk_size=40)
+        self.assertEqual(len(self.upserted), 2 * 95)
+        self.assertEqual((job['added'], job['skipped'], job['rows_committed']), (0, 95, 96))
+
+    def test_import_jobs_table_is_a_migration(self):
+        def has_table():
+            with database.db_connection() as conn:
+                return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'import_jobs'").fetchone() is not None
+
+        with database.db_connection() as conn:
+            conn.execute("DROP TABLE import_jobs")
+            conn.execute("PRAGMA user_version = 8")  # Before schema v9, which added import_jobs
+            database._create_tables(conn.cursor())
+        self.assertFalse(has_table())
+
+        database.run_migrations()
+        self.assertTrue(has_table())
+        self.assertEqual(database.get_schema_version(), database.SCHEMA_MIGRATIONS[-1][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
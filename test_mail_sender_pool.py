@@ -0,0 +1,117 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+# Add project dir to path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "investor-mail-system"))
+
+import database
+from mail_sender import MailSenderPool
+from rate_limiter import RateLimiter, AdaptiveThrottle
+from smtp_sink import SMTPSink
+
+BODY = "<html><body>Merhaba {{ad}}</body></html>"
+SUBJECT = "{{sirket}} için"
+
+
+def recipients(count):
+    return [{'email': f'yatirimci{i}@example.com', 'name': f'Yatırımcı {i}', 'company': f'Fon {i}'}
+            for i in range(count)]
+
+
+class MailSenderPoolTest(unittest.TestCase):
+    """MailSenderPool against a local SMTP sink"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.original_path = database.DATABASE_PATH
+        cls.tmp_dir = tempfile.mkdtemp(prefix="investor_mail_pool_")
+        database.open_database(os.path.join(cls.tmp_dir, "pool.db"))
+        database.add_unsubscribe("yatirimci3@example.com")
+
+    @classmethod
+    def tearDownClass(cls):
+        database.open_database(cls.original_path)
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+
+    def setUp(self):
+        self.sink = SMTPSink().start()
+
+    def tearDown(self):
+        self.sink.stop()
+
+    def make_pool(self, size=4, interval=0.0, **kwargs):
+        kwargs.setdefault('throttle', AdaptiveThrottle(interval, backoff_base=0.01))
+        pool = MailSenderPool("me@example.com", "", size=size, server="127.0.0.1", port=self.sink.port,
+                              starttls=False, rate_limiter=RateLimiter(interval), **kwargs)
+        self.assertTrue(pool.connect()[0])
+        self.addCleanup(pool.disconnect)
+        return pool
+
+    def test_results_in_recipient_order(self):
+        progress = []
+        results = self.make_pool().send_bulk(
+            recipients(20), SUBJECT, BODY, progress_callback=lambda done, total, *_: progress.append(done)
+        )
+        self.assertEqual([r['recipient']['email'] for r in results], [r['email'] for r in recipients(20)])
+        self.assertEqual(progress, list(range(1, 21)))
+        self.assertEqual(len(self.sink.messages), 19)
+        self.assertFalse(results[3]['success'])
+        self.assertIn("Unsubscribed", results[3]['message'])
+
+    def test_messages_use_every_session(self):
+        self.make_pool(size=4).send_bulk(recipients(12), SUBJECT, BODY)
+        self.assertEqual(self.sink.sessions, 4)
+        delivered = sorted(rcpt[0] for _, rcpt, _ in self.sink.messages)
+        self.assertIn("yatirimci0@example.com", delivered)
+
+    def test_rate_limit_is_shared(self):
+        pool = self.make_pool(size=4, interval=0.05)
+        start = time.monotonic()
+        pool.send_bulk(recipients(11), SUBJECT, BODY)
+        # 10 deliveries (one unsubscribed) need at least 9 intervals, whatever the pool size
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+
+    def test_reconnects_dropped_sessions(self):
+        self.sink.drop_after = 2
+        pool = self.make_pool(size=2)
+        results = pool.send_bulk(recipients(10), SUBJECT, BODY)
+        self.assertTrue(all(r['success'] for i, r in enumerate(results) if i != 3))
+        self.assertGreater(pool.reconnects, 0)
+
+    def test_requeues_transient_failures(self):
+        self.sink.tempfail = 3
+        throttle = AdaptiveThrottle(0.01, backoff_base=0.01)
+        results = self.make_pool(size=2, throttle=throttle).send_bulk(recipients(6), SUBJECT, BODY)
+        self.assertTrue(all(r['success'] for i, r in enumerate(results) if i != 3))
+        self.assertEqual(len(self.sink.messages), 5)
+        self.assertLess(throttle.factor, 1)
+        self.assertEqual(throttle.metrics()['transient'], 3)
+
+    def test_stops_when_progress_callback_raises(self):
+        self.sink.latency = 0.02
+
+        def stop_after_first(done, total, *_):
+            raise KeyboardInterrupt()  # What a Streamlit rerun looks like here
+
+        with self.assertRaises(KeyboardInterrupt):
+            self.make_pool(size=2).send_bulk(recipients(30), SUBJECT, BODY, progress_callback=stop_after_first)
+        # At most what was in flight when it stopped; nothing is sent afterwards
+        sent = len(self.sink.messages)
+        self.assertLessEqual(sent, 4)
+        time.sleep(0.2)
+        self.assertEqual(len(self.sink.messages), sent)
+
+    def test_health_check_on_idle_session(self):
+        pool = self.make_pool(size=1, health_check_seconds=0)
+        pool.senders[0].smtp.close()  # Server side is gone, is_connected still says True
+        results = pool.send_bulk(recipients(2), SUBJECT, BODY)
+        self.assertTrue(all(r['success'] for r in results))
+        self.assertEqual(pool.reconnects, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import os
+import sys
+import email
+import asyncio
+import unittest
+from unittest import mock
+from email.header import decode_header
+
+# Add project dir to path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "investor-mail-system"))
+
+from mime_message import build_message, message_chunks, prepare_attachments, close_attachments, PreparedAttachment
+from mail_sender import MailSender
+from async_sender import AsyncSMTPTransport
+from rate_limiter import RateLimiter, AdaptiveThrottle
+from smtp_sink import SMTPSink
+
+DECK = os.urandom(300_000)
+NOTES = "Yatırım notları".encode('utf-8')
+
+
+class AttachmentFile:
+    """Minimal stand-in for a streamlit UploadedFile"""
+
+    def __init__(self, name, content, type):
+        self.name, self.content, self.type = name, content, type
+
+    def read(self):
+        return self.content
+
+    def getvalue(self):
+        return self.content
+
+
+class PreparedAttachmentTest(unittest.TestCase):
+    """Attachments are encoded once and reused verbatim by every message"""
+
+    def build(self, attachments, body="<p>Sayın Ayşe</p>"):
+        raw = build_message("me@example.com", "ayse@example.com", "Sunum – Örnek VC", body, attachments)
+        return raw, email.message_from_bytes(raw)
+
+    def test_round_trip(self):
+        prepared = prepare_attachments([
+            ("deck.pdf", DECK, None),
+            AttachmentFile("notlar.txt", NOTES, "text/plain"),
+        ])
+        raw, parsed = self.build(prepared, "<p>Sayın Ayşe</p>".encode('utf-8'))
+        body, deck, notes = parsed.get_payload()
+
+        self.assertEqual(parsed.defects, [])
+        self.assertEqual(decode_header(parsed['Subject'])[0][0].decode('utf-8'), "Sunum – Örnek VC")
+        self.assertEqual(body.get_payload()[0].get_payload(decode=True).decode('utf-8'), "<p>Sayın Ayşe</p>")
+        self.assertEqual((deck.get_content_type(), deck.get_filename()), ("application/pdf", "deck.pdf"))
+        self.assertEqual(deck.get_payload(decode=True), DECK)
+        self.assertEqual(notes.get_payload(decode=True), NOTES)
+        self.assertNotIn(b'\n', raw.replace(b'\r\n', b''))
+
+    def test_spooled_part_is_identical(self):
+        in_memory = PreparedAttachment("deck.pdf", DECK, spool_threshold=len(DECK))
+        spooled = PreparedAttachment("deck.pdf", DECK, spool_threshold=1024)
+        self.assertFalse(in_memory.spooled)
+        self.assertTrue(spooled.spooled)
+        self.assertEqual(bytes(spooled.data), in_memory.data)
+
+        _, parsed = self.build([spooled])
+        self.assertEqual(parsed.get_payload()[1].get_payload(decode=True), DECK)
+        spooled.close()
+
+    def test_prepared_parts_are_reused(self):
+        prepared = prepare_attachments([("deck.pdf", DECK, "application/pdf")])
+        self.assertIs(prepare_attachments(prepared)[0], prepared[0])
+
+        first, _ = self.build(prepared)
+        second, _ = self.build(prepared)
+        self.assertIn(bytes(prepared[0].data), first)
+        self.assertIn(bytes(prepared[0].data), second)
+        close_attachments(prepared)
+
+    def test_chunks_share_the_spooled_part(self):
+        spooled = PreparedAttachment("deck.pdf", DECK, spool_threshold=1024)
+        self.addCleanup(spooled.close)
+        chunks = message_chunks("me@example.com", "ayse@example.com", "Sunum", "<p>Sayın Ayşe</p>", [spooled])
+        self.assertEqual(sum(chunk is spooled.data for chunk in chunks), 1)
+        self.assertTrue(all(isinstance(chunk, bytes) for chunk in chunks if chunk is not spooled.data))
+        self.assertLess(sum(len(chunk) for chunk in chunks if chunk is not spooled.data), 4096)
+
+    def test_smtp_senders_stream_the_chunks(self):
+        sink = SMTPSink().start()
+        self.addCleanup(sink.stop)
+        spooled = PreparedAttachment("deck.pdf", DECK, spool_threshold=1024)
+        self.addCleanup(spooled.close)
+
+        sender = MailSender("me@example.com", "", "127.0.0.1", sink.port, starttls=False,
+                            rate_limiter=RateLimiter(0), throttle=AdaptiveThrottle(0))
+        sender.connect()
+        self.assertTrue(sender.send_email("ayse@example.com", "Ayşe", "Sunum", "<p>Sayın Ayşe</p>", [spooled]).success)
+        sender.disconnect()
+
+        async def send_async():
+            transport = AsyncSMTPTransport("me@example.com", "", size=1, server="127.0.0.1", port=sink.port,
+                                           starttls=False)
+            await transport.start()
+            try:
+                return await transport.send("ali@example.com", "Sunum", "<p>Sayın Ali</p>", [spooled])
+            finally:
+                await transport.stop()
+        self.assertTrue(asyncio.run(send_async()).success)
+
+        self.assertEqual([rcpt for _, rcpt, _ in sink.messages], [["ayse@example.com"], ["ali@example.com"]])
+        for _, _, data in sink.messages:
+            parsed = email.message_from_bytes(data)
+            self.assertEqual(parsed.defects, [])
+            self.assertEqual(parsed.get_payload()[1].get_payload(decode=True), DECK)
+
+    def test_chunks_need_prepared_attachments(self):
+        with self.assertRaises(TypeError):
+            message_chunks("me@example.com", "ayse@example.com", "Sunum", "<p>Sayın Ayşe</p>",
+                           [("deck.pdf", DECK, None)])
+
+    def test_attachments_prepared_per_message_are_closed(self):
+        sink = SMTPSink().start()
+        self.addCleanup(sink.stop)
+        closed = []
+        close = PreparedAttachment.close
+        prepared = prepare_attachments([("notlar.txt", NOTES, "text/plain")])
+        self.addCleanup(close_attachments, prepared)
+
+        with mock.patch.object(PreparedAttachment, 'close', lambda self: closed.append(self.filename) or close(self)):
+            _, parsed = self.build([("deck.pdf", DECK, None)] + prepared)
+            self.assertEqual(parsed.get_payload()[1].get_payload(decode=True), DECK)
+
+            sender = MailSender("me@example.com", "", "127.0.0.1", sink.port, starttls=False,
+                                rate_limiter=RateLimiter(0), throttle=AdaptiveThrottle(0))
+            sender.connect()
+            self.addCleanup(sender.disconnect)
+            result = sender.send_email("ayse@example.com", "Ayşe", "Sunum", "<p>Sayın Ayşe</p>",
+                                       [AttachmentFile("sunum.pdf", DECK, "application/pdf")] + prepared)
+            self.assertTrue(result.success)
+        # The caller's prepared attachment stays open for the next message
+        self.assertEqual(closed, ["deck.pdf", "sunum.pdf"])
+
+    def test_without_attachments(self):
+        raw, parsed = self.build(None)
+        self.assertEqual(len(parsed.get_payload()), 1)
+        self.assertEqual(parsed.defects, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+import os
+import sys
+import time
+import shutil
+import socket
+import subprocess
+import tempfile
+import unittest
+
+# Add project dir to path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "investor-mail-system"))
+
+import database
+from rate_limiter import RateLimiter, AdaptiveThrottle, DailyQuotaExceeded
+from async_sender import AsyncSMTPTransport
+from outbox import enqueue_campaign, run_outbox, idempotency_key
+from smtp_sink import SMTPSink
+
+BODY = "<html><body>Merhaba {{ad}}</body></html>"
+SUBJECT = "{{sirket}} için"
+
+
+class QuotaAfter(RateLimiter):
+    """No waiting, and the daily quota runs out after `limit` slots"""
+
+    def __init__(self, limit):
+        super().__init__(0)
+        self.limit = limit
+
+    def reserve(self):
+        if self.limit <= 0:
+            raise DailyQuotaExceeded(time.time() + 3600)
+        self.limit -= 1
+        return 0
+
+
+class OutboxTest(unittest.TestCase):
+    """Durable outbox: enqueue, lease, drain and resume"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.original_path = database.DATABASE_PATH
+        cls.tmp_dir = tempfile.mkdtemp(prefix="investor_mail_outbox_")
+
+    @classmethod
+    def tearDownClass(cls):
+        database.open_database(cls.original_path)
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+
+    def setUp(self):
+        database.open_database(os.path.join(self.tmp_dir, f"{self._testMethodName}.db"))
+        database.add_unsubscribe("yatirimci3@example.com")
+        self.recipients = []
+        for i in range(10):
+            email = f"yatirimci{i}@example.com"
+            investor_id = database.add_investor(f"Yatırımcı {i}", email, f"Fon {i}")
+            self.recipients.append({'id': investor_id, 'email': email, 'name': f"Yatırımcı {i}",
+                                    'company': f"Fon {i}"})
+        self.sink = SMTPSink().start()
+
+    def tearDown(self):
+        self.sink.stop()
+
+    def drain(self, campaign_id, rate_limiter=None):
+        transport = AsyncSMTPTransport("me@example.com", "", size=2, server="127.0.0.1",
+                                       port=self.sink.port, starttls=False)
+        return list(run_outbox(transport, campaign_id, rate_limiter=rate_limiter or RateLimiter(0),
+                               throttle=AdaptiveThrottle(0)))
+
+    def delivered(self):
+        return sorted(rcpt[0] for _, rcpt, _ in self.sink.messages)
+
+    def test_campaign_sent_once_per_recipient(self):
+        # The same address twice in the selection is one message
+        campaign_id = enqueue_campaign(self.recipients + self.recipients[:2], SUBJECT, BODY, template_id=None,
+                                       attachments=[("sunum.txt", b"pitch deck", "text/plain")])
+        progress = database.get_campaign_progress(campaign_id)
+        self.assertEqual((progress['total'], progress['queued'], progress['skipped']), (10, 9, 1))
+
+        results = self.drain(campaign_id)
+        self.assertEqual(len(results), 9)
+        self.assertTrue(all(r['state'] == 'sent' for r in results))
+        self.assertEqual(len(self.delivered()), 9)
+        self.assertIn(b'filename="sunum.txt"', self.sink.messages[0][2])
+
+        self.assertEqual(database.get_campaign(campaign_id)['status'], 'done')
+        self.assertEqual(database.get_stats()['total_sent'], 9)
+        self.assertEqual(database.get_unfinished_campaigns(), [])
+
+        # Draining a finished campaign sends nothing
+        self.assertEqual(self.drain(campaign_id), [])
+        self.assertEqual(len(self.sink.messages), 9)
+
+    def test_resume_after_crash(self):
+        campaign_id = enqueue_campaign(self.recipients, SUBJECT, BODY)
+
+        # A worker finished two messages, then died holding a lease on three more
+        done = database.claim_outbox_items(campaign_id, "dead-worker", 2, 600)
+        for item in done:
+            database.complete_outbox_item(item['id'], "dead-worker", 'sent')
+        stuck = database.claim_outbox_items(campaign_id, "dead-worker", 3, -1)
+
+        results = self.drain(campaign_id)
+        self.assertEqual(len(results), 7)
+        self.assertNotIn(done[0]['to_email'], self.delivered())
+        self.assertIn(stuck[0]['to_email'], self.delivered())
+
+        # A resent message keeps the Message-ID derived from its idempotency key
+        key = idempotency_key(campaign_id, stuck[0]['to_email'])
+        message = next(data for _, rcpt, data in self.sink.messages if rcpt[0] == stuck[0]['to_email'])
+        self.assertIn(f"Message-ID: <{key}@investor-mail-system>".encode('ascii'), message)
+        self.assertEqual(database.get_campaign(campaign_id)['status'], 'done')
+
+    def test_reclaims_leases_of_dead_process(self):
+        campaign_id = enqueue_campaign(self.recipients, SUBJECT, BODY)
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        dead = database.claim_outbox_items(campaign_id, f"{socket.gethostname()}:{process.pid}:0000", 3, 600)
+        # Maybe still running on another machine: left until its lease runs out
+        elsewhere = database.claim_outbox_items(campaign_id, "baska-makine:1:0000", 2, 600)
+
+        results = self.drain(campaign_id)
+        self.assertEqual(len(results), 7)
+        self.assertIn(dead[0]['to_email'], self.delivered())
+        self.assertNotIn(elsewhere[0]['to_email'], self.delivered())
+        progress = database.get_campaign_progress(campaign_id)
+        self.assertEqual((progress['sent'], progress['sending']), (7, 2))
+        self.assertEqual(database.get_campaign(campaign_id)['status'], 'running')
+
+    def test_closed_drain_stops_and_requeues(self):
+        self.sink.latency = 0.05
+        campaign_id = enqueue_campaign(self.recipients, SUBJECT, BODY)
+        transport = AsyncSMTPTransport("me@example.com", "", size=1, server="127.0.0.1",
+                                       port=self.sink.port, starttls=False)
+        results = run_outbox(transport, campaign_id, rate_limiter=RateLimiter(0), throttle=AdaptiveThrottle(0))
+        self.assertEqual(next(results)['state'], 'sent')
+        results.close()  # What a Streamlit rerun does to an abandoned drain
+
+        deadline = time.time() + 5
+        while database.get_campaign_progress(campaign_id)['sending'] and time.time() < deadline:
+            time.sleep(0.01)
+        progress = database.get_campaign_progress(campaign_id)
+        self.assertEqual(progress['sending'], 0)
+        self.assertGreater(progress['queued'], 0)
+        sent = len(self.sink.messages)
+        time.sleep(0.3)
+        self.assertEqual(len(self.sink.messages), sent)
+
+        self.drain(campaign_id)
+        self.assertEqual(sorted(set(self.delivered())), sorted(r['email'] for r in self.recipients
+                                                               if r['email'] != "yatirimci3@example.com"))
+        self.assertEqual(database.get_campaign(campaign_id)['status'], 'done')
+
+    def test_quota_stops_and_resumes(self):
+        campaign_id = enqueue_campaign(self.recipients, SUBJECT, BODY)
+
+        results = self.drain(campaign_id, rate_limiter=QuotaAfter(4))
+        self.assertEqual(sum(r['state'] == 'sent' for r in results), 4)
+        progress = database.get_campaign_progress(campaign_id)
+        self.assertEqual((progress['sent'], progress['queued'], progress['sending']), (4, 5, 0))
+        self.assertEqual([c['id'] for c in database.get_unfinished_campaigns()], [campaign_id])
+
+        self.drain(campaign_id)
+        self.assertEqual(len(set(self.delivered())), 9)
+        self.assertEqual(len(self.delivered()), 9)
+        self.assertEqual(database.get_campaign(campaign_id)['status'], 'done')
+
+    def test_leases_are_exclusive(self):
+        campaign_id = enqueue_campaign(self.recipients, SUBJECT, BODY)
+        first = database.claim_outbox_items(campaign_id, "a", 5, 600)
+        second = database.claim_outbox_items(campaign_id, "b", 5, 600)
+        self.assertEqual((len(first), len(second)), (5, 4))
+        self.assertFalse({i['id'] for i in first} & {i['id'] for i in second})
+
+        # Only the lease owner can finish a message
+        self.assertFalse(database.complete_outbox_item(first[0]['id'], "b", 'sent'))
+        self.assertTrue(database.complete_outbox_item(first[0]['id'], "a", 'sent'))
+
+    def test_cancel(self):
+        campaign_id = enqueue_campaign(self.recipients, SUBJECT, BODY)
+        database.cancel_campaign(campaign_id)
+        self.assertEqual(self.drain(campaign_id), [])
+        self.assertEqual(database.get_campaign_progress(campaign_id)['cancelled'], 9)
+        self.assertEqual(database.get_campaign(campaign_id)['status'], 'cancelled')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+import os
+import re
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+# Add project dir to path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "investor-mail-system"))
+
+import database
+
+# A plan line like "SCAN investors" (no index) means a full table scan
+FULL_SCAN = re.compile(r"^SCAN (\w+)$")
+
+
+class QueryPlanTest(unittest.TestCase):
+    """Every hot query in database.py must be served by an index"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.original_path = database.DATABASE_PATH
+        cls.tmp_dir = tempfile.mkdtemp(prefix="investor_mail_plans_")
+        database.open_database(os.path.join(cls.tmp_dir, "plans.db"))
+
+        cls.investor_id = database.add_investor("Plan Test", "plan@example.com", "Plan Co", "VC")
+        database.log_sent_mail(cls.investor_id, None, "Plan")
+        database.add_interaction(cls.investor_id, "note", "Plan")
+        database.log_audit("plan_test", "Plan")
+
+    @classmethod
+    def tearDownClass(cls):
+        database.open_database(cls.original_path)
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+
+    def capture_selects(self, func, *args):
+        """Run a database function and return the SELECT statements it executed"""
+        statements = []
+        with database.db_connection() as conn:
+            conn.set_trace_callback(statements.append)
+            try:
+                func(*args)
+            finally:
+                conn.set_trace_callback(None)
+        return [sql for sql in statements if sql.lstrip().upper().startswith("SELECT")]
+
+    def assert_indexed(self, func, *args, ignore_tables=()):
+        statements = self.capture_selects(func, *args)
+        self.assertTrue(statements, f"{func.__name__} executed no SELECT")
+
+        with database.db_connection() as conn:
+            for sql in statements:
+                details = [row["detail"] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+                for detail in details:
+                    scan = FULL_SCAN.match(detail)
+                    if scan and scan.group(1) not in ignore_tables:
+                        self.fail(f"{func.__name__}: full table scan ({detail})\n{sql}")
+                    self.assertNotIn("TEMP B-TREE", detail, f"{func.__name__}: unindexed sort\n{sql}")
+
+    def test_schema_version(self):
+        self.assertEqual(database.get_schema_version(), database.SCHEMA_MIGRATIONS[-1][0])
+
+    def test_failed_migration_rolls_back(self):
+        tmp_dir = tempfile.mkdtemp(prefix="investor_mail_migration_")
+        self.addCleanup(shutil.rmtree, tmp_dir, ignore_errors=True)
+        self.addCleanup(database.open_database, database.DATABASE_PATH)
+        database.open_database(os.path.join(tmp_dir, "failing.db"))
+        version = database.get_schema_version()
+
+        def failing_step(conn):
+            raise sqlite3.OperationalError("step failed")
+
+        def columns():
+            with database.db_connection() as conn:
+                return [row['name'] for row in conn.execute("PRAGMA table_info(investors)")]
+
+        before = columns()
+        new_version = (version + 1, "Test", [
+            "ALTER TABLE investors ADD COLUMN migration_test TEXT",
+            "CREATE INDEX idx_investors_migration_test ON investors (migration_test)",
+            failing_step,
+        ])
+        with mock.patch.object(database, 'SCHEMA_MIGRATIONS', database.SCHEMA_MIGRATIONS + [new_version]):
+            with self.assertRaises(sqlite3.OperationalError):
+                database.run_migrations()
+            self.assertEqual(columns(), before)
+            self.assertEqual(database.get_schema_version(), version)
+
+            # The next start runs the whole migration again
+            new_version[2].pop()
+            database.run_migrations()
+        self.assertIn("migration_test", columns())
+        self.assertEqual(database.get_schema_version(), version + 1)
+
+    def test_get_all_investors(self):
+        self.assert_indexed(database.get_all_investors)
+
+    def test_get_investors_by_category(self):
+        self.assert_indexed(database.get_investors_by_category, "VC")
+
+    def test_get_categories(self):
+        self.assert_indexed(database.get_categories)
+
+    def test_get_investor_by_id(self):
+        self.assert_indexed(database.get_investor_by_id, self.investor_id)
+
+    def test_get_investors_by_ids(self):
+        self.assert_indexed(lambda ids: list(database.get_investors_by_ids(ids)), [self.investor_id, 10 ** 9])
+
+    def test_get_investors_by_ids_order(self):
+        ids = [database.add_investor(f"Sıra {i}", f"sira{i}@example.com") for i in range(7)]
+        wanted = ids[::-1] + [10 ** 9]  # Newest first, plus an id that does not exist
+        rows = list(database.get_investors_by_ids(wanted, chunk_size=3))
+        self.assertEqual([row['id'] for row in rows], ids[::-1])
+        self.assertEqual(rows[0]['email'], "sira6@example.com")
+
+    def test_investor_filters(self):
+        for args in ((None, None), ("VC", None), ("VC", "plan"), (None, "şirket")):
+            with self.subTest(args=args):
+                self.assert_indexed(database.count_investors, *args)
+                self.assert_indexed(database.get_investor_ids, *args)
+                self.assert_indexed(database.get_investor_page, *args, 50, 0)
+
+    def test_investor_filter_search(self):
+        database.add_investor("ŞULE Yılmaz", "sule@example.com", "Örnek Fon", "MELEK")
+        self.assertEqual([inv['email'] for inv in database.get_investor_page(search="şule")], ["sule@example.com"])
+        self.assertEqual(database.count_investors("MELEK", "örnek"), 1)
+        self.assertEqual(database.count_investors("VC", "örnek"), 0)
+
+    def test_get_investors_keyset(self):
+        key = ("VC", "Plan", self.investor_id)
+        for category in (None, "VC"):
+            for cursor in ({}, {'after': key}, {'before': key}):
+                with self.subTest(category=category, cursor=cursor):
+                    self.assert_indexed(lambda: database.get_investors_keyset(category, limit=20, **cursor))
+
+    def test_keyset_pages_walk_the_list(self):
+        for i in range(12):
+            database.add_investor(f"Sayfa {i % 4}", f"sayfa{i}@example.com", "", ("VC", "MELEK")[i % 2],
+                                  tags="Fintech, Erken Aşama" if i % 3 == 0 else "")
+        for category in (None, "VC"):
+            expected = database.get_investor_ids(category)
+            pages, after = [], None
+            while True:
+                page = database.get_investors_keyset(category, limit=5, after=after)
+                if not page:
+                    break
+                pages.append([inv['id'] for inv in page])
+                after = (page[-1]['category'], page[-1]['name'], page[-1]['id'])
+            self.assertEqual(sum(pages, []), expected)
+
+            # Back from the second page gives the first one
+            def key(inv):
+                return inv['category'], inv['name'], inv['id']
+
+            first = database.get_investors_keyset(category, limit=5)
+            second = database.get_investors_keyset(category, limit=5, after=key(first[-1]))
+            back = database.get_investors_keyset(category, limit=5, before=key(second[0]))
+            self.assertEqual(back, first)
+
+        self.assertEqual(database.count_investors(tag="erken aşama"), 4)
+        self.assertEqual(database.count_investors(tag="erken"), 0)
+        self.assertEqual(database.count_investors(status="NEW", tag="FINTECH"), 4)
+
+    def test_get_status_counts(self):
+        self.assert_indexed(database.get_status_counts)
+        self.assertEqual(sum(database.get_status_counts().values()), database.count_investors())
+
+    def test_get_stats(self):
+        # The templates table holds a handful of rows, counting it by scan is fine
+        self.assert_indexed(database.get_stats, ignore_tables=("templates",))
+
+    def test_get_sent_mails(self):
+        self.assert_indexed(database.get_sent_mails, 50)
+
+    def test_get_investor_interactions(self):
+        self.assert_indexed(database.get_investor_interactions, self.investor_id)
+
+    def test_get_pending_scheduled_mails(self):
+        self.assert_indexed(database.get_pending_scheduled_mails)
+
+    def test_get_scheduled_wakeups(self):
+        self.assert_indexed(database.get_scheduled_wakeups)
+
+    def test_is_unsubscribed(self):
+        self.assert_indexed(database.is_unsubscribed, "plan@example.com")
+
+    def test_get_audit_logs(self):
+        self.assert_indexed(database.get_audit_logs, 50)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,189 @@
+import os
+import sys
+import time
+import asyncio
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+PROJECT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "investor-mail-system")
+
+# Add project dir to path
+sys.path.append(PROJECT_DIR)
+
+import smtplib
+import database
+from rate_limiter import (
+    SendQuotaLimiter, DailyQuotaExceeded, AdaptiveThrottle, classify_smtp_error,
+    TRANSIENT, DISCONNECTED, PERMANENT, QUOTA
+)
+
+
+class SendQuotaTest(unittest.TestCase):
+    """Token bucket and rolling 24h quota persisted in SQLite"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.original_path = database.DATABASE_PATH
+        cls.tmp_dir = tempfile.mkdtemp(prefix="investor_mail_quota_")
+
+    @classmethod
+    def tearDownClass(cls):
+        database.open_database(cls.original_path)
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+
+    def setUp(self):
+        self.db_path = os.path.join(self.tmp_dir, f"{self._testMethodName}.db")
+        database.open_database(self.db_path)
+
+    def test_burst_then_interval(self):
+        now = 1_000_000.0
+        waits = [database.reserve_send_slot(2.0, 3, 100, now=now)[0] for _ in range(6)]
+        self.assertEqual(waits, [0.0, 0.0, 0.0, 2.0, 4.0, 6.0])
+
+        # The bucket refills one token per interval
+        wait, _ = database.reserve_send_slot(2.0, 3, 100, now=now + 20)
+        self.assertEqual(wait, 0.0)
+
+    def test_rolling_daily_quota(self):
+        start = 1_000_000.0
+        for i in range(5):
+            self.assertEqual(database.reserve_send_slot(0, 10, 5, now=start + i)[0], 0.0)
+
+        wait, retry_at = database.reserve_send_slot(0, 10, 5, now=start + 10)
+        self.assertIsNone(wait)
+        self.assertEqual(retry_at, start + database.QUOTA_WINDOW_SECONDS)
+
+        # The first send leaves the window after 24 hours
+        wait, _ = database.reserve_send_slot(0, 10, 5, now=retry_at + 0.5)
+        self.assertEqual(wait, 0.0)
+
+    def test_status_and_plan(self):
+        limiter = SendQuotaLimiter(interval=60, burst=2, daily_limit=4)
+        self.assertEqual(limiter.status()['available_now'], 2)
+        self.assertEqual(limiter.plan(10), {'sendable': 4, 'deferred': 6, 'duration_seconds': 120.0})
+
+        limiter.reserve()
+        limiter.reserve()
+        status = limiter.status()
+        self.assertEqual((status['sent_24h'], status['remaining'], status['available_now']), (2, 2, 0))
+        self.assertGreater(status['next_slot_in'], 59)
+
+    def test_refund_gives_back_quota(self):
+        limiter = SendQuotaLimiter(interval=0, burst=5, daily_limit=3)
+        for _ in range(3):
+            limiter.reserve()
+        resets_at = limiter.status()['quota_resets_at']
+        with self.assertRaises(DailyQuotaExceeded):
+            limiter.reserve()
+
+        limiter.refund(2)
+        status = limiter.status()
+        self.assertEqual((status['sent_24h'], status['remaining']), (1, 2))
+        self.assertEqual(status['quota_resets_at'], resets_at)
+        limiter.reserve()
+
+    def test_quota_exceeded_raises(self):
+        limiter = SendQuotaLimiter(interval=0, burst=5, daily_limit=2)
+        limiter.wait()
+        limiter.wait()
+        with self.assertRaises(DailyQuotaExceeded) as raised:
+            limiter.wait()
+        self.assertGreater(raised.exception.retry_at, time.time())
+        self.assertIsNone(limiter.status()['next_slot_in'])
+
+    def test_shared_across_processes(self):
+        script = (
+            "import database\n"
+            "for _ in range(20): database.reserve_send_slot(0, 1, 50)\n"
+        )
+        env = dict(os.environ, INVESTOR_MAIL_DB=self.db_path)
+        workers = [
+            subprocess.Popen([sys.executable, "-c", script], cwd=PROJECT_DIR, env=env,
+                             stdout=subprocess.DEVNULL)
+            for _ in range(3)
+        ]
+        for worker in workers:
+            self.assertEqual(worker.wait(timeout=60), 0)
+
+        # 60 attempts from 3 processes, exactly the quota of 50 was handed out
+        self.assertEqual(SendQuotaLimiter(interval=0, burst=1, daily_limit=50).status()['sent_24h'], 50)
+
+
+class AdaptiveThrottleTest(unittest.TestCase):
+    """AIMD pacing and SMTP error classification"""
+
+    def test_classify_smtp_errors(self):
+        cases = [
+            (smtplib.SMTPDataError(421, b"4.7.0 Try again later"), TRANSIENT),
+            (smtplib.SMTPRecipientsRefused({"a@b.co": (450, b"4.2.1 too quickly")}), TRANSIENT),
+            (smtplib.SMTPRecipientsRefused({"a@b.co": (550, b"5.1.1 no such user")}), PERMANENT),
+            (smtplib.SMTPSenderRefused(454, b"4.7.0 Cannot authenticate", "me@b.co"), TRANSIENT),
+            (smtplib.SMTPDataError(550, b"5.4.5 Daily user sending limit exceeded"), QUOTA),
+            (smtplib.SMTPDataError(552, b"5.7.0 Attachment blocked"), PERMANENT),
+            (smtplib.SMTPServerDisconnected("Connection unexpectedly closed"), DISCONNECTED),
+            (ConnectionResetError(), DISCONNECTED),
+            # AsyncSMTPSession reply timeouts: two distinct classes before Python 3.11
+            (asyncio.TimeoutError(), DISCONNECTED),
+            (TimeoutError(), DISCONNECTED),
+            (ValueError("bad header"), PERMANENT),
+        ]
+        for error, kind in cases:
+            with self.subTest(error=error):
+                self.assertEqual(classify_smtp_error(error), kind)
+
+    def test_multiplicative_decrease_additive_increase(self):
+        throttle = AdaptiveThrottle(interval=1.0, decrease=0.5, increase=0.1, backoff_base=0.01)
+        self.assertEqual(throttle.reserve(), 0)
+
+        throttle.record(TRANSIENT)
+        throttle.record(TRANSIENT)
+        self.assertAlmostEqual(throttle.factor, 0.25)
+        self.assertEqual(throttle.failures, 2)
+
+        # Permanent errors and dropped connections leave the rate alone
+        throttle.record(PERMANENT)
+        throttle.record(DISCONNECTED)
+        self.assertAlmostEqual(throttle.factor, 0.25)
+
+        for _ in range(3):
+            throttle.record()
+        self.assertAlmostEqual(throttle.factor, 0.55)
+        self.assertEqual(throttle.failures, 0)
+
+        for _ in range(10):
+            throttle.record()
+        self.assertEqual(throttle.factor, 1.0)
+
+    def test_backoff_pauses_and_paces(self):
+        throttle = AdaptiveThrottle(interval=1.0, decrease=0.5, backoff_base=10, backoff_max=60)
+        delay = throttle.record(TRANSIENT, retry_after=30)
+        self.assertGreaterEqual(delay, 30)
+        self.assertGreater(throttle.reserve(), 29)
+        # Degraded: the next slot is interval / factor after the previous one
+        self.assertAlmostEqual(throttle.reserve() - delay, 2.0, delta=0.1)
+
+        self.assertEqual(throttle.record(QUOTA), 60)
+
+    def test_backoff_grows_with_jitter(self):
+        throttle = AdaptiveThrottle(backoff_base=2, backoff_max=20)
+        for failures, ceiling in [(1, 2), (2, 4), (3, 8), (5, 20), (9, 20)]:
+            delays = {throttle.backoff_delay(failures) for _ in range(20)}
+            self.assertTrue(all(ceiling / 2 <= d <= ceiling for d in delays))
+            self.assertGreater(len(delays), 1)
+
+    def test_metrics_series(self):
+        throttle = AdaptiveThrottle(backoff_base=0.01)
+        for _ in range(6):
+            throttle.record()
+        throttle.record(TRANSIENT)
+        metrics = throttle.metrics(bucket_seconds=60)
+        self.assertEqual((metrics['sent'], metrics['transient'], metrics['permanent']), (6, 1, 0))
+        self.assertEqual(metrics['series'][-1]['errors'], 1)
+        self.assertEqual(sum(point['sent_per_minute'] for point in metrics['series']), 6)
+        self.assertEqual(metrics['factor'], throttle.factor)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,342 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+# Add project dir to path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "investor-mail-system"))
+
+import database
+import scheduler
+from scheduler import EmailScheduler
+from rate_limiter import RateLimiter, AdaptiveThrottle, SendResult, TRANSIENT
+from outbox import run_outbox, enqueue_scheduled_mails
+from template_engine import render_batch
+
+
+def scheduled_mail_id(message_id):
+    """Scheduled mail behind an outbox Message-ID"""
+    key = message_id.strip('<>').split('@')[0]
+    with database.db_connection() as conn:
+        return conn.execute("SELECT scheduled_mail_id FROM outbox WHERE idempotency_key = ?", (key,)).fetchone()[0]
+
+
+class FakeTransport:
+    """Stands in for the Gmail transport, recording when each scheduled mail went out"""
+    concurrency = 4
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def send(self, to_email, subject, body_html, attachments, message_id=None):
+        owner = self.scheduler
+        owner.checks += 1
+        if owner.fail_first:
+            owner.fail_first -= 1
+            return SendResult(False, "⏳ Geçici hata: 421", TRANSIENT)
+        key = scheduled_mail_id(message_id)
+        owner.sent[key] = time.time()
+        owner.bodies[key] = (subject, body_html)
+        owner.log.append(key)
+        return True, "✅ Gönderildi"
+
+
+class FakeScheduler(EmailScheduler):
+    """EmailScheduler sending the outbox over a fake transport"""
+    _instance = None
+    _running = False
+
+    def _oauth_client(self):
+        return object()
+
+    def _send(self, oauth_client, campaign_id):
+        return run_outbox(FakeTransport(self), campaign_id, rate_limiter=RateLimiter(0),
+                          throttle=AdaptiveThrottle(0))
+
+
+class EmailSchedulerTest(unittest.TestCase):
+    """Wakeup heap: mails go out when due, without polling"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.original_path = database.DATABASE_PATH
+        cls.tmp_dir = tempfile.mkdtemp(prefix="investor_mail_scheduler_")
+        database.open_database(os.path.join(cls.tmp_dir, "scheduler.db"))
+        cls.investor_id = database.add_investor("Ayşe", "ayse@example.com")
+
+    @classmethod
+    def tearDownClass(cls):
+        database.open_database(cls.original_path)
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+
+    def setUp(self):
+        FakeScheduler._instance = None
+        FakeScheduler.checks = 0
+        FakeScheduler.fail_first = 0
+        FakeScheduler.sent = {}
+        FakeScheduler.bodies = {}
+        FakeScheduler.log = []
+        self.scheduler = FakeScheduler()
+        self.addCleanup(self.scheduler.stop)
+
+    def schedule(self, seconds):
+        return database.schedule_mail(self.investor_id, None, "Konu", "<p>Gövde</p>",
+                                      datetime.now() + timedelta(seconds=seconds))
+
+    def status(self, mail_id):
+        with database.db_connection() as conn:
+            return conn.execute("SELECT status FROM scheduled_mails WHERE id = ?", (mail_id,)).fetchone()[0]
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_sends_when_due(self):
+        start = time.time()
+        due = {self.schedule(0.2 + i * 0.05): start + 0.2 + i * 0.05 for i in range(10)}
+        self.assertTrue(self.wait_for(lambda: len(self.scheduler.sent) == 10))
+
+        self.assertEqual(set(self.scheduler.sent), set(due))
+        for mail_id, sent_at in self.scheduler.sent.items():
+            self.assertGreaterEqual(sent_at, due[mail_id] - 0.01)
+        lag = self.scheduler.lag_stats()
+        self.assertEqual(lag['count'], 10)
+        self.assertLess(lag['p99'], 0.5)
+
+    def test_idle_without_due_mails(self):
+        self.schedule(3600)
+        time.sleep(0.3)
+        self.assertEqual(self.scheduler.checks, 0)
+
+    def test_cancel(self):
+        mail_id = self.schedule(0.2)
+        kept = self.schedule(0.3)
+        self.assertTrue(database.cancel_scheduled_mail(mail_id))
+        self.assertFalse(database.cancel_scheduled_mail(mail_id))
+
+        self.assertTrue(self.wait_for(lambda: kept in self.scheduler.sent))
+        time.sleep(0.1)
+        self.assertNotIn(mail_id, self.scheduler.sent)
+
+    def test_retries_transient_failures(self):
+        FakeScheduler.fail_first = 1
+        mail_id = self.schedule(0)
+        self.assertTrue(self.wait_for(lambda: mail_id in self.scheduler.sent))
+        self.assertEqual(self.scheduler.checks, 2)
+
+    def test_sent_through_outbox(self):
+        logged = database.get_stats()['total_sent']
+        mail_id = self.schedule(0)
+        self.assertTrue(self.wait_for(lambda: self.status(mail_id) == 'sent'))
+        with database.db_connection() as conn:
+            row = conn.execute("SELECT * FROM outbox WHERE scheduled_mail_id = ?", (mail_id,)).fetchone()
+        self.assertEqual((row['state'], row['attempts']), ('sent', 1))
+        self.assertEqual(database.get_stats()['total_sent'], logged + 1)
+        self.assertEqual(database.get_unfinished_campaigns(scheduled=True), [])
+
+    def test_resumes_mails_left_in_outbox(self):
+        # A worker moved a mail into the outbox, then its process died
+        self.scheduler.stop()
+        mail_id = database.schedule_mail(self.investor_id, None, "Konu", "<p>Gövde</p>",
+                                         datetime.now() - timedelta(seconds=1))
+        mails = database.claim_scheduled_mails("olu", 10, 60)
+        self.assertEqual([mail['id'] for mail in mails], [mail_id])
+        enqueue_scheduled_mails(mails, "olu")
+        self.assertEqual(self.status(mail_id), 'queued')
+
+        FakeScheduler._instance = None
+        FakeScheduler._running = False
+        self.scheduler = FakeScheduler()
+        self.addCleanup(self.scheduler.stop)
+        self.assertTrue(self.wait_for(lambda: mail_id in self.scheduler.sent))
+        self.assertTrue(self.wait_for(lambda: self.status(mail_id) == 'sent'))
+
+    def test_resync_finds_other_processes_mails(self):
+        with mock.patch.object(scheduler, 'SCHEDULER_RESYNC_SECONDS', 0.2):
+            self.scheduler._resync()
+            # Written without schedule_mail, so no listener fires
+            with database.db_connection() as conn:
+                cursor = conn.execute(
+                    "INSERT INTO scheduled_mails (investor_id, subject, body, scheduled_time) VALUES (?, ?, ?, ?)",
+                    (self.investor_id, "Konu", "<p>Gövde</p>", datetime.now())
+                )
+            self.assertTrue(self.wait_for(lambda: cursor.lastrowid in self.scheduler.sent))
+
+    def test_two_schedulers_send_once(self):
+        class OtherProcess(FakeScheduler):
+            _instance = None
+            _running = False
+
+        other = OtherProcess()
+        self.addCleanup(other.stop)
+        ids = [self.schedule(0.1) for _ in range(40)]
+        self.assertTrue(self.wait_for(lambda: len(self.scheduler.log) >= 40))
+        time.sleep(0.1)
+        self.assertEqual(sorted(self.scheduler.log), sorted(ids))
+
+    def test_sends_campaign_rendered_at_send_time(self):
+        investor = database.get_investor_by_id(self.investor_id)
+        due = datetime.now() + timedelta(seconds=0.1)
+        self.assertEqual(scheduler.schedule_campaign([investor], "Merhaba {{ad}}", "<p>{{sirket}}</p>", due), 1)
+        self.assertTrue(self.wait_for(lambda: len(self.scheduler.sent) == 1))
+        subject, body = list(self.scheduler.bodies.values())[0]
+        self.assertEqual(subject, "Merhaba Ayşe")
+        self.assertIn(b"<p></p>", body)
+
+
+
+class ClaimTest(unittest.TestCase):
+    """pending -> claimed -> sent/failed, with leases"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.original_path = database.DATABASE_PATH
+        cls.tmp_dir = tempfile.mkdtemp(prefix="investor_mail_claims_")
+        database.open_database(os.path.join(cls.tmp_dir, "claims.db"))
+        cls.investor_id = database.add_investor("Ayşe", "ayse@example.com")
+
+    @classmethod
+    def tearDownClass(cls):
+        database.open_database(cls.original_path)
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+
+    def setUp(self):
+        with database.db_connection() as conn:
+            conn.execute("DELETE FROM scheduled_mails")
+        due = datetime.now() - timedelta(hours=1)
+        self.ids = [database.schedule_mail(self.investor_id, None, "Konu", "<p>Gövde</p>", due)
+                    for _ in range(30)]
+
+    def test_claims_are_exclusive(self):
+        claimed = []
+
+        def worker(owner):
+            while True:
+                mails = database.claim_scheduled_mails(owner, 4, 60)
+                if not mails:
+                    return
+                claimed.extend(mail['id'] for mail in mails)
+
+        threads = [threading.Thread(target=worker, args=(f"w{i}",)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(claimed), self.ids)
+
+    def test_reclaims_expired_lease(self):
+        dead = database.claim_scheduled_mails("olu", 30, 60, now=time.time() - 120)
+        self.assertEqual(len(dead), 30)
+        self.assertEqual(database.claim_scheduled_mails("canli", 30, 60, now=time.time() - 100), [])
+
+        mails = database.claim_scheduled_mails("canli", 30, 60)
+        self.assertEqual([mail['id'] for mail in mails], self.ids)
+        self.assertEqual({mail['attempts'] for mail in mails}, {1})
+        self.assertEqual(mails[0]['investor_email'], "ayse@example.com")
+
+        # The dead worker's late result is ignored
+        self.assertFalse(database.complete_scheduled_mail(self.ids[0], "olu", 'sent'))
+        self.assertTrue(database.complete_scheduled_mail(self.ids[0], "canli", 'sent'))
+
+    def test_deferred_waits_for_retry_time(self):
+        mail = database.claim_scheduled_mails("w", 1, 60)[0]
+        database.defer_scheduled_mail(mail['id'], "⏳ 421", "w", retry_at=time.time() + 60)
+        self.assertNotIn(mail['id'], [m['id'] for m in database.claim_scheduled_mails("w", 30, 600)])
+        later = database.claim_scheduled_mails("w", 30, 60, now=time.time() + 61)
+        self.assertEqual([m['id'] for m in later], [mail['id']])
+        self.assertEqual(later[0]['attempts'], 1)
+
+
+class ScheduledCampaignTest(unittest.TestCase):
+    """Scheduled mails stored as template snapshot + context, rendered when sent"""
+
+    SUBJECT = "{{ad}} için fırsat"
+    BODY = "<html><body><p>Merhaba {{ad}}, {{sirket}}</p>{% if kategori %}<i>{{kategori}}</i>{% endif %}</body></html>"
+
+    @classmethod
+    def setUpClass(cls):
+        cls.original_path = database.DATABASE_PATH
+        cls.tmp_dir = tempfile.mkdtemp(prefix="investor_mail_campaigns_")
+        database.open_database(os.path.join(cls.tmp_dir, "campaigns.db"))
+        for i in range(5):
+            database.add_investor(f"Yatırımcı {i}", f"y{i}@example.com", f"Şirket {i}", "MELEK" if i % 2 else "VC",
+                                  notes="uzun notlar " * 50)
+        cls.investors = database.get_all_investors()
+        cls.template_id = database.add_template("Pitch", cls.SUBJECT, cls.BODY)
+
+    @classmethod
+    def tearDownClass(cls):
+        database.open_database(cls.original_path)
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+
+    def setUp(self):
+        with database.db_connection() as conn:
+            conn.execute("DELETE FROM scheduled_mails")
+        self.due = datetime.now() - timedelta(hours=1)
+
+    def rows(self):
+        with database.db_connection() as conn:
+            return [dict(row) for row in conn.execute("SELECT * FROM scheduled_mails ORDER BY id")]
+
+    def test_stores_template_once(self):
+        count = scheduler.schedule_campaign(self.investors, self.SUBJECT, self.BODY, self.due, self.template_id)
+        self.assertEqual(count, 5)
+
+        rows = self.rows()
+        self.assertEqual(len({row['campaign_id'] for row in rows}), 1)
+        self.assertTrue(all(row['body'] is None and row['subject'] is None for row in rows))
+        # Only the variables the templates use, not the whole investor row
+        self.assertEqual(set(json.loads(rows[0]['context'])), {'ad', 'sirket', 'kategori'})
+        campaign = database.get_scheduled_campaign(rows[0]['campaign_id'])
+        self.assertEqual(campaign['body_template'], self.BODY)
+
+    def test_lazy_render_matches_eager(self):
+        scheduler.schedule_campaign(self.investors, self.SUBJECT, self.BODY, self.due, self.template_id)
+        mails = database.claim_scheduled_mails("w", 10, 600)
+        self.assertEqual(scheduler.render_scheduled_mails(mails), [])
+
+        eager = {inv['id']: (subject, body) for inv, subject, body in
+                 render_batch(self.BODY, self.SUBJECT, self.investors)}
+        for mail in mails:
+            self.assertEqual((mail['subject'], mail['body'].decode('utf-8')), eager[mail['investor_id']])
+
+    def test_render_errors(self):
+        scheduler.schedule_campaign(self.investors[:2], "Konu", "{{ 1 // sifir }}", self.due)
+        mails = database.claim_scheduled_mails("w", 10, 600)
+        self.assertEqual(len(scheduler.render_scheduled_mails(mails)), 2)
+
+    def test_migration_compacts_unchanged_mails(self):
+        rendered = list(render_batch(self.BODY, self.SUBJECT, self.investors[:2]))
+        for inv, subject, body in rendered:
+            database.schedule_mail(inv['id'], self.template_id, subject, body, self.due)
+        # Edited by hand after rendering, must stay as it is
+        database.schedule_mail(self.investors[2]['id'], self.template_id, "Özel konu", "<p>Özel</p>", self.due)
+
+        with database.db_connection() as conn:
+            database._compact_scheduled_mails(conn)
+        rows = self.rows()
+        self.assertEqual([row['body'] is None for row in rows], [True, True, False])
+
+        mails = database.claim_scheduled_mails("w", 10, 600)
+        scheduler.render_scheduled_mails(mails)
+        self.assertEqual([(m['subject'], m['body']) for m in mails[:2]],
+                         [(subject, body.encode('utf-8')) for _, subject, body in rendered])
+        self.assertEqual(mails[2]['body'], "<p>Özel</p>")
+
+
+if __name__ == '__main__':
+    unittest.main()
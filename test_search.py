@@ -0,0 +1,115 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+# Add project dir to path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "investor-mail-system"))
+
+import database
+
+
+class SearchInvestorsTest(unittest.TestCase):
+    """Full-text investor search (investors_fts), kept in sync by triggers"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.original_path = database.DATABASE_PATH
+        cls.tmp_dir = tempfile.mkdtemp(prefix="investor_mail_search_")
+        database.open_database(os.path.join(cls.tmp_dir, "search.db"))
+
+        cls.cagri = database.add_investor("Çağrı Yılmaz", "cagri@example.com", "İstanbul Girişim Ortakları", "VC",
+                                          notes="Oyun yatırımlarına açık", tags="gaming, seed")
+        cls.ayse = database.add_investor("Ayşe Demir", "ayse@example.com", "Demir Holding", "MELEK",
+                                         notes="Çağrı bey tanıştırdı")
+        cls.ISIL = database.add_investor("IŞIL ÖZ", "isil@example.com", "Öz Yatırım", "MELEK", tags="fintech")
+
+    @classmethod
+    def tearDownClass(cls):
+        database.open_database(cls.original_path)
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+
+    def ids(self, query):
+        return [inv['id'] for inv in database.search_investors(query)]
+
+    def test_ignores_case_and_turkish_letters(self):
+        for query in ("cagri yilmaz", "ÇAĞRI", "istanbul", "ISTANBUL", "girisim"):
+            with self.subTest(query=query):
+                self.assertIn(self.cagri, self.ids(query))
+        for query in ("ışıl", "isil", "IŞIL", "oz yatirim"):
+            with self.subTest(query=query):
+                self.assertEqual(self.ids(query), [self.ISIL])
+
+    def test_prefixes(self):
+        self.assertEqual(set(self.ids("yat")), {self.cagri, self.ISIL})
+        self.assertEqual(self.ids("fin"), [self.ISIL])
+        self.assertEqual(self.ids("@"), [])
+
+    def test_name_ranks_above_notes(self):
+        # Çağrı is in one investor's name and another's notes
+        self.assertEqual(self.ids("çağrı"), [self.cagri, self.ayse])
+
+    def test_triggers_keep_index_in_sync(self):
+        investor_id = database.add_investor("Kemal Kara", "kemal@example.com")
+        self.assertEqual(self.ids("kemal"), [investor_id])
+
+        database.update_investor(investor_id, "Kemal Kara", "kemal@example.com", "Kara Capital", "VC",
+                                 "Sağlık teknolojisi", "", "", "NEW", "healthtech")
+        self.assertEqual(self.ids("saglik"), [investor_id])
+        self.assertEqual(self.ids("healthtech"), [investor_id])
+
+        database.add_interaction(investor_id, "meeting", "Zoom görüşmesi, dönüş bekleniyor")
+        self.assertEqual(self.ids("gorusme"), [investor_id])
+        with database.db_connection() as conn:
+            conn.execute("DELETE FROM interactions WHERE investor_id = ?", (investor_id,))
+        self.assertEqual(self.ids("gorusme"), [])
+
+        # Imports update the same rows through ON CONFLICT DO UPDATE
+        database.bulk_add_investors([{'email': "kemal@example.com", 'name': "Kemal Kara", 'notes': "Biyoteknoloji"}],
+                                    on_conflict="update")
+        self.assertEqual(self.ids("biyo"), [investor_id])
+
+        database.delete_investor(investor_id)
+        self.assertEqual(self.ids("kemal"), [])
+
+    def test_import_counts_ignore_trigger_writes(self):
+        rows = [("Nur Ak", "nur@example.com", "", "", "", "", "", "NEW", ""),
+                ("Efe Su", "efe@example.com", "", "", "", "", "", "NEW", "")]
+        self.assertEqual(database.bulk_upsert_investors(rows), {'added': 2, 'updated': 0, 'skipped': 0})
+        rows.append(("Can Tan", "can@example.com", "", "", "", "", "", "NEW", ""))
+        self.assertEqual(database.bulk_upsert_investors(rows, on_conflict="update"),
+                         {'added': 1, 'updated': 2, 'skipped': 0})
+        self.assertEqual(database.bulk_upsert_investors(rows), {'added': 0, 'updated': 0, 'skipped': 3})
+
+    def test_list_filters_use_the_index(self):
+        self.assertEqual(database.count_investors(search="cagri"), 2)
+        self.assertEqual(database.count_investors("VC", "cagri"), 1)
+        with database.db_connection() as conn:
+            sql = "SELECT rowid FROM investors_fts WHERE investors_fts MATCH ?"
+            details = [row['detail'] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, ('"x"*',))]
+        self.assertTrue(any("VIRTUAL TABLE INDEX" in detail for detail in details), details)
+
+    def test_migration_indexes_existing_rows(self):
+        tmp_dir = tempfile.mkdtemp(prefix="investor_mail_search_migration_")
+        self.addCleanup(shutil.rmtree, tmp_dir, ignore_errors=True)
+        self.addCleanup(database.open_database, database.DATABASE_PATH)
+
+        database.open_database(os.path.join(tmp_dir, "old.db"))
+        # A database from before the full-text index, with an investor and a note
+        with database.db_connection() as conn:
+            conn.execute("DROP TABLE investors_fts")
+            for trigger in ('investors_fts_insert', 'investors_fts_update', 'investors_fts_delete',
+                            'interactions_fts_insert', 'interactions_fts_update', 'interactions_fts_delete'):
+                conn.execute(f"DROP TRIGGER {trigger}")
+            conn.execute("PRAGMA user_version = 7")
+        investor_id = database.add_investor("Eski Kayıt", "eski@example.com")
+        database.add_interaction(investor_id, "note", "Lansmanda tanışıldı")
+
+        database.run_migrations()
+        self.assertEqual(self.ids("eski"), [investor_id])
+        self.assertEqual(self.ids("lansman"), [investor_id])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+import os
+import sys
+import unittest
+
+# Add project dir to path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "investor-mail-system"))
+
+from jinja2 import Template
+
+from template_engine import (
+    render_template, render_batch, render_message, build_context, get_default_templates,
+    splice_footer, TemplateCache, SimpleTemplate, TRACKING_PIXEL
+)
+from mime_message import html_part
+from email.mime.text import MIMEText
+
+BODY = "<html><body>Merhaba {{ad}}, {{sirket}} ({{category}}) - {{email}}</body></html>"
+SUBJECT = "{{name}} & {{company}}"
+
+RECIPIENTS = [
+    {'id': 1, 'name': 'Ayşe Yılmaz', 'company': 'Örnek VC', 'category': 'VC', 'email': 'ayse@example.com'},
+    {'id': 2, 'name': 'John Doe', 'company': None, 'category': 'ANGEL', 'email': 'john@example.com'},
+    {'ad': 'Mehmet', 'sirket': 'Fon A.Ş.', 'kategori': 'FON'},
+]
+
+
+class RenderBatchTest(unittest.TestCase):
+    """render_batch must personalize exactly like render_template"""
+
+    def test_matches_render_template(self):
+        for recipient, subject, body in render_batch(BODY, SUBJECT, RECIPIENTS):
+            self.assertEqual(body, render_template(BODY, recipient))
+            self.assertEqual(subject, render_template(SUBJECT, recipient).replace(TRACKING_PIXEL, ''))
+
+    def test_subject_has_no_tracking_pixel(self):
+        _, subject, body = next(render_batch(BODY, SUBJECT, RECIPIENTS))
+        self.assertEqual(subject, "Ayşe Yılmaz & Örnek VC")
+        self.assertIn(TRACKING_PIXEL + "</body>", body)
+
+    def test_tracking_can_be_disabled(self):
+        _, _, body = next(render_batch(BODY, SUBJECT, RECIPIENTS, tracking=False))
+        self.assertNotIn(TRACKING_PIXEL, body)
+
+    def test_none_renders_empty(self):
+        results = list(render_batch(BODY, SUBJECT, RECIPIENTS))
+        self.assertEqual(results[1][1], "John Doe & ")
+
+    def test_process_pool_keeps_order(self):
+        recipients = [dict(RECIPIENTS[0], id=i, name=f"Yatırımcı {i}") for i in range(50)]
+        serial = list(render_batch(BODY, SUBJECT, recipients))
+        parallel = list(render_batch(BODY, SUBJECT, recipients, processes=2, chunk_size=7))
+        self.assertEqual(serial, parallel)
+
+    def test_errors_are_yielded_or_raised(self):
+        broken = "{{ missing.attr }}"
+        recipient, subject, error = next(render_batch(broken, SUBJECT, RECIPIENTS, return_errors=True))
+        self.assertIsNone(subject)
+        self.assertIsInstance(error, Exception)
+        with self.assertRaises(Exception):
+            list(render_batch(broken, SUBJECT, RECIPIENTS))
+
+
+# Templates the fast path must take, rendered against jinja2 for identical output
+SIMPLE_SOURCES = [
+    "",
+    "Sadece metin, değişken yok",
+    "{{ad}}",
+    "{{ad}}{{sirket}}",
+    "Merhaba {{ ad }}!\n{{sirket}}\n",
+    "Trailing newlines\n\n",
+    "{{-  ad  -}}   {{ sirket -}}\n  sonu",
+    "{# yorum #}Önce {{ad}} {# başka #}sonra",
+    "{% raw %}{{ad}} kalır{% endraw %} {{ad}}",
+    "{{ bilinmeyen }}|{{ None_value }}|{{ sayi }}|{{ ondalik }}|{{ liste }}",
+    "Emoji 🚀 {{ad}} ğüşıöç ĞÜŞİÖÇ",
+    "<html><body>{{email}}</body></html>",
+]
+
+# Templates that need jinja2 (control flow, filters, expressions, globals)
+JINJA_SOURCES = [
+    "{{ ad|upper }}",
+    "{{ ad.title() }}",
+    "{{ liste[0] }}",
+    "{% if ad %}Sayın {{ad}}{% endif %}",
+    "{% for x in liste %}{{x}},{% endfor %}",
+    "{% set y = 1 %}{{y}}",
+    "{{ ad ~ sirket }}",
+    "{{ 'sabit' }}",
+    "{{ range }}",
+    "{{ self }}",
+]
+
+CONTEXTS = [
+    {},
+    build_context(RECIPIENTS[0]),
+    build_context(RECIPIENTS[1]),
+    build_context(RECIPIENTS[2]),
+    {'ad': 'Ali', 'None_value': None, 'sayi': 42, 'ondalik': 1.5, 'liste': ['a', 'b'], 'sirket': ''},
+    {'ad': '<b>&</b>', 'sirket': '{{ad}}', 'email': 'x@y.z'},
+]
+
+
+class FastPathTest(unittest.TestCase):
+    """Simple templates skip jinja2 but must render byte-identical output"""
+
+    def setUp(self):
+        self.cache = TemplateCache(bytecode_dir=None)
+
+    def assert_same_output(self, source):
+        compiled = self.cache.get(source)
+        for context in CONTEXTS:
+            with self.subTest(source=source, context=context):
+                self.assertEqual(compiled.render(context), Template(source).render(context))
+                self.assertEqual(compiled.render(**context), Template(source).render(**context))
+
+    def test_simple_templates_take_fast_path(self):
+        for source in SIMPLE_SOURCES:
+            with self.subTest(source=source):
+                self.assertIsInstance(self.cache.get(source), SimpleTemplate)
+
+    def test_default_templates_take_fast_path(self):
+        for template in get_default_templates():
+            self.assertIsInstance(self.cache.get(template['body']), SimpleTemplate)
+            self.assertIsInstance(self.cache.get(template['subject']), SimpleTemplate)
+
+    def test_other_templates_fall_back_to_jinja(self):
+        for source in JINJA_SOURCES:
+            with self.subTest(source=source):
+                self.assertNotIsInstance(self.cache.get(source), SimpleTemplate)
+
+    def test_identical_output(self):
+        sources = SIMPLE_SOURCES + [t['body'] for t in get_default_templates()]
+        sources += [t['subject'] for t in get_default_templates()]
+        for source in sources:
+            self.assert_same_output(source)
+
+    def test_fast_path_can_be_disabled(self):
+        cache = TemplateCache(bytecode_dir=None, fast_path=False)
+        self.assertNotIsInstance(cache.get("{{ad}}"), SimpleTemplate)
+
+
+class FooterTest(unittest.TestCase):
+    """Footers go before the last </body> in one pass, bodies can render to bytes"""
+
+    FOOTER = '<p>Abonelikten çık</p>'
+    SOURCES = [
+        "<html><body>{{ad}}</body></html>",
+        "<body>{{ad}}</body>{{sirket}}</body>son",
+        "{{ad}}</body>",
+        "</body>{{ad}}",
+        "no body {{ad}}",
+        "{% if ad %}<body>{{ad}}</body>{% endif %}",
+    ]
+
+    def setUp(self):
+        self.cache = TemplateCache(bytecode_dir=None)
+
+    def test_footer_matches_string_splice(self):
+        for source in self.SOURCES:
+            for context in CONTEXTS:
+                with self.subTest(source=source, context=context):
+                    expected = splice_footer(Template(source).render(context), self.FOOTER)
+                    compiled = self.cache.get(source)
+                    self.assertEqual(render_message(compiled, context, self.FOOTER), expected)
+                    self.assertEqual(
+                        render_message(compiled, context, self.FOOTER, as_bytes=True),
+                        expected.encode('utf-8')
+                    )
+
+    def test_footer_before_last_body_close(self):
+        self.assertEqual(splice_footer("a</body>b</body>c", "F"), "a</body>bF</body>c")
+        self.assertEqual(splice_footer("abc", "F"), "abcF")
+
+    def test_render_template_bytes(self):
+        body = get_default_templates()[0]['body']
+        self.assertEqual(
+            render_template(body, RECIPIENTS[0], as_bytes=True),
+            render_template(body, RECIPIENTS[0]).encode('utf-8')
+        )
+
+    def test_batch_footer_per_recipient(self):
+        footer = lambda recipient: f"<a href='/unsubscribe?id={recipient.get('id')}'>x</a>"
+        results = list(render_batch(BODY, SUBJECT, RECIPIENTS, footer=footer, as_bytes=True))
+        self.assertTrue(results[0][2].endswith(
+            "<a href='/unsubscribe?id=1'>x</a>".encode('utf-8') + TRACKING_PIXEL.encode('utf-8') + b"</body></html>"
+        ))
+
+    def test_html_part_from_bytes(self):
+        html = render_template(BODY, RECIPIENTS[0])
+        self.assertEqual(
+            html_part(html.encode('utf-8')).as_string(),
+            MIMEText(html, 'html', 'utf-8').as_string()
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()